@@ -1,55 +1,147 @@
 """Support for Home Theatre Direct's MC series"""
 
+import asyncio
+
 import homeassistant.helpers.config_validation as cv
 import voluptuous as vol
-from homeassistant.const import CONF_HOST, CONF_PORT
-from homeassistant.core import HomeAssistant
+from homeassistant.const import (
+    ATTR_ENTITY_ID,
+    CONF_HOST,
+    CONF_PORT,
+    EVENT_HOMEASSISTANT_STOP,
+)
+from homeassistant.core import (
+    Event,
+    HomeAssistant,
+    ServiceCall,
+    ServiceResponse,
+    SupportsResponse,
+)
+from homeassistant.exceptions import HomeAssistantError
 from homeassistant.helpers import discovery
 from homeassistant.helpers.typing import ConfigType
 
-from .htd_mc_client.client import HtdMcClient
+from .coordinator import HtdCoordinator
+from .diagnostics import get_diagnostics
+from .htd_mc_client.async_client import AsyncHtdMcClient
 from .htd_mc_client.constants import HtdConstants
+from .htd_mc_client.models import ZoneDetail
+from .htd_mc_client.transport import SerialTransport, TcpTransport
 
 DOMAIN = "htd_mc"
 
+CONF_SERIAL_PORT = "serial_port"
+CONF_BAUDRATE = "baudrate"
 CONF_ZONES = "zones"
+CONF_ZONE_COUNT = "zone_count"
 CONF_SOURCES = "sources"
 CONF_RETRY_ATTEMPTS = "retry_attempts"
 CONF_SOCKET_TIMEOUT = "socket_timeout"
 CONF_COMMAND_DELAY = "command_delay"
+CONF_IDLE_TIMEOUT = "idle_timeout"
+CONF_CACHE_TTL = "cache_ttl"
 CONF_UPDATE_VOLUME_ON_CHANGE = "update_volume_on_change"
+CONF_OPTIMISTIC = "optimistic"
+
+SERVICE_APPLY_SCENE = "apply_scene"
+SERVICE_GET_DIAGNOSTICS = "get_diagnostics"
+
+ATTR_POWER = "power"
+ATTR_SOURCE = "source"
+ATTR_VOLUME = "volume"
+ATTR_MUTE = "mute"
+ATTR_BASS = "bass"
+ATTR_TREBLE = "treble"
+ATTR_BALANCE = "balance"
+
+APPLY_SCENE_SCHEMA = vol.Schema(
+    {
+        vol.Required(ATTR_ENTITY_ID): cv.entity_ids,
+        vol.Optional(ATTR_POWER): cv.boolean,
+        vol.Optional(ATTR_SOURCE): cv.string,
+        vol.Optional(ATTR_VOLUME): vol.All(
+            vol.Coerce(float), vol.Range(min=0, max=1)
+        ),
+        vol.Optional(ATTR_MUTE): cv.boolean,
+        vol.Optional(ATTR_BASS): vol.All(
+            vol.Coerce(int),
+            vol.Range(
+                min=-HtdConstants.MAX_HTD_TONE, max=HtdConstants.MAX_HTD_TONE
+            ),
+        ),
+        vol.Optional(ATTR_TREBLE): vol.All(
+            vol.Coerce(int),
+            vol.Range(
+                min=-HtdConstants.MAX_HTD_TONE, max=HtdConstants.MAX_HTD_TONE
+            ),
+        ),
+        vol.Optional(ATTR_BALANCE): vol.All(
+            vol.Coerce(int),
+            vol.Range(
+                min=-HtdConstants.MAX_HTD_BALANCE,
+                max=HtdConstants.MAX_HTD_BALANCE,
+            ),
+        ),
+    }
+)
+
+# a gateway is reached either over the network, or through a serial port
+GATEWAY_SCHEMA = vol.Schema(
+    {
+        vol.Exclusive(CONF_HOST, "connection"): cv.string,
+        vol.Optional(
+            CONF_PORT, default=HtdConstants.DEFAULT_HTD_MC_PORT
+        ): cv.port,
+        vol.Exclusive(CONF_SERIAL_PORT, "connection"): cv.string,
+        vol.Optional(
+            CONF_BAUDRATE,
+            default=HtdConstants.DEFAULT_SERIAL_BAUDRATE
+        ): cv.positive_int,
+        vol.Optional(CONF_ZONES): vol.All(
+            cv.ensure_list,
+            [cv.string]
+        ),
+        vol.Optional(CONF_SOURCES): vol.All(
+            cv.ensure_list,
+            [cv.string]
+        ),
+        vol.Optional(CONF_ZONE_COUNT): vol.All(
+            vol.Coerce(int),
+            vol.Range(min=1, max=HtdConstants.MAX_HTD_ZONES),
+        ),
+        vol.Optional(
+            CONF_RETRY_ATTEMPTS,
+            default=HtdConstants.DEFAULT_RETRY_ATTEMPTS
+        ): cv.port,
+        vol.Optional(
+            CONF_SOCKET_TIMEOUT,
+            default=HtdConstants.DEFAULT_SOCKET_TIMEOUT
+        ): cv.port,
+        vol.Optional(
+            CONF_COMMAND_DELAY,
+            default=HtdConstants.DEFAULT_COMMAND_DELAY
+        ): cv.port,
+        vol.Optional(
+            CONF_IDLE_TIMEOUT,
+            default=HtdConstants.DEFAULT_IDLE_TIMEOUT
+        ): cv.positive_int,
+        vol.Optional(
+            CONF_CACHE_TTL,
+            default=HtdConstants.DEFAULT_CACHE_TTL
+        ): cv.positive_float,
+        vol.Optional(CONF_UPDATE_VOLUME_ON_CHANGE): cv.boolean,
+        vol.Optional(CONF_OPTIMISTIC, default=True): cv.boolean,
+    }
+)
 
 CONFIG_SCHEMA = vol.Schema(
     {
         DOMAIN: vol.Schema(
             [
-                {
-                    vol.Required(CONF_HOST): cv.string,
-                    vol.Optional(
-                        CONF_PORT, default=HtdConstants.DEFAULT_HTD_MC_PORT
-                    ): cv.port,
-                    vol.Optional(CONF_ZONES): vol.All(
-                        cv.ensure_list,
-                        [cv.string]
-                    ),
-                    vol.Optional(CONF_SOURCES): vol.All(
-                        cv.ensure_list,
-                        [cv.string]
-                    ),
-                    vol.Optional(
-                        CONF_RETRY_ATTEMPTS,
-                        default=HtdConstants.DEFAULT_RETRY_ATTEMPTS
-                    ): cv.port,
-                    vol.Optional(
-                        CONF_SOCKET_TIMEOUT,
-                        default=HtdConstants.DEFAULT_SOCKET_TIMEOUT
-                    ): cv.port,
-                    vol.Optional(
-                        CONF_COMMAND_DELAY,
-                        default=HtdConstants.DEFAULT_COMMAND_DELAY
-                    ): cv.port,
-                    vol.Optional(CONF_UPDATE_VOLUME_ON_CHANGE): cv.boolean,
-                }
+                vol.All(
+                    GATEWAY_SCHEMA,
+                    cv.has_at_least_one_key(CONF_HOST, CONF_SERIAL_PORT),
+                )
             ]
         )
     },
@@ -57,7 +149,7 @@ CONFIG_SCHEMA = vol.Schema(
 )
 
 
-def setup(hass: HomeAssistant, config: ConfigType):
+async def async_setup(hass: HomeAssistant, config: ConfigType):
     htd_config = config.get(DOMAIN)
 
     configs = []
@@ -66,11 +158,17 @@ def setup(hass: HomeAssistant, config: ConfigType):
         htd_item_config = htd_config[i]
         host = htd_item_config.get(CONF_HOST)
         port = htd_item_config.get(CONF_PORT)
+        serial_port = htd_item_config.get(CONF_SERIAL_PORT)
+        baudrate = htd_item_config.get(CONF_BAUDRATE)
         zones = htd_item_config.get(CONF_ZONES)
         sources = htd_item_config.get(CONF_SOURCES)
+        zone_count = htd_item_config.get(CONF_ZONE_COUNT)
         retry_attempts = htd_item_config.get(CONF_RETRY_ATTEMPTS)
         command_delay = htd_item_config.get(CONF_COMMAND_DELAY)
         socket_timeout = htd_item_config.get(CONF_SOCKET_TIMEOUT)
+        idle_timeout = htd_item_config.get(CONF_IDLE_TIMEOUT)
+        cache_ttl = htd_item_config.get(CONF_CACHE_TTL)
+        optimistic = htd_item_config.get(CONF_OPTIMISTIC)
         update_volume_on_change = htd_item_config.get(
             CONF_UPDATE_VOLUME_ON_CHANGE
         )
@@ -81,34 +179,126 @@ def setup(hass: HomeAssistant, config: ConfigType):
         if sources is None:
             sources = []
 
-        # the device has 6 zones, so we default to Zone X
-        for i in range(len(zones), 6):
+        # the device has 6 zones, so we default to Zone X. the ones past
+        # zone_count are dropped once the gateway is set up.
+        for i in range(len(zones), HtdConstants.MAX_HTD_ZONES):
             zones.append("Zone " + str(i + 1))
 
         # the device has 6 sources, so we default to Source X
-        for i in range(len(sources), 6):
+        for i in range(len(sources), HtdConstants.MAX_HTD_ZONES):
             sources.append("Source " + str(i + 1))
 
-        client = HtdMcClient(
-            host,
+        # either the IP gateway, or the device's own serial port
+        if serial_port is not None:
+            transport = SerialTransport(serial_port, baudrate)
+        else:
+            transport = TcpTransport(host, port)
+
+        client = AsyncHtdMcClient(
+            host or serial_port,
             port=port,
             command_delay=command_delay,
             retry_attempts=retry_attempts,
             socket_timeout=socket_timeout,
+            idle_timeout=idle_timeout,
+            cache_ttl=cache_ttl,
+            transport=transport,
+        )
+
+        coordinator = HtdCoordinator(
+            hass, client, len(configs), list(range(1, len(zones) + 1))
         )
 
+        # keep a connection open to hear about changes as they happen
+        client.start_listening()
+
         configs.append(
             {
                 "zones": zones,
                 "sources": sources,
+                "zone_count": zone_count,
                 "client": client,
+                "coordinator": coordinator,
                 "update_volume_on_change": update_volume_on_change,
+                "optimistic": optimistic,
+                "entities": [],
+                "group_volume_controllers": {},
             }
         )
 
     hass.data[DOMAIN] = configs
 
-    for component in ("media_player",):
-        discovery.load_platform(hass, component, DOMAIN, {}, config)
+    # the clients keep their connections open, so close them on the way out
+    async def async_close_clients(event: Event):
+        for htd_item in configs:
+            await htd_item["client"].close()
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_close_clients)
+
+    # get every zone picked to the same state. each gateway gets all of its
+    # zones in a single scene, and the gateways go at the same time.
+    async def async_apply_scene(call: ServiceCall):
+        entity_ids = call.data[ATTR_ENTITY_ID]
+        scenes = []
+
+        for htd_item in configs:
+            zones = [
+                entity.zone
+                for entity in htd_item["entities"]
+                if entity.entity_id in entity_ids
+            ]
+
+            if not zones:
+                continue
+
+            source = call.data.get(ATTR_SOURCE)
+
+            if source is not None:
+                if source not in htd_item["sources"]:
+                    raise HomeAssistantError("unknown source %s" % source)
+
+                source = htd_item["sources"].index(source) + 1
+
+            volume = call.data.get(ATTR_VOLUME)
+
+            if volume is not None:
+                volume = round(volume * 100)
+
+            scene = {
+                zone: ZoneDetail(
+                    zone,
+                    power=call.data.get(ATTR_POWER),
+                    mute=call.data.get(ATTR_MUTE),
+                    source=source,
+                    volume=volume,
+                    bass=call.data.get(ATTR_BASS),
+                    treble=call.data.get(ATTR_TREBLE),
+                    balance=call.data.get(ATTR_BALANCE),
+                )
+                for zone in zones
+            }
+            scenes.append(htd_item["client"].apply_scene(scene))
+
+        await asyncio.gather(*scenes)
+
+    hass.services.async_register(
+        DOMAIN, SERVICE_APPLY_SCENE, async_apply_scene, APPLY_SCENE_SCHEMA
+    )
+
+    # everything the clients have measured, for troubleshooting
+    async def async_get_diagnostics(call: ServiceCall) -> ServiceResponse:
+        return get_diagnostics(configs)
+
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_GET_DIAGNOSTICS,
+        async_get_diagnostics,
+        supports_response=SupportsResponse.ONLY,
+    )
+
+    for component in ("media_player", "sensor"):
+        hass.async_create_task(
+            discovery.async_load_platform(hass, component, DOMAIN, {}, config)
+        )
 
     return True
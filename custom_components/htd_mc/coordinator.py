@@ -0,0 +1,107 @@
+"""Coordinator for HTD MC Series"""
+
+import logging
+from datetime import timedelta
+
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.update_coordinator import (
+    DataUpdateCoordinator,
+    UpdateFailed,
+)
+
+from .htd_mc_client.async_client import AsyncHtdMcClient
+from .htd_mc_client.models import ZoneDetail
+from .htd_mc_client.polling import PollPlanner
+from .htd_mc_client.scheduler import PRIORITY_BACKGROUND
+
+# the gateway pushes zone changes to us as they happen, polling is only a
+# safety net for anything we might have missed. every scan the PollPlanner
+# picks the few zones that are due, so this is how often we check, not how
+# often every zone is asked about.
+SCAN_INTERVAL = timedelta(seconds=30)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# one coordinator per gateway. the first refresh queries all the zones in a
+# single pass, after that each scan only queries the zones the PollPlanner
+# says are due, so zones that are off are barely polled at all while the
+# ones playing stay fresh. each zone's state is handed to its entity,
+# instead of every entity polling the gateway on its own. in between scans,
+# every zone the gateway sends us, whether it's a reply to one of our
+# commands or a change made on a keypad, is handed to the entities right
+# away.
+class HtdCoordinator(DataUpdateCoordinator[dict[int, ZoneDetail]]):
+    client: AsyncHtdMcClient = None
+    zones: [int] = None
+    planner: PollPlanner = None
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        client: AsyncHtdMcClient,
+        device_instance_id: int,
+        zones: [int],
+    ):
+        super().__init__(
+            hass,
+            _LOGGER,
+            name="htd_mc_%d" % device_instance_id,
+            update_interval=SCAN_INTERVAL,
+        )
+        self.client = client
+        self.zones = zones
+        self.planner = PollPlanner(client.cache)
+
+        client.subscribe(self._handle_zone_update)
+
+    # a zone sent before the first refresh has worked, like when the gateway
+    # was offline at startup and has come back, is still a zone we know
+    # about now
+    @callback
+    def _handle_zone_update(self, zone_info: ZoneDetail):
+        if zone_info.number not in self.zones:
+            return
+
+        data = dict(self.data or {})
+        data[zone_info.number] = zone_info
+
+        if not self.last_update_success:
+            self.async_set_updated_data(data)
+            return
+
+        # async_set_updated_data would put off the next scan, so a keypad
+        # pushing more often than the scan interval would keep the other
+        # zones from ever being polled. once we're up, the zone is updated
+        # in place and only the entities are told.
+        self.data = data
+        self.async_update_listeners()
+
+    async def _async_update_data(self) -> dict[int, ZoneDetail]:
+        data = dict(self.data or {})
+
+        # zones we've never asked about all go in one pass, like at startup
+        zones = [zone for zone in self.zones if zone not in data]
+
+        if not zones:
+            zones = self.planner.get_due_zones(self.zones, data)
+
+            if not zones:
+                return self.data
+
+        try:
+            zone_infos = await self.client.query_all_zones(
+                zones, PRIORITY_BACKGROUND
+            )
+        except OSError as e:
+            raise UpdateFailed(
+                "unable to reach %s, %s" % (self.client.transport, e)
+            ) from e
+
+        if all(zone_info is None for zone_info in zone_infos.values()):
+            raise UpdateFailed(
+                "no valid response from %s" % self.client.transport
+            )
+
+        data.update(zone_infos)
+        return data
@@ -0,0 +1,25 @@
+"""Diagnostics for HTD MC Series"""
+
+
+# every gateway's transport, what it's sized for, everything its client
+# has measured, round trip histograms included, and the zones as the
+# coordinator last saw them. the integration is set up from yaml, so there
+# are no config entries to hang home assistant's diagnostics off, this is
+# handed out by the get_diagnostics service instead.
+def get_diagnostics(configs: list[dict]) -> dict:
+    return {
+        "gateways": [
+            {
+                "transport": str(htd_item["client"].transport),
+                "capabilities": str(htd_item["client"].capabilities),
+                "metrics": htd_item["client"].get_metrics(),
+                "zones": {
+                    str(zone): str(zone_info)
+                    for zone, zone_info in (
+                        htd_item["coordinator"].data or {}
+                    ).items()
+                },
+            }
+            for htd_item in configs
+        ]
+    }
@@ -0,0 +1,700 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from .base_client import BaseHtdMcClient
+from .cache import MUTE_FIELDS, POWER_FIELDS, VOLUME_FIELDS
+from .connection import AsyncHtdConnection
+from .constants import HtdConstants
+from .decoder import FrameDecoder
+from .groups import infer_zones
+from .models import ZoneDetail
+from .scheduler import PRIORITY_USER, CommandScheduler, ScheduledCommand
+from .transport import Transport
+from .utils import parse_zone
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# the same client as HtdMcClient, but everything is awaitable, so commands
+# don't tie up a thread while we wait on the device.
+#
+# the connection's reader task hands us every byte the gateway sends. the
+# FrameDecoder cuts the stream into 14 byte chunks, however the bytes were
+# split up on the way, and every valid zone chunk is given to whoever is
+# waiting on a reply for that zone, and to every subscriber. the gateway
+# also sends zone chunks on its own, for example when someone uses a keypad,
+# so subscribers hear about changes as soon as they happen. the answers to
+# commands sent without waiting, like the steps of a volume ramp, only
+# update the cache, the command that finishes the ramp tells subscribers
+# where the zone ended up.
+#
+# commands don't go to the connection directly, they're queued up with the
+# CommandScheduler, whose single writer sends them one at a time.
+#
+# every zone that comes in also goes in the ZoneCache, so with the pushed
+# updates keeping it current, get_zone rarely needs to ask the device.
+class AsyncHtdMcClient(BaseHtdMcClient):
+    connection: AsyncHtdConnection = None
+
+    def __init__(
+        self,
+        ip_address: str,
+        port: int = HtdConstants.DEFAULT_HTD_MC_PORT,
+        command_delay: int = HtdConstants.DEFAULT_COMMAND_DELAY,
+        retry_attempts: int = HtdConstants.DEFAULT_RETRY_ATTEMPTS,
+        socket_timeout: int = HtdConstants.DEFAULT_SOCKET_TIMEOUT,
+        idle_timeout: int = HtdConstants.DEFAULT_IDLE_TIMEOUT,
+        cache_ttl: float = HtdConstants.DEFAULT_CACHE_TTL,
+        transport: Transport = None,
+    ):
+        super().__init__(
+            ip_address,
+            port=port,
+            command_delay=command_delay,
+            retry_attempts=retry_attempts,
+            socket_timeout=socket_timeout,
+            cache_ttl=cache_ttl,
+            transport=transport,
+        )
+        self.connection = AsyncHtdConnection(
+            ip_address,
+            port=port,
+            socket_timeout=socket_timeout,
+            idle_timeout=idle_timeout,
+            transport=self.transport,
+            data_received=self._data_received,
+            connection_lost=self._connection_lost,
+        )
+
+        self._decoder = FrameDecoder()
+        self._waiters: dict[int, list[asyncio.Future]] = {}
+        self._raw_waiter: asyncio.Future | None = None
+        # when each command sent without waiting went, per zone, until its
+        # answer shows up
+        self._unanswered: dict[int, deque[float]] = {}
+        self._subscribers = []
+        self._scheduler = CommandScheduler(self._execute)
+        self._listen_task: asyncio.Task | None = None
+
+    # register a callback to be given every ZoneDetail the gateway sends,
+    # returns a function to unsubscribe again.
+    def subscribe(self, callback) -> callable:
+        self._subscribers.append(callback)
+
+        def unsubscribe():
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+        return unsubscribe
+
+    # keep the connection open in the background, reconnecting whenever it
+    # drops, so pushed updates keep coming even when we're not sending
+    # anything. this needs to be called from the running loop.
+    def start_listening(self):
+        if self._listen_task is not None:
+            return
+
+        self.connection.keep_alive = True
+        self._listen_task = asyncio.get_running_loop().create_task(
+            self._listen()
+        )
+
+    async def close(self):
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+            self._listen_task = None
+
+        self.connection.keep_alive = False
+        await self._scheduler.close()
+        await self.connection.close()
+
+    # how many commands are waiting to be sent
+    @property
+    def queue_depth(self) -> int:
+        return self._scheduler.depth
+
+    def get_metrics(self) -> dict:
+        return {**super().get_metrics(), "queue_depth": self.queue_depth}
+
+    # the zone's state from the cache when we know it, otherwise from the
+    # device
+    async def get_zone(
+        self, zone: int, fields: [str] = None
+    ) -> ZoneDetail | None:
+        zone_info = self.get_cached_zone(zone, fields)
+
+        if zone_info is None:
+            zone_info = await self.query_zone(zone)
+
+        return zone_info
+
+    # mute or unmute the zone. the device can only toggle mute, so we look
+    # at where the zone is first, from the cache when we've heard about it
+    # recently, and send nothing when it's already there. the toggle's reply
+    # tells us where it really ended up, and if the zone had changed under
+    # us since, one more toggle puts it right. a zone we can't get the state
+    # of is left alone rather than toggled blind.
+    async def set_mute(self, zone: int, mute: bool) -> ZoneDetail | None:
+        zone_info = await self.get_zone(zone, MUTE_FIELDS)
+
+        if zone_info is None or zone_info.mute is mute:
+            return zone_info
+
+        zone_info = await self.toggle_mute(zone)
+
+        if zone_info is not None and zone_info.mute is not mute:
+            zone_info = await self.toggle_mute(zone)
+
+        return zone_info
+
+    # turn the zone on or off, unless we already know it is
+    async def set_power(
+        self, zone: int, power: bool
+    ) -> ZoneDetail | None:
+        zone_info = self.get_cached_zone(zone, POWER_FIELDS)
+
+        if zone_info is not None and zone_info.power is power:
+            return zone_info
+
+        if power:
+            return await self.power_on(zone)
+
+        return await self.power_off(zone)
+
+    # step the volume to where we want it. the device only knows volume up
+    # and down, one step at a time, so we queue each step once the writer
+    # has sent the one before, without waiting on an answer for it, then
+    # query the zone once at the end to see where it really ended up. the
+    # writer paces the steps, so we don't. on_increment is called after
+    # every step with our best guess of the zone, and can return a new
+    # volume to head towards instead. if the writer falls behind, the
+    # waiting steps are merged, so turning around mid-ramp cancels out.
+    async def set_volume(
+        self, zone: int, volume: float, on_increment=None, zone_info=None
+    ) -> ZoneDetail | None:
+        self.validate_zone(zone)
+
+        if zone_info is None:
+            zone_info = await self.get_zone(zone, VOLUME_FIELDS)
+
+        # stepping from a volume the device can't have would send a step for
+        # every bit it's off by, so ask the zone where it really is first
+        if zone_info is not None and not self.is_valid_volume(zone_info):
+            zone_info = await self.query_zone(zone)
+
+        if zone_info is None:
+            return None
+
+        if not self.is_valid_volume(zone_info):
+            _LOGGER.warning(
+                "Unexpected volume, not changing it. zone = %d, volume = %d"
+                % (zone, zone_info.htd_volume)
+            )
+            return None
+
+        htd_volume = zone_info.htd_volume
+        stepped = False
+
+        # never more steps than it takes to go from one end to the other
+        for _ in range(HtdConstants.MAX_HTD_VOLUME):
+            step = self.get_volume_step(htd_volume, volume)
+
+            if step is None:
+                break
+
+            data_code, htd_volume = step
+            self.cache.invalidate(
+                zone, HtdConstants.SET_COMMAND_CODE, data_code
+            )
+
+            try:
+                await self._scheduler.submit(
+                    zone,
+                    HtdConstants.SET_COMMAND_CODE,
+                    data_code,
+                    PRIORITY_USER,
+                    wait_reply=False,
+                )
+            except Exception as e:
+                _LOGGER.warning(
+                    "Error changing volume. zone = %d, error = %s"
+                    % (zone, e)
+                )
+                break
+
+            stepped = True
+
+            if on_increment is not None:
+                override_volume = on_increment(
+                    volume, self.estimate_volume(zone_info, htd_volume)
+                )
+
+                if override_volume is not None:
+                    volume = override_volume
+
+        zone_info = await self.query_zone(zone)
+
+        if stepped:
+            self.check_volume_steps(zone_info, htd_volume)
+
+        return zone_info
+
+    # ask the device where the zone is at. anything we query because a user
+    # asked for something goes ahead of the polling, which passes
+    # PRIORITY_BACKGROUND.
+    async def query_zone(
+        self, zone: int, priority: int = PRIORITY_USER
+    ) -> ZoneDetail | None:
+        return await self.send_command(
+            zone, HtdConstants.QUERY_COMMAND_CODE, 0, priority=priority
+        )
+
+    # query every zone in one pass. the queries are queued together, so the
+    # writer sends them all in one go and we wait for each zone to answer.
+    # any zone that doesn't answer in time is queried on its own, which
+    # gets the usual retries.
+    async def query_all_zones(
+        self, zones: [int] = None, priority: int = PRIORITY_USER
+    ) -> dict[int, ZoneDetail]:
+        if zones is None:
+            zones = self.capabilities.zones
+
+        zones = list(zones)
+
+        for zone in zones:
+            self.validate_zone(zone)
+
+        results = await asyncio.gather(
+            *[
+                self._scheduler.submit(
+                    zone,
+                    HtdConstants.QUERY_COMMAND_CODE,
+                    0,
+                    priority,
+                )
+                for zone in zones
+            ],
+            return_exceptions=True,
+        )
+
+        zone_infos = {}
+
+        for zone, zone_info in zip(zones, results):
+            if isinstance(zone_info, Exception):
+                _LOGGER.warning(
+                    "Error querying all zones, querying zone %d on its own. "
+                    "error = %s" % (zone, zone_info)
+                )
+                zone_info = None
+
+            if zone_info is None:
+                zone_info = await self.query_zone(zone, priority)
+
+            zone_infos[zone] = zone_info
+
+        return zone_infos
+
+    # get a group of zones to the state wanted for each, in one go. we
+    # start from what the cache knows, asking the device only about the
+    # zones it doesn't, work out the fewest commands to get there and queue
+    # them all without waiting on an answer for each. the writer sends them
+    # back to back at the command delay, and a single pass over the zones at
+    # the end confirms where they all ended up. when confirm is given, only
+    # those zones are asked, and the rest are worked out from their answer,
+    # see infer_zones. subscribers hear about those like any other zone.
+    async def apply_scene(
+        self, scene: dict[int, ZoneDetail], confirm: [int] = None
+    ) -> dict[int, ZoneDetail]:
+        zones = sorted(scene)
+
+        for zone in zones:
+            self.validate_zone(zone)
+
+        current = {zone: self.get_cached_zone(zone) for zone in zones}
+        unknown = [zone for zone in zones if current[zone] is None]
+
+        if unknown:
+            current.update(await self.query_all_zones(unknown))
+
+        futures = []
+
+        for zone, command, data_code in self.plan_scene(scene, current):
+            self.cache.invalidate(zone, command, data_code)
+            futures.append(
+                self._scheduler.submit(
+                    zone, command, data_code, PRIORITY_USER, wait_reply=False
+                )
+            )
+
+        for result in await asyncio.gather(*futures, return_exceptions=True):
+            if isinstance(result, Exception):
+                _LOGGER.warning("Error applying scene. error = %s" % result)
+                # we can't tell which zones got their commands now
+                confirm = None
+                break
+
+        zone_infos = await self.query_all_zones(
+            self.get_confirm_zones(zones, confirm, current)
+        )
+        inferred = infer_zones(scene, zone_infos, current)
+
+        for zone_info in inferred.values():
+            self.cache.update(zone_info)
+            self._notify_subscribers(zone_info)
+
+        missing = [
+            zone
+            for zone in zones
+            if zone not in zone_infos and zone not in inferred
+        ]
+
+        if missing:
+            zone_infos.update(await self.query_all_zones(missing))
+
+        zone_infos.update(inferred)
+
+        return {zone: zone_infos[zone] for zone in zones}
+
+    # priority is the scheduler lane the command waits in, polling passes
+    # PRIORITY_BACKGROUND so it waits for anything a user asked for
+    async def send_command(
+        self, zone, command, data_code, attempt=0, priority=PRIORITY_USER
+    ) -> ZoneDetail | str | None:
+        # anything the device won't understand fails here, before it's queued
+        self.commands.get(zone, command, data_code)
+        self.cache.invalidate(zone, command, data_code)
+
+        try:
+            response = await self._scheduler.submit(
+                zone, command, data_code, priority
+            )
+        except OSError as e:
+            self.metrics.connection_errors += 1
+
+            # the connection has already been dropped, so the retry will
+            # reconnect. once we're out of retries, let the caller know.
+            if attempt >= self.retry_attempts:
+                raise
+
+            self.metrics.retries += 1
+            _LOGGER.warning(
+                "Connection error, will retry. zone = %d, retry = %d, "
+                "error = %s" % (zone, attempt, e)
+            )
+            return await self.send_command(
+                zone, command, data_code, attempt + 1, priority
+            )
+
+        if command is HtdConstants.MODEL_QUERY_COMMAND_CODE:
+            if response is None:
+                return None
+
+            return response.decode("utf-8", errors="replace")
+
+        if response is None:
+            self.metrics.bad_responses += 1
+
+        if response is None and attempt < self.retry_attempts:
+            self.metrics.retries += 1
+            _LOGGER.warning(
+                "Bad response, will retry. zone = %d, retry = %d" % (
+                    zone, attempt)
+            )
+            # back off longer each time, depending on how the device is doing
+            await asyncio.sleep(self.pacer.retry_delay(attempt))
+            return await self.send_command(
+                zone, command, data_code, attempt + 1, priority
+            )
+
+        if response is None:
+            _LOGGER.critical(
+                (
+                    "Still bad response after retrying! zone = %d! "
+                    "The device may be overloaded or unreachable."
+                )
+                % zone
+            )
+
+        return response
+
+    # called by the scheduler's writer with the next command to send, or a
+    # batch of queries to send together. the pacer's delay after each keeps
+    # us from flooding the device.
+    async def _execute(self, batch: [ScheduledCommand]):
+        scheduled = batch[0]
+        self.metrics.record_queue_depth(self._scheduler.depth + len(batch))
+
+        if scheduled.is_query:
+            await self._execute_queries(batch)
+        elif scheduled.is_volume_step:
+            await self._execute_volume_steps(scheduled)
+        elif not scheduled.wait_reply:
+            await self._write_unanswered(
+                scheduled.zone,
+                self.commands.get(
+                    scheduled.zone, scheduled.command, scheduled.data_code
+                ),
+            )
+            scheduled.set_result(None)
+        else:
+            scheduled.set_result(
+                await self._request(
+                    scheduled.zone,
+                    scheduled.command,
+                    self.commands.get(
+                        scheduled.zone, scheduled.command, scheduled.data_code
+                    ),
+                )
+            )
+
+        await self._pace()
+
+    # wait between commands, so we don't flood the device
+    async def _pace(self):
+        delay = self.pacer.delay
+        self.metrics.pacing_time += delay
+        await asyncio.sleep(delay)
+
+    async def _execute_queries(self, batch: [ScheduledCommand]):
+        cmd, _ = self.get_query_all_command(
+            [scheduled.zone for scheduled in batch]
+        )
+        futures = [self._add_waiter(scheduled.zone) for scheduled in batch]
+        start = time.monotonic()
+        error = None
+
+        try:
+            await self.connection.write(cmd)
+            self.metrics.commands += len(batch)
+            await asyncio.wait(
+                futures, timeout=self.pacer.timeout * len(batch)
+            )
+            rtt = (time.monotonic() - start) / len(batch)
+            self.metrics.record_round_trip(
+                HtdConstants.QUERY_COMMAND_CODE, rtt
+            )
+            self.pacer.record_response(
+                rtt,
+                all(future.done() for future in futures),
+            )
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            for scheduled, future in zip(batch, futures):
+                self._remove_waiter(scheduled.zone, future)
+
+                # a query that never went out gets the reason why. one that
+                # wasn't answered in time is a bad response, and whatever we
+                # thought was still on its way isn't coming
+                if error is not None:
+                    scheduled.set_exception(error)
+                elif not future.done():
+                    self.metrics.timeouts += 1
+                    self._unanswered.pop(scheduled.zone, None)
+                    scheduled.set_result(None)
+                elif future.exception() is not None:
+                    scheduled.set_exception(future.exception())
+                else:
+                    scheduled.set_result(future.result())
+
+    # send the net number of volume steps waiting for a zone. only the last
+    # one waits for an answer, and only if somebody asked for it.
+    async def _execute_volume_steps(self, scheduled: ScheduledCommand):
+        zone = scheduled.zone
+
+        if scheduled.steps == 0:
+            if scheduled.wait_reply:
+                scheduled.set_result(
+                    await self._request(
+                        zone,
+                        HtdConstants.QUERY_COMMAND_CODE,
+                        self.commands.get(
+                            zone, HtdConstants.QUERY_COMMAND_CODE, 0
+                        ),
+                    )
+                )
+            else:
+                scheduled.set_result(None)
+            return
+
+        if scheduled.steps > 0:
+            data_code = HtdConstants.VOLUME_UP_COMMAND
+        else:
+            data_code = HtdConstants.VOLUME_DOWN_COMMAND
+
+        cmd = self.commands.get(
+            zone, HtdConstants.SET_COMMAND_CODE, data_code
+        )
+        unanswered = abs(scheduled.steps)
+
+        if scheduled.wait_reply:
+            unanswered -= 1
+
+        # paced in between, execute paces after the last one
+        for index in range(unanswered):
+            if index > 0:
+                await self._pace()
+
+            await self._write_unanswered(zone, cmd)
+
+        if scheduled.wait_reply:
+            if unanswered > 0:
+                await self._pace()
+
+            scheduled.set_result(
+                await self._request(
+                    zone, HtdConstants.SET_COMMAND_CODE, cmd
+                )
+            )
+        else:
+            scheduled.set_result(None)
+
+    # send a command without waiting for the answer. its answer is still on
+    # its way, so it mustn't be taken as the answer to the next command.
+    async def _write_unanswered(self, zone: int, cmd: bytes):
+        await self.connection.write(cmd)
+        self.metrics.commands += 1
+        self._unanswered.setdefault(zone, deque()).append(time.monotonic())
+
+    # send one command and wait for the reader to hand us the answer. a
+    # reply that doesn't show up in time is treated like a bad response.
+    async def _request(
+        self, zone: int, command: int, cmd: bytes
+    ) -> ZoneDetail | bytes | None:
+        if command is HtdConstants.MODEL_QUERY_COMMAND_CODE:
+            future = self._raw_waiter = (
+                asyncio.get_running_loop().create_future()
+            )
+        else:
+            future = self._add_waiter(zone)
+
+        start = time.monotonic()
+
+        try:
+            await self.connection.write(cmd)
+            self.metrics.commands += 1
+            response = await asyncio.wait_for(future, self.pacer.timeout)
+        except asyncio.TimeoutError:
+            # whatever we thought was still on its way isn't coming
+            self.metrics.timeouts += 1
+            self._unanswered.pop(zone, None)
+            self.pacer.record_timeout()
+            return None
+        finally:
+            if future is self._raw_waiter:
+                self._raw_waiter = None
+            else:
+                self._remove_waiter(zone, future)
+
+        rtt = time.monotonic() - start
+        self.metrics.record_round_trip(command, rtt)
+        self.pacer.record_response(rtt, True)
+
+        return response
+
+    async def _listen(self):
+        while True:
+            await self.connection.wait_for_backoff()
+
+            try:
+                await self.connection.connect()
+            except OSError:
+                continue
+
+            await self.connection.wait_closed()
+
+    def _add_waiter(self, zone: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(zone, []).append(future)
+        return future
+
+    def _remove_waiter(self, zone: int, future: asyncio.Future):
+        waiters = self._waiters.get(zone)
+
+        if waiters is not None and future in waiters:
+            waiters.remove(future)
+
+    def _data_received(self, data: bytes):
+        rejected = self._decoder.rejected
+        data, offsets = self._decoder.feed_offsets(data)
+        self.metrics.bad_frames += self._decoder.rejected - rejected
+
+        for offset in offsets:
+            zone_info = parse_zone(data, offset)
+
+            if zone_info is None:
+                self.metrics.bad_frames += 1
+            else:
+                self._zone_received(zone_info)
+
+        # the model query is answered with a plain string, not zone chunks,
+        # so its answer is whatever the decoder passed over. zone chunks
+        # that turn up while we wait still go where they belong.
+        if self._raw_waiter is not None and not self._raw_waiter.done():
+            leftover = bytearray()
+            position = 0
+
+            for offset in offsets:
+                leftover += data[position:offset]
+                position = offset + HtdConstants.MESSAGE_CHUNK_SIZE
+
+            leftover += data[position:]
+
+            if leftover:
+                self._raw_waiter.set_result(bytes(leftover))
+
+    def _zone_received(self, zone_info: ZoneDetail):
+        self.cache.update(zone_info)
+
+        unanswered = self._unanswered.get(zone_info.number)
+
+        if unanswered:
+            # this answers a command sent without waiting, like a volume
+            # step, so it's older than anything a waiter is waiting for. it
+            # still tells the pacer how the device is keeping up.
+            self.pacer.record_response(
+                time.monotonic() - unanswered.popleft(), True
+            )
+            return
+
+        # the oldest command waiting on this zone gets the answer
+        for future in self._waiters.get(zone_info.number, []):
+            if not future.done():
+                future.set_result(zone_info)
+                break
+
+        self._notify_subscribers(zone_info)
+
+    def _notify_subscribers(self, zone_info: ZoneDetail):
+        for callback in list(self._subscribers):
+            try:
+                callback(zone_info)
+            except Exception:
+                _LOGGER.exception(
+                    "error notifying subscriber for zone %d" % zone_info.number
+                )
+
+    def _connection_lost(self, error: Exception | None):
+        self._decoder.reset()
+        self._unanswered.clear()
+
+        if error is None:
+            error = ConnectionResetError(
+                "connection to %s was closed" % self.transport
+            )
+
+        futures = [
+            future
+            for waiters in self._waiters.values()
+            for future in waiters
+        ]
+
+        if self._raw_waiter is not None:
+            futures.append(self._raw_waiter)
+
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
@@ -0,0 +1,485 @@
+import copy
+import logging
+
+from .cache import ZoneCache
+from .capabilities import DeviceCapabilities
+from .commands import CommandTable
+from .constants import HtdConstants
+from .groups import ZoneGroups
+from .metrics import ClientMetrics
+from .models import ZoneDetail
+from .pacing import AdaptivePacer
+from .transport import TcpTransport, Transport
+from .utils import (
+    convert_to_htd_volume,
+    validate_source,
+    validate_zone,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+ONE_SECOND = 1_000
+
+# the settings that can only be stepped up and down, with the data codes to
+# step them up and down and how far they go either way
+STEPPED_SETTINGS = (
+    (
+        "bass",
+        HtdConstants.BASE_UP_COMMAND,
+        HtdConstants.BASE_DOWN_COMMAND,
+        HtdConstants.MAX_HTD_TONE,
+    ),
+    (
+        "treble",
+        HtdConstants.TREBLE_UP_COMMAND,
+        HtdConstants.TREBLE_DOWN_COMMAND,
+        HtdConstants.MAX_HTD_TONE,
+    ),
+    (
+        "balance",
+        HtdConstants.BALANCE_RIGHT_COMMAND,
+        HtdConstants.BALANCE_LEFT_COMMAND,
+        HtdConstants.MAX_HTD_BALANCE,
+    ),
+)
+
+
+# the commands the device understands are the same whether we talk to it
+# with blocking sockets or asyncio, so they live here. each one hands off to
+# send_command, returning whatever that returns. for the sync client that's
+# the parsed ZoneDetail, for the async client it's something to await.
+# send_command looks the command up in the CommandTable, which also rejects
+# anything the device wouldn't understand, like a zone that doesn't exist.
+# we assume the full six zones and six sources, unless told otherwise with
+# set_capabilities.
+class BaseHtdMcClient:
+    ip_address: str = None
+    port: int = None
+    command_delay_sec: float = None
+    retry_attempts: int = None
+    socket_timeout: float = None
+    transport: Transport = None
+    pacer: AdaptivePacer = None
+    capabilities: DeviceCapabilities = None
+    commands: CommandTable = None
+    cache: ZoneCache = None
+    metrics: ClientMetrics = None
+    groups: ZoneGroups = None
+
+    def __init__(
+        self,
+        ip_address: str,
+        port: int = HtdConstants.DEFAULT_HTD_MC_PORT,
+        command_delay: int = HtdConstants.DEFAULT_COMMAND_DELAY,
+        retry_attempts: int = HtdConstants.DEFAULT_RETRY_ATTEMPTS,
+        socket_timeout: int = HtdConstants.DEFAULT_SOCKET_TIMEOUT,
+        cache_ttl: float = HtdConstants.DEFAULT_CACHE_TTL,
+        transport: Transport = None,
+    ):
+        self.ip_address = ip_address
+        self.port = port
+        self.command_delay_sec = command_delay / ONE_SECOND
+        self.retry_attempts = retry_attempts
+        self.socket_timeout = socket_timeout
+        self.transport = transport or TcpTransport(ip_address, port)
+        self.pacer = AdaptivePacer(
+            self.command_delay_sec,
+            socket_timeout,
+            min_delay=self.transport.min_command_delay / ONE_SECOND,
+        )
+        self.cache = ZoneCache(cache_ttl)
+        self.metrics = ClientMetrics()
+        self.groups = ZoneGroups()
+        self.set_capabilities(DeviceCapabilities())
+
+    # size everything by what the device can do. the command table is
+    # rebuilt for it, so a zone, source or command the device doesn't have
+    # is rejected before anything is sent.
+    def set_capabilities(
+        self, capabilities: DeviceCapabilities
+    ) -> DeviceCapabilities:
+        self.capabilities = capabilities
+        self.commands = CommandTable(capabilities)
+        self.cache.zone_count = capabilities.zone_count
+        return capabilities
+
+    def validate_zone(self, zone: int):
+        validate_zone(zone, self.capabilities.zone_count)
+
+    def validate_source(self, source: int):
+        validate_source(source, self.capabilities.source_count)
+
+    # everything the client has measured, along with where the pacing and
+    # the connection stand
+    def get_metrics(self) -> dict:
+        return {
+            **self.metrics.as_dict(),
+            "command_delay_ms": self.pacer.delay * ONE_SECOND,
+            "response_timeout_ms": self.pacer.timeout * ONE_SECOND,
+            "smoothed_rtt_ms": (
+                self.pacer.rtt * ONE_SECOND
+                if self.pacer.rtt is not None
+                else None
+            ),
+            "bad_response_rate": self.pacer.bad_response_rate,
+            "connected": self.connection.connected,
+            "connections_opened": self.connection.connects,
+            "connect_failures": self.connection.connect_failures,
+        }
+
+    # how many bytes the device sends back for a single command
+    @property
+    def response_size(self) -> int:
+        return (
+            HtdConstants.RESPONSE_CHUNK_COUNT * HtdConstants.MESSAGE_CHUNK_SIZE
+        )
+
+    def send_command(self, zone, command, data_code, attempt=0):
+        raise NotImplementedError()
+
+    def set_volume(self, zone: int, volume: float, on_increment=None,
+                   zone_info=None):
+        raise NotImplementedError()
+
+    def query_all_zones(self, zones: [int] = None):
+        raise NotImplementedError()
+
+    def apply_scene(
+        self, scene: dict[int, ZoneDetail], confirm: [int] = None
+    ):
+        raise NotImplementedError()
+
+    def query_zone(self, zone: int):
+        return self.send_command(zone, HtdConstants.QUERY_COMMAND_CODE, 0)
+
+    # the zone's state without asking the device, as long as we've heard
+    # about it recently and none of the fields asked for are being changed.
+    # returns None when the device needs to be asked.
+    def get_cached_zone(
+        self, zone: int, fields: [str] = None
+    ) -> ZoneDetail | None:
+        return self.cache.get(zone, fields)
+
+    def set_source(self, zone: int, source: int):
+        self.validate_source(source)
+
+        # I have no idea why this is offset by 2
+        return self.send_command(
+            zone,
+            HtdConstants.SET_COMMAND_CODE,
+            source + 2
+        )
+
+    def volume_up(self, zone: int):
+        return self.send_command(
+            zone, HtdConstants.SET_COMMAND_CODE, HtdConstants.VOLUME_UP_COMMAND
+        )
+
+    def volume_down(self, zone: int):
+        return self.send_command(
+            zone,
+            HtdConstants.SET_COMMAND_CODE,
+            HtdConstants.VOLUME_DOWN_COMMAND
+        )
+
+    def toggle_mute(self, zone):
+        return self.send_command(
+            zone,
+            HtdConstants.SET_COMMAND_CODE,
+            HtdConstants.TOGGLE_MUTE_COMMAND
+        )
+
+    def power_on(self, zone=None, all_zones=False):
+        if all_zones:
+            zone = 1  # zone is one when it's all zones
+            power_command = HtdConstants.POWER_ON_ALL_ZONES_COMMAND
+        else:
+            power_command = HtdConstants.POWER_ON_ZONE_COMMAND
+        return self.send_command(
+            zone,
+            HtdConstants.SET_COMMAND_CODE,
+            power_command
+        )
+
+    def power_off(self, zone=None, all_zones=False):
+        if all_zones:
+            zone = 1  # zone is one when it's all zones
+            power_command = HtdConstants.POWER_OFF_ALL_ZONES_COMMAND
+        else:
+            power_command = HtdConstants.POWER_OFF_ZONE_COMMAND
+        return self.send_command(
+            zone,
+            HtdConstants.SET_COMMAND_CODE,
+            power_command
+        )
+
+    def bass_up(self, zone):
+        return self.send_command(
+            zone, HtdConstants.SET_COMMAND_CODE, HtdConstants.BASE_UP_COMMAND
+        )
+
+    def bass_down(self, zone):
+        return self.send_command(
+            zone, HtdConstants.SET_COMMAND_CODE, HtdConstants.BASE_DOWN_COMMAND
+        )
+
+    def treble_up(self, zone):
+        return self.send_command(
+            zone, HtdConstants.SET_COMMAND_CODE, HtdConstants.TREBLE_UP_COMMAND
+        )
+
+    def treble_down(self, zone):
+        return self.send_command(
+            zone,
+            HtdConstants.SET_COMMAND_CODE,
+            HtdConstants.TREBLE_DOWN_COMMAND
+        )
+
+    def balance_right(self, zone):
+        return self.send_command(
+            zone,
+            HtdConstants.SET_COMMAND_CODE,
+            HtdConstants.BALANCE_RIGHT_COMMAND
+        )
+
+    def balance_left(self, zone):
+        return self.send_command(
+            zone,
+            HtdConstants.SET_COMMAND_CODE,
+            HtdConstants.BALANCE_LEFT_COMMAND
+        )
+
+    # bass, treble and balance can only be stepped, so setting them is a
+    # scene that plans the steps from where they are now. zone can also be a
+    # list of zones, to set them all in the same burst.
+    def set_bass(self, zone: int | list[int], bass: int):
+        return self.apply_scene(self._get_setting_scene(zone, bass=bass))
+
+    def set_treble(self, zone: int | list[int], treble: int):
+        return self.apply_scene(self._get_setting_scene(zone, treble=treble))
+
+    def set_balance(self, zone: int | list[int], balance: int):
+        return self.apply_scene(
+            self._get_setting_scene(zone, balance=balance)
+        )
+
+    @staticmethod
+    def _get_setting_scene(
+        zone: int | list[int], **settings
+    ) -> dict[int, ZoneDetail]:
+        zones = zone if isinstance(zone, list) else [zone]
+        return {zone: ZoneDetail(zone, **settings) for zone in zones}
+
+    # every zone linked to zone, joined or in party mode, itself included
+    def get_group(self, zone: int) -> [int]:
+        return self.groups.get_members(zone, self.cache.known)
+
+    # make the same change to every zone linked to zone, as one scene. the
+    # change goes to every member alike, so only the first one is asked
+    # where it ended up, and the rest are worked out from its answer.
+    def apply_group(self, zone: int, **settings):
+        members = self.get_group(zone)
+        scene = {member: ZoneDetail(member, **settings) for member in members}
+        return self.apply_scene(scene, confirm=members[:1])
+
+    # the zones to ask about once a scene is done. any zone we didn't know
+    # the state of beforehand can't be worked out, so it's always asked.
+    @staticmethod
+    def get_confirm_zones(
+        zones: [int],
+        confirm: [int],
+        current: dict[int, ZoneDetail | None],
+    ) -> [int]:
+        if confirm is None:
+            return zones
+
+        return [
+            zone
+            for zone in zones
+            if zone in confirm or current.get(zone) is None
+        ]
+
+    def get_model_info(self):
+        return self.send_command(1, HtdConstants.MODEL_QUERY_COMMAND_CODE, 0)
+
+    # every zone's query command back to back, so they can be sent in one
+    # go, along with how many bytes we expect to get back for them.
+    def get_query_all_command(self, zones: [int]) -> (bytes, int):
+        cmd = self.commands.get_batch(
+            [(zone, HtdConstants.QUERY_COMMAND_CODE, 0) for zone in zones]
+        )
+
+        return cmd, len(zones) * self.response_size
+
+    # the fewest commands that get every zone in the scene from its current
+    # state to the one wanted. anything left as None in the wanted ZoneDetail
+    # is left alone. when every zone on the device is being turned on, or
+    # off, a single all zones command does it. mute, volume, bass, treble and
+    # balance can only be changed relative to where they are, so they're
+    # skipped for a zone we don't know the state of.
+    def plan_scene(
+        self,
+        scene: dict[int, ZoneDetail],
+        current: dict[int, ZoneDetail | None],
+    ) -> [tuple[int, int, int]]:
+        commands = []
+        all_zones = self.capabilities.zones
+
+        for power, all_command, zone_command in (
+            (
+                True,
+                HtdConstants.POWER_ON_ALL_ZONES_COMMAND,
+                HtdConstants.POWER_ON_ZONE_COMMAND,
+            ),
+            (
+                False,
+                HtdConstants.POWER_OFF_ALL_ZONES_COMMAND,
+                HtdConstants.POWER_OFF_ZONE_COMMAND,
+            ),
+        ):
+            changing = [
+                zone
+                for zone, wanted in scene.items()
+                if wanted.power is power
+                and (current.get(zone) is None
+                     or current[zone].power is not power)
+            ]
+            everywhere = all(
+                zone in scene and scene[zone].power is power
+                for zone in all_zones
+            )
+
+            if (
+                everywhere
+                and len(changing) > 1
+                and self.capabilities.supports(all_command)
+            ):
+                # zone is one when it's all zones
+                commands.append(
+                    (1, HtdConstants.SET_COMMAND_CODE, all_command)
+                )
+            else:
+                commands.extend(
+                    (zone, HtdConstants.SET_COMMAND_CODE, zone_command)
+                    for zone in changing
+                )
+
+        for zone in sorted(scene):
+            wanted = scene[zone]
+            zone_info = current.get(zone)
+
+            if wanted.source is not None and (
+                zone_info is None or zone_info.source != wanted.source
+            ):
+                self.validate_source(wanted.source)
+
+                # I have no idea why this is offset by 2
+                commands.append(
+                    (zone, HtdConstants.SET_COMMAND_CODE, wanted.source + 2)
+                )
+
+            if zone_info is None:
+                continue
+
+            if wanted.mute is not None and zone_info.mute != wanted.mute:
+                commands.append(
+                    (
+                        zone,
+                        HtdConstants.SET_COMMAND_CODE,
+                        HtdConstants.TOGGLE_MUTE_COMMAND,
+                    )
+                )
+
+            for field, up_code, down_code, limit in STEPPED_SETTINGS:
+                commands.extend(
+                    (zone, HtdConstants.SET_COMMAND_CODE, data_code)
+                    for data_code in self.get_setting_steps(
+                        getattr(zone_info, field),
+                        getattr(wanted, field),
+                        up_code,
+                        down_code,
+                        limit,
+                    )
+                )
+
+            if wanted.volume is not None and self.is_valid_volume(zone_info):
+                htd_volume = zone_info.htd_volume
+
+                for _ in range(HtdConstants.MAX_HTD_VOLUME):
+                    step = self.get_volume_step(htd_volume, wanted.volume)
+
+                    if step is None:
+                        break
+
+                    data_code, htd_volume = step
+                    commands.append(
+                        (zone, HtdConstants.SET_COMMAND_CODE, data_code)
+                    )
+
+        return commands
+
+    # the volume steps don't wait for an answer, so a step the device
+    # dropped only shows when the zone didn't end up where the steps should
+    # have taken it. that counts against the pacing like an answer that
+    # never came.
+    def check_volume_steps(
+        self, zone_info: ZoneDetail | None, htd_volume: int
+    ):
+        if zone_info is not None and zone_info.htd_volume != htd_volume:
+            _LOGGER.debug(
+                "zone %d ended up at %d instead of %d, steps were dropped"
+                % (zone_info.number, zone_info.htd_volume, htd_volume)
+            )
+            self.metrics.bad_responses += 1
+            self.pacer.record_timeout()
+
+    # whether the zone's volume is one the device can actually be at
+    @staticmethod
+    def is_valid_volume(zone_info: ZoneDetail) -> bool:
+        return 0 <= zone_info.htd_volume <= HtdConstants.MAX_HTD_VOLUME
+
+    # work out the next volume step to get from htd_volume to the desired
+    # volume. returns the step's data code and where the volume will be
+    # after it, or None when we're already there.
+    @staticmethod
+    def get_volume_step(
+        htd_volume: int, volume: float
+    ) -> tuple[int, int] | None:
+        steps = convert_to_htd_volume(volume) - htd_volume
+
+        if steps == 0:
+            return None
+
+        if steps > 0:
+            return HtdConstants.VOLUME_UP_COMMAND, htd_volume + 1
+
+        return HtdConstants.VOLUME_DOWN_COMMAND, htd_volume - 1
+
+    # the data codes to step a setting from current to wanted, kept within
+    # -limit to limit. nothing if we don't want it changed.
+    @staticmethod
+    def get_setting_steps(
+        current: int,
+        wanted: int | None,
+        up_code: int,
+        down_code: int,
+        limit: int,
+    ) -> [int]:
+        if wanted is None:
+            return []
+
+        steps = max(-limit, min(limit, wanted)) - current
+
+        if steps > 0:
+            return [up_code] * steps
+
+        return [down_code] * -steps
+
+    # the volume steps don't wait for the device to answer, so while the
+    # volume is changing, this is our best guess of where the zone is at.
+    @staticmethod
+    def estimate_volume(zone_info: ZoneDetail, htd_volume: int) -> ZoneDetail:
+        estimate = copy.copy(zone_info)
+        estimate.htd_volume = htd_volume
+        estimate.volume = round(htd_volume / HtdConstants.MAX_HTD_VOLUME * 100)
+        return estimate
@@ -0,0 +1,338 @@
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import sys
+import time
+
+from .async_client import AsyncHtdMcClient
+from .client import HtdMcClient
+from .constants import HtdConstants
+from .simulator import HtdSimulator
+
+ONE_SECOND = 1_000
+
+ZONES = list(range(1, HtdConstants.MAX_HTD_ZONES + 1))
+
+# the zone the single zone operations run against
+BENCHMARK_ZONE = 1
+
+OPERATIONS = ("query_zone", "query_all_zones", "volume_ramp")
+
+
+# the value below which the given percent of the values fall, worked out
+# between the two nearest values
+def percentile(values: [float], percent: float) -> float | None:
+    if not values:
+        return None
+
+    values = sorted(values)
+    position = (len(values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+
+    return values[lower] + (values[upper] - values[lower]) * (
+        position - lower
+    )
+
+
+# everything we measured for one operation, ready to be saved as json. the
+# latencies are in milliseconds.
+def summarize(
+    client: str,
+    operation: str,
+    settings: dict,
+    latencies: [float],
+    failures: int,
+    elapsed: float,
+    commands: int,
+    connections: int,
+    retries: int,
+) -> dict:
+    latencies = [latency * ONE_SECOND for latency in latencies]
+
+    return {
+        "client": client,
+        "operation": operation,
+        **settings,
+        "iterations": len(latencies) + failures,
+        "failures": failures,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "mean_ms": sum(latencies) / len(latencies) if latencies else None,
+        "commands_per_second": commands / elapsed if elapsed else None,
+        "connections_opened": connections,
+        "retries": retries,
+    }
+
+
+# put every zone back where it started, so every iteration of a volume ramp
+# has the same distance to go. the client's cache has to forget it too.
+def reset(simulator: HtdSimulator, client):
+    for zone_info in simulator.zones.values():
+        zone_info.htd_volume = 0
+
+    client.cache.clear()
+
+
+def run_sync(
+    simulator: HtdSimulator,
+    operation: str,
+    iterations: int,
+    client_settings: dict,
+) -> dict:
+    client = HtdMcClient(
+        "127.0.0.1", port=simulator.port, **client_settings
+    )
+    connections = simulator.connections_opened
+    commands = simulator.commands_received
+    latencies = []
+    failures = 0
+    elapsed = 0.0
+
+    try:
+        for _ in range(iterations):
+            if operation == "volume_ramp":
+                reset(simulator, client)
+
+            start = time.perf_counter()
+
+            try:
+                if operation == "query_zone":
+                    result = client.query_zone(BENCHMARK_ZONE)
+                elif operation == "query_all_zones":
+                    result = client.query_all_zones(ZONES)
+                else:
+                    result = client.set_volume(BENCHMARK_ZONE, 100)
+            except OSError:
+                result = None
+
+            took = time.perf_counter() - start
+            elapsed += took
+
+            if result is None:
+                failures += 1
+            else:
+                latencies.append(took)
+    finally:
+        client.close()
+
+    return summarize(
+        "sync",
+        operation,
+        client_settings,
+        latencies,
+        failures,
+        elapsed,
+        simulator.commands_received - commands,
+        simulator.connections_opened - connections,
+        client.metrics.retries,
+    )
+
+
+async def run_async(
+    simulator: HtdSimulator,
+    operation: str,
+    iterations: int,
+    client_settings: dict,
+) -> dict:
+    client = AsyncHtdMcClient(
+        "127.0.0.1", port=simulator.port, **client_settings
+    )
+    connections = simulator.connections_opened
+    commands = simulator.commands_received
+    latencies = []
+    failures = 0
+    elapsed = 0.0
+
+    try:
+        for _ in range(iterations):
+            if operation == "volume_ramp":
+                reset(simulator, client)
+
+            start = time.perf_counter()
+
+            try:
+                if operation == "query_zone":
+                    result = await client.query_zone(BENCHMARK_ZONE)
+                elif operation == "query_all_zones":
+                    result = await client.query_all_zones(ZONES)
+                else:
+                    result = await client.set_volume(BENCHMARK_ZONE, 100)
+            except OSError:
+                result = None
+
+            took = time.perf_counter() - start
+            elapsed += took
+
+            if result is None:
+                failures += 1
+            else:
+                latencies.append(took)
+    finally:
+        await client.close()
+
+    return summarize(
+        "async",
+        operation,
+        client_settings,
+        latencies,
+        failures,
+        elapsed,
+        simulator.commands_received - commands,
+        simulator.connections_opened - connections,
+        client.metrics.retries,
+    )
+
+
+# run every operation with both clients, for every command_delay and
+# retry_attempts asked for, against a simulator with the given faults. the
+# simulator is seeded, so the same arguments inject the same faults.
+def run(
+    iterations: int,
+    command_delays: [int],
+    retry_attempts: [int],
+    simulator_settings: dict,
+    operations: [str] = OPERATIONS,
+) -> dict:
+    results = []
+
+    for command_delay in command_delays:
+        for retry_attempt in retry_attempts:
+            client_settings = {
+                "command_delay": command_delay,
+                "retry_attempts": retry_attempt,
+            }
+
+            for operation in operations:
+                simulator = HtdSimulator(**simulator_settings)
+                simulator.start_in_thread()
+
+                try:
+                    results.append(
+                        run_sync(
+                            simulator, operation, iterations, client_settings
+                        )
+                    )
+                    results.append(
+                        asyncio.run(
+                            run_async(
+                                simulator,
+                                operation,
+                                iterations,
+                                client_settings,
+                            )
+                        )
+                    )
+                finally:
+                    simulator.stop_thread()
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "iterations": iterations,
+        "simulator": simulator_settings,
+        "results": results,
+    }
+
+
+def print_results(report: dict):
+    print(
+        "%-6s %-16s %6s %5s %9s %9s %9s %8s %5s %7s"
+        % (
+            "client",
+            "operation",
+            "delay",
+            "retry",
+            "p50 ms",
+            "p95 ms",
+            "p99 ms",
+            "cmd/s",
+            "conns",
+            "retries",
+        )
+    )
+
+    for result in report["results"]:
+        print(
+            "%-6s %-16s %6d %5d %9s %9s %9s %8s %5d %7d"
+            % (
+                result["client"],
+                result["operation"],
+                result["command_delay"],
+                result["retry_attempts"],
+                format_number(result["p50_ms"]),
+                format_number(result["p95_ms"]),
+                format_number(result["p99_ms"]),
+                format_number(result["commands_per_second"]),
+                result["connections_opened"],
+                result["retries"],
+            )
+        )
+
+
+def format_number(value: float | None) -> str:
+    return "-" if value is None else "%.1f" % value
+
+
+# python -m htd_mc_client.benchmark, from custom_components/htd_mc
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark the htd_mc clients against the simulator"
+    )
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument(
+        "--command-delay",
+        type=int,
+        action="append",
+        help="in milliseconds, can be given more than once",
+    )
+    parser.add_argument(
+        "--retry-attempts",
+        type=int,
+        action="append",
+        help="can be given more than once",
+    )
+    parser.add_argument(
+        "--operation", choices=OPERATIONS, action="append"
+    )
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--jitter", type=float, default=0.005)
+    parser.add_argument("--fragment-size", type=int, default=None)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--garble-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", help="where to save the results as json"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    report = run(
+        args.iterations,
+        args.command_delay or [HtdConstants.DEFAULT_COMMAND_DELAY],
+        args.retry_attempts or [HtdConstants.DEFAULT_RETRY_ATTEMPTS],
+        {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "fragment_size": args.fragment_size,
+            "drop_rate": args.drop_rate,
+            "garble_rate": args.garble_rate,
+            "seed": args.seed,
+        },
+        args.operation or OPERATIONS,
+    )
+
+    print_results(report)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
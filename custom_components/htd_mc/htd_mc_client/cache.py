@@ -0,0 +1,128 @@
+import time
+
+from .constants import HtdConstants
+from .models import ZoneDetail
+
+POWER_FIELDS = ("power",)
+MUTE_FIELDS = ("mute",)
+VOLUME_FIELDS = ("volume", "htd_volume")
+SOURCE_FIELDS = ("source",)
+BASS_FIELDS = ("bass",)
+TREBLE_FIELDS = ("treble",)
+BALANCE_FIELDS = ("balance",)
+
+# the fields of a zone each set command changes
+AFFECTED_FIELDS = {
+    HtdConstants.POWER_OFF_ZONE_COMMAND: POWER_FIELDS,
+    HtdConstants.POWER_ON_ZONE_COMMAND: POWER_FIELDS,
+    HtdConstants.POWER_ON_ALL_ZONES_COMMAND: POWER_FIELDS,
+    HtdConstants.POWER_OFF_ALL_ZONES_COMMAND: POWER_FIELDS,
+    HtdConstants.TOGGLE_MUTE_COMMAND: MUTE_FIELDS,
+    HtdConstants.VOLUME_UP_COMMAND: VOLUME_FIELDS,
+    HtdConstants.VOLUME_DOWN_COMMAND: VOLUME_FIELDS,
+    HtdConstants.BASE_UP_COMMAND: BASS_FIELDS,
+    HtdConstants.BASE_DOWN_COMMAND: BASS_FIELDS,
+    HtdConstants.TREBLE_UP_COMMAND: TREBLE_FIELDS,
+    HtdConstants.TREBLE_DOWN_COMMAND: TREBLE_FIELDS,
+    HtdConstants.BALANCE_RIGHT_COMMAND: BALANCE_FIELDS,
+    HtdConstants.BALANCE_LEFT_COMMAND: BALANCE_FIELDS,
+    **{
+        source + 2: SOURCE_FIELDS
+        for source in range(1, HtdConstants.MAX_HTD_ZONES + 1)
+    },
+}
+
+# these change every zone, not just the one they're sent to
+ALL_ZONES_DATA_CODES = (
+    HtdConstants.POWER_ON_ALL_ZONES_COMMAND,
+    HtdConstants.POWER_OFF_ALL_ZONES_COMMAND,
+)
+
+
+# the last state we've seen for every zone, so we don't have to ask the
+# device again for something it just told us. every zone the device sends
+# goes in here, whether it's a reply or something it sent on its own. a
+# zone is only served for ttl seconds after we last heard about it. sending
+# a command marks just the fields it changes as stale until the device tells
+# us where they ended up, so asking for the volume while a source change is
+# on its way is still served from here.
+class ZoneCache:
+    ttl: float = None
+
+    def __init__(
+        self,
+        ttl: float = HtdConstants.DEFAULT_CACHE_TTL,
+        zone_count: int = HtdConstants.MAX_HTD_ZONES,
+    ):
+        self.ttl = ttl
+        self.zone_count = zone_count
+        self._zones: dict[int, ZoneDetail] = {}
+        self._updated: dict[int, float] = {}
+        self._stale: dict[int, set[str]] = {}
+
+    # the zone's last known state, or None if we don't know it, it's too
+    # old, or any of the fields asked for are waiting on a command. without
+    # any fields, every field has to be fresh.
+    def get(self, zone: int, fields: [str] = None) -> ZoneDetail | None:
+        zone_info = self._zones.get(zone)
+
+        if zone_info is None:
+            return None
+
+        if time.monotonic() - self._updated[zone] > self.ttl:
+            return None
+
+        stale = self._stale.get(zone)
+
+        if stale and (fields is None or not stale.isdisjoint(fields)):
+            return None
+
+        return zone_info
+
+    def update(self, zone_info: ZoneDetail):
+        self._zones[zone_info.number] = zone_info
+        self._updated[zone_info.number] = time.monotonic()
+        self._stale.pop(zone_info.number, None)
+
+    # a command is on its way, so whatever it changes can't be trusted until
+    # the device tells us about the zone again
+    def invalidate(self, zone: int, command: int, data_code: int):
+        if command != HtdConstants.SET_COMMAND_CODE:
+            return
+
+        fields = AFFECTED_FIELDS.get(data_code)
+
+        if fields is None:
+            return
+
+        if data_code in ALL_ZONES_DATA_CODES:
+            zones = range(1, self.zone_count + 1)
+        else:
+            zones = (zone,)
+
+        for zone in zones:
+            self._stale.setdefault(zone, set()).update(fields)
+
+    # the last state we heard for every zone, however old or stale
+    @property
+    def known(self) -> dict[int, ZoneDetail]:
+        return self._zones
+
+    # how many seconds since we last heard about the zone, or None if we
+    # never have
+    def age(self, zone: int) -> float | None:
+        updated = self._updated.get(zone)
+
+        if updated is None:
+            return None
+
+        return time.monotonic() - updated
+
+    # whether a command sent to the zone hasn't been answered yet
+    def is_changing(self, zone: int) -> bool:
+        return bool(self._stale.get(zone))
+
+    def clear(self):
+        self._zones.clear()
+        self._updated.clear()
+        self._stale.clear()
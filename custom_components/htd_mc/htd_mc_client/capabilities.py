@@ -0,0 +1,74 @@
+from .constants import HtdConstants
+
+# every set command, besides the sources, see get_command_data_codes
+ALL_SET_COMMANDS = (
+    HtdConstants.POWER_OFF_ZONE_COMMAND,
+    HtdConstants.POWER_ON_ZONE_COMMAND,
+    HtdConstants.POWER_ON_ALL_ZONES_COMMAND,
+    HtdConstants.POWER_OFF_ALL_ZONES_COMMAND,
+    HtdConstants.TOGGLE_MUTE_COMMAND,
+    HtdConstants.VOLUME_UP_COMMAND,
+    HtdConstants.VOLUME_DOWN_COMMAND,
+    HtdConstants.BASE_UP_COMMAND,
+    HtdConstants.BASE_DOWN_COMMAND,
+    HtdConstants.TREBLE_UP_COMMAND,
+    HtdConstants.TREBLE_DOWN_COMMAND,
+    HtdConstants.BALANCE_RIGHT_COMMAND,
+    HtdConstants.BALANCE_LEFT_COMMAND,
+)
+
+ALL_ZONES_COMMANDS = (
+    HtdConstants.POWER_ON_ALL_ZONES_COMMAND,
+    HtdConstants.POWER_OFF_ALL_ZONES_COMMAND,
+)
+
+
+# what a gateway can do: how many zones and sources it has and which set
+# commands it understands. everything sized by the device, the command
+# table, validation, polling and the entities we create, goes by this, so
+# we never spend a round trip on a zone that isn't wired up. every model
+# we know of has six zones and six sources, so that's the default, and
+# zone_count leaves out the zones that aren't in use.
+class DeviceCapabilities:
+    zone_count: int = None
+    source_count: int = None
+    set_commands: tuple[int, ...] = None
+
+    def __init__(
+        self,
+        zone_count: int = HtdConstants.MAX_HTD_ZONES,
+        source_count: int = HtdConstants.MAX_HTD_ZONES,
+        set_commands: tuple[int, ...] = ALL_SET_COMMANDS,
+    ):
+        self.zone_count = zone_count
+        self.source_count = source_count
+        self.set_commands = set_commands
+
+    @property
+    def zones(self) -> [int]:
+        return list(range(1, self.zone_count + 1))
+
+    # the same device, with only the first zone_count zones in use. the all
+    # zones commands would reach the zones left out too, so they go.
+    def limit_zones(self, zone_count: int | None) -> "DeviceCapabilities":
+        if zone_count is None or zone_count >= self.zone_count:
+            return self
+
+        return DeviceCapabilities(
+            zone_count=zone_count,
+            source_count=self.source_count,
+            set_commands=tuple(
+                command
+                for command in self.set_commands
+                if command not in ALL_ZONES_COMMANDS
+            ),
+        )
+
+    def supports(self, data_code: int) -> bool:
+        return data_code in self.set_commands
+
+    def __str__(self):
+        return "zones = %d, sources = %d" % (
+            self.zone_count,
+            self.source_count,
+        )
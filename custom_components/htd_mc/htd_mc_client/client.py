@@ -1,23 +1,20 @@
 import logging
-import socket
 import time
 
+from .base_client import BaseHtdMcClient
+from .cache import MUTE_FIELDS, POWER_FIELDS, VOLUME_FIELDS
+from .connection import HtdConnection
 from .constants import HtdConstants
+from .groups import infer_zones
 from .models import ZoneDetail
-from .utils import get_command, parse_message, validate_source, validate_zone
+from .transport import Transport
+from .utils import parse_all_zones, parse_message
 
 _LOGGER = logging.getLogger(__name__)
 
-MAX_BYTES_TO_RECEIVE = 2 ** 10  # 1024
-ONE_SECOND = 1_000
 
-
-class HtdMcClient:
-    ip_address: str = None
-    port: int = None
-    command_delay_sec: float = None
-    retry_attempts: int = None
-    socket_timeout: float = None
+class HtdMcClient(BaseHtdMcClient):
+    connection: HtdConnection = None
 
     def __init__(
         self,
@@ -26,181 +23,355 @@ class HtdMcClient:
         command_delay: int = HtdConstants.DEFAULT_COMMAND_DELAY,
         retry_attempts: int = HtdConstants.DEFAULT_RETRY_ATTEMPTS,
         socket_timeout: int = HtdConstants.DEFAULT_SOCKET_TIMEOUT,
+        idle_timeout: int = HtdConstants.DEFAULT_IDLE_TIMEOUT,
+        cache_ttl: float = HtdConstants.DEFAULT_CACHE_TTL,
+        transport: Transport = None,
     ):
-        self.ip_address = ip_address
-        self.port = port
-        self.command_delay_sec = command_delay / ONE_SECOND
-        self.retry_attempts = retry_attempts
-        self.socket_timeout = socket_timeout
-
-    def query_zone(self, zone: int) -> ZoneDetail | None:
-        validate_zone(zone)
-        return self.send_command(zone, HtdConstants.QUERY_COMMAND_CODE, 0)
-
-    def set_source(self, zone: int, source: int) -> ZoneDetail | None:
-        validate_zone(zone)
-        validate_source(source)
-
-        # I have no idea why this is offset by 2
-        return self.send_command(
-            zone,
-            HtdConstants.SET_COMMAND_CODE,
-            source + 2
+        super().__init__(
+            ip_address,
+            port=port,
+            command_delay=command_delay,
+            retry_attempts=retry_attempts,
+            socket_timeout=socket_timeout,
+            cache_ttl=cache_ttl,
+            transport=transport,
         )
-
-    def volume_up(self, zone: int) -> ZoneDetail | None:
-        validate_zone(zone)
-        return self.send_command(
-            zone, HtdConstants.SET_COMMAND_CODE, HtdConstants.VOLUME_UP_COMMAND
+        self.connection = HtdConnection(
+            ip_address,
+            port=port,
+            socket_timeout=socket_timeout,
+            idle_timeout=idle_timeout,
+            transport=self.transport,
         )
 
-    def volume_down(self, zone: int) -> ZoneDetail | None:
-        validate_zone(zone)
-        return self.send_command(
-            zone,
-            HtdConstants.SET_COMMAND_CODE,
-            HtdConstants.VOLUME_DOWN_COMMAND
-        )
+    def close(self):
+        self.connection.close()
+
+    # wait between commands, so we don't flood the device
+    def _pace(self):
+        delay = self.pacer.delay
+        self.metrics.pacing_time += delay
+        time.sleep(delay)
+
+    # the answers to commands sent without waiting that have shown up so
+    # far, like volume steps, tell the pacer how the device is keeping up
+    def _record_answers(self):
+        for rtt in self.connection.read_available():
+            self.pacer.record_response(rtt, True)
+
+    # the zone's state from the cache when we know it, otherwise from the
+    # device
+    def get_zone(self, zone: int, fields: [str] = None) -> ZoneDetail | None:
+        zone_info = self.get_cached_zone(zone, fields)
 
-    def set_volume(
-        self, zone: int, volume: float, on_increment=None, zone_info=None
-    ) -> ZoneDetail | None:
         if zone_info is None:
             zone_info = self.query_zone(zone)
 
-        diff = round(volume) - zone_info.volume
+        return zone_info
 
-        if 1 >= diff >= -1:
+    # mute or unmute the zone. the device can only toggle mute, so we look
+    # at where the zone is first, from the cache when we've heard about it
+    # recently, and send nothing when it's already there. the toggle's reply
+    # tells us where it really ended up, and if the zone had changed under
+    # us since, one more toggle puts it right. a zone we can't get the state
+    # of is left alone rather than toggled blind.
+    def set_mute(self, zone: int, mute: bool) -> ZoneDetail | None:
+        zone_info = self.get_zone(zone, MUTE_FIELDS)
+
+        if zone_info is None or zone_info.mute is mute:
             return zone_info
 
-        if diff < 0:
-            zone_info = self.volume_down(zone)
-        else:
-            zone_info = self.volume_up(zone)
+        zone_info = self.toggle_mute(zone)
+
+        if zone_info is not None and zone_info.mute is not mute:
+            zone_info = self.toggle_mute(zone)
+
+        return zone_info
+
+    # turn the zone on or off, unless we already know it is
+    def set_power(self, zone: int, power: bool) -> ZoneDetail | None:
+        zone_info = self.get_cached_zone(zone, POWER_FIELDS)
+
+        if zone_info is not None and zone_info.power is power:
+            return zone_info
+
+        if power:
+            return self.power_on(zone)
+
+        return self.power_off(zone)
+
+    # step the volume to where we want it. the device only knows volume up
+    # and down, one step at a time, so we send the steps back to back at the
+    # command delay without waiting on an answer for each, then query the
+    # zone once at the end to see where it really ended up. on_increment is
+    # called after every step with our best guess of the zone, and can
+    # return a new volume to head towards instead.
+    def set_volume(
+        self, zone: int, volume: float, on_increment=None, zone_info=None
+    ) -> ZoneDetail | None:
+        self.validate_zone(zone)
 
         if zone_info is None:
+            zone_info = self.get_zone(zone, VOLUME_FIELDS)
+
+        # stepping from a volume the device can't have would send a step for
+        # every bit it's off by, so ask the zone where it really is first
+        if zone_info is not None and not self.is_valid_volume(zone_info):
             zone_info = self.query_zone(zone)
 
-        if on_increment is not None:
-            override_volume = on_increment(volume, zone_info)
+        if zone_info is None:
+            return None
 
-            if override_volume is not None:
-                volume = override_volume
+        if not self.is_valid_volume(zone_info):
+            _LOGGER.warning(
+                "Unexpected volume, not changing it. zone = %d, volume = %d"
+                % (zone, zone_info.htd_volume)
+            )
+            return None
 
-        return self.set_volume(zone, volume, on_increment, zone_info)
+        htd_volume = zone_info.htd_volume
+        stepped = False
 
-    def toggle_mute(self, zone) -> ZoneDetail | None:
-        validate_zone(zone)
-        return self.send_command(
-            zone,
-            HtdConstants.SET_COMMAND_CODE,
-            HtdConstants.TOGGLE_MUTE_COMMAND
-        )
+        # never more steps than it takes to go from one end to the other
+        for _ in range(HtdConstants.MAX_HTD_VOLUME):
+            step = self.get_volume_step(htd_volume, volume)
 
-    def power_on(self, zone=None, all_zones=False) -> ZoneDetail | None:
-        if all_zones:
-            zone = 1  # zone is one when it's all zones
-            power_command = HtdConstants.POWER_ON_ALL_ZONES_COMMAND
-        else:
-            validate_zone(zone)
-            power_command = HtdConstants.POWER_ON_ZONE_COMMAND
-        return self.send_command(
-            zone,
-            HtdConstants.SET_COMMAND_CODE,
-            power_command
-        )
+            if step is None:
+                break
 
-    def power_off(self, zone=None, all_zones=False) -> ZoneDetail | None:
-        if all_zones:
-            zone = 1  # zone is one when it's all zones
-            power_command = HtdConstants.POWER_OFF_ALL_ZONES_COMMAND
-        else:
-            validate_zone(zone)
-            power_command = HtdConstants.POWER_OFF_ZONE_COMMAND
-        return self.send_command(
-            zone,
-            HtdConstants.SET_COMMAND_CODE,
-            power_command
-        )
+            data_code, htd_volume = step
+            cmd = self.commands.get(
+                zone, HtdConstants.SET_COMMAND_CODE, data_code
+            )
+            self.cache.invalidate(
+                zone, HtdConstants.SET_COMMAND_CODE, data_code
+            )
 
-    def bass_up(self, zone) -> ZoneDetail | None:
-        validate_zone(zone)
-        return self.send_command(
-            zone, HtdConstants.SET_COMMAND_CODE, HtdConstants.BASE_UP_COMMAND
-        )
+            try:
+                self.connection.write(cmd, self.response_size)
+                self.metrics.commands += 1
+            except OSError as e:
+                self.metrics.connection_errors += 1
+                _LOGGER.warning(
+                    "Connection error changing volume. zone = %d, error = %s"
+                    % (zone, e)
+                )
+                break
 
-    def bass_down(self, zone) -> ZoneDetail | None:
-        validate_zone(zone)
-        return self.send_command(
-            zone, HtdConstants.SET_COMMAND_CODE, HtdConstants.BASE_DOWN_COMMAND
-        )
+            stepped = True
+            self._pace()
+            self._record_answers()
 
-    def treble_up(self, zone) -> ZoneDetail | None:
-        validate_zone(zone)
-        return self.send_command(
-            zone, HtdConstants.SET_COMMAND_CODE, HtdConstants.TREBLE_UP_COMMAND
-        )
+            if on_increment is not None:
+                override_volume = on_increment(
+                    volume, self.estimate_volume(zone_info, htd_volume)
+                )
 
-    def treble_down(self, zone) -> ZoneDetail | None:
-        validate_zone(zone)
-        return self.send_command(
-            zone,
-            HtdConstants.SET_COMMAND_CODE,
-            HtdConstants.TREBLE_DOWN_COMMAND
-        )
+                if override_volume is not None:
+                    volume = override_volume
 
-    def balance_right(self, zone) -> ZoneDetail | None:
-        validate_zone(zone)
-        return self.send_command(
-            zone,
-            HtdConstants.SET_COMMAND_CODE,
-            HtdConstants.BALANCE_RIGHT_COMMAND
-        )
+        # the answers to the steps are still on their way, get them out of
+        # the way before asking where the zone ended up
+        self.connection.discard()
+
+        zone_info = self.query_zone(zone)
+
+        if stepped:
+            self.check_volume_steps(zone_info, htd_volume)
 
-    def balance_left(self, zone):
-        validate_zone(zone)
-        return self.send_command(
-            zone,
-            HtdConstants.SET_COMMAND_CODE,
-            HtdConstants.BALANCE_LEFT_COMMAND
+        return zone_info
+
+    # get a group of zones to the state wanted for each, in one go. we
+    # start from what the cache knows, asking the device only about the
+    # zones it doesn't, work out the fewest commands to get there and send
+    # them back to back at the command delay without waiting on an answer
+    # for each. a single pass over the zones at the end confirms where they
+    # all ended up. when confirm is given, only those zones are asked, and
+    # the rest are worked out from their answer, see infer_zones.
+    def apply_scene(
+        self, scene: dict[int, ZoneDetail], confirm: [int] = None
+    ) -> dict[int, ZoneDetail]:
+        zones = sorted(scene)
+
+        for zone in zones:
+            self.validate_zone(zone)
+
+        current = {zone: self.get_cached_zone(zone) for zone in zones}
+        unknown = [zone for zone in zones if current[zone] is None]
+
+        if unknown:
+            current.update(self.query_all_zones(unknown))
+
+        for zone, command, data_code in self.plan_scene(scene, current):
+            cmd = self.commands.get(zone, command, data_code)
+            self.cache.invalidate(zone, command, data_code)
+
+            try:
+                self.connection.write(cmd, self.response_size)
+                self.metrics.commands += 1
+            except OSError as e:
+                self.metrics.connection_errors += 1
+                _LOGGER.warning(
+                    "Connection error applying scene. error = %s" % e
+                )
+                # we can't tell which zones got their commands now
+                confirm = None
+                break
+
+            self._pace()
+            self._record_answers()
+
+        self.connection.discard()
+
+        zone_infos = self.query_all_zones(
+            self.get_confirm_zones(zones, confirm, current)
         )
+        inferred = infer_zones(scene, zone_infos, current)
+
+        for zone_info in inferred.values():
+            self.cache.update(zone_info)
+
+        missing = [
+            zone
+            for zone in zones
+            if zone not in zone_infos and zone not in inferred
+        ]
+
+        if missing:
+            zone_infos.update(self.query_all_zones(missing))
+
+        zone_infos.update(inferred)
+
+        return {zone: zone_infos[zone] for zone in zones}
+
+    # query every zone in one pass. all the query commands go out together
+    # and we parse every zone out of whatever comes back. any zone missing
+    # from the reply is queried on its own, which gets the usual retries.
+    def query_all_zones(
+        self, zones: [int] = None
+    ) -> dict[int, ZoneDetail]:
+        if zones is None:
+            zones = self.capabilities.zones
+
+        zones = list(zones)
+        cmd, response_size = self.get_query_all_command(zones)
+
+        start = time.monotonic()
+
+        try:
+            data = self.connection.send(
+                cmd,
+                response_size=response_size,
+                timeout=self.pacer.timeout * len(zones),
+            )
+            self.metrics.commands += len(zones)
+            self.metrics.record_round_trip(
+                HtdConstants.QUERY_COMMAND_CODE,
+                (time.monotonic() - start) / len(zones),
+            )
+            found = parse_all_zones(data)
 
-    def get_model_info(self):
-        return self.send_command(1, HtdConstants.MODEL_QUERY_COMMAND_CODE, 0)
+            for zone_info in found.values():
+                self.cache.update(zone_info)
+
+            self.pacer.record_response(
+                (time.monotonic() - start) / len(zones),
+                all(zone in found for zone in zones),
+            )
+            self._pace()
+        except OSError as e:
+            self.metrics.connection_errors += 1
+            _LOGGER.warning(
+                "Connection error querying all zones, querying one by one. "
+                "error = %s" % e
+            )
+            found = {}
+
+        zone_infos = {}
+
+        for zone in zones:
+            zone_info = found.get(zone)
+
+            if zone_info is None:
+                zone_info = self.query_zone(zone)
+
+            zone_infos[zone] = zone_info
+
+        return zone_infos
 
     def send_command(
         self, zone, command, data_code, attempt=0
     ) -> ZoneDetail | str | None:
-        cmd = get_command(zone, command, data_code)
+        cmd = self.commands.get(zone, command, data_code)
+        self.cache.invalidate(zone, command, data_code)
 
-        address = (self.ip_address, self.port)
-        connection = socket.create_connection(address)
-        connection.settimeout(self.socket_timeout)
-        connection.send(cmd)
-        data = connection.recv(MAX_BYTES_TO_RECEIVE)
-        connection.close()
-        time.sleep(self.command_delay_sec)
+        # keep reading until the whole response is in, so a response split
+        # across reads doesn't look like a bad one. the model is just a
+        # string, so there we take whatever we get.
+        response_size = self.response_size
 
         if command is HtdConstants.MODEL_QUERY_COMMAND_CODE:
-            return data.decode("utf-8")
+            response_size = None
+
+        start = time.monotonic()
+        self.metrics.commands += 1
+
+        try:
+            data = self.connection.send(
+                cmd, response_size=response_size, timeout=self.pacer.timeout
+            )
+        except OSError as e:
+            if isinstance(e, TimeoutError):
+                self.metrics.timeouts += 1
+                self.pacer.record_timeout()
+            else:
+                self.metrics.connection_errors += 1
+
+            # the connection has already been dropped, so the retry will
+            # reconnect. once we're out of retries, let the caller know.
+            if attempt >= self.retry_attempts:
+                raise
+
+            self.metrics.retries += 1
+            _LOGGER.warning(
+                "Connection error, will retry. zone = %d, retry = %d, "
+                "error = %s" % (zone, attempt, e)
+            )
+            return self.send_command(zone, command, data_code, attempt + 1)
+
+        rtt = time.monotonic() - start
+        self.metrics.record_round_trip(command, rtt)
+
+        if command is HtdConstants.MODEL_QUERY_COMMAND_CODE:
+            self.pacer.record_response(rtt, True)
+            self._pace()
+            return data.decode("utf-8", errors="replace")
 
         response = parse_message(zone, data)
+        self.pacer.record_response(rtt, response is not None)
+
+        if response is not None:
+            self.cache.update(response)
+        else:
+            self.metrics.bad_responses += 1
+
+        self._pace()
 
         if response is None and attempt < self.retry_attempts:
+            self.metrics.retries += 1
             _LOGGER.warning(
                 "Bad response, will retry. zone = %d, retry = %d" % (
                     zone, attempt)
             )
-            time.sleep(
-                (self.command_delay_sec * 2) * (attempt + 1)
-            )  # sleep longer each time to be sure.
+            # back off longer each time, depending on how the device is doing
+            time.sleep(self.pacer.retry_delay(attempt))
             return self.send_command(zone, command, data_code, attempt + 1)
 
         if response is None:
             _LOGGER.critical(
                 (
                     "Still bad response after retrying! zone = %d! "
-                    "Consider increasing your command_delay!"
+                    "The device may be overloaded or unreachable."
                 )
                 % zone
             )
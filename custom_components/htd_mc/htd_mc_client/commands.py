@@ -0,0 +1,81 @@
+from .capabilities import DeviceCapabilities
+from .constants import HtdConstants
+from .utils import get_command
+
+
+# the data codes we ever send with each command code to a device that can
+# do what capabilities says. sources are sent as the source number offset
+# by 2, see set_source.
+def get_command_data_codes(
+    capabilities: DeviceCapabilities,
+) -> dict[int, tuple[int, ...]]:
+    return {
+        HtdConstants.SET_COMMAND_CODE: (
+            *capabilities.set_commands,
+            *[
+                source + 2
+                for source in range(1, capabilities.source_count + 1)
+            ],
+        ),
+        HtdConstants.QUERY_COMMAND_CODE: (0,),
+        HtdConstants.MODEL_QUERY_COMMAND_CODE: (0,),
+    }
+
+
+# every data code fits in a byte, so zone and data code together make the
+# index into a command's frames
+ZONE_SHIFT = 8
+
+
+# every command we can send, built once up front with the checksum already
+# on the end, so sending a command is just an index lookup. anything not in
+# the table isn't something the device understands, so a failed lookup
+# doubles as validation. it's built for the zones, sources and commands the
+# device has, so those are all the table holds.
+class CommandTable:
+    def __init__(self, capabilities: DeviceCapabilities = None):
+        if capabilities is None:
+            capabilities = DeviceCapabilities()
+
+        self.zone_count = zone_count = capabilities.zone_count
+        size = (zone_count + 1) << ZONE_SHIFT
+        self._frames: dict[int, tuple[bytes | None, ...]] = {}
+
+        for command, data_codes in get_command_data_codes(
+            capabilities
+        ).items():
+            frames = [None] * size
+
+            for zone in range(1, zone_count + 1):
+                for data_code in data_codes:
+                    frames[(zone << ZONE_SHIFT) | data_code] = bytes(
+                        get_command(zone, command, data_code)
+                    )
+
+            self._frames[command] = tuple(frames)
+
+    def get(self, zone: int, command: int, data_code: int) -> bytes:
+        frames = self._frames.get(command)
+        frame = None
+
+        if (
+            frames is not None
+            and 0 < zone <= self.zone_count
+            and 0 <= data_code < (1 << ZONE_SHIFT)
+        ):
+            frame = frames[(zone << ZONE_SHIFT) | data_code]
+
+        if frame is None:
+            raise ValueError(
+                "invalid command, zone = %s, command = %s, data_code = %s"
+                % (zone, command, data_code)
+            )
+
+        return frame
+
+    # several commands joined together, to go out in a single send
+    def get_batch(self, commands: [tuple[int, int, int]]) -> bytes:
+        return b"".join(
+            self.get(zone, command, data_code)
+            for zone, command, data_code in commands
+        )
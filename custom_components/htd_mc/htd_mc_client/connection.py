@@ -0,0 +1,494 @@
+import asyncio
+import logging
+import select
+import socket
+import threading
+import time
+from collections import deque
+
+from .constants import HtdConstants
+from .transport import TcpTransport, Transport
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# a long-lived connection to a single gateway. the gateway does not like
+# having a new connection opened for every command, so we keep one socket
+# open and share it between commands and retries. if the socket goes
+# quiet for longer than the idle timeout, or the gateway hangs up on us, we
+# drop it and reconnect on the next command, backing off when connecting
+# keeps failing. the transport decides how we get there, tcp by default.
+class HtdConnection:
+    ip_address: str = None
+    port: int = None
+    socket_timeout: float = None
+    idle_timeout: float = None
+    transport: Transport = None
+
+    def __init__(
+        self,
+        ip_address: str,
+        port: int = HtdConstants.DEFAULT_HTD_MC_PORT,
+        socket_timeout: float = HtdConstants.DEFAULT_SOCKET_TIMEOUT,
+        idle_timeout: float = HtdConstants.DEFAULT_IDLE_TIMEOUT,
+        transport: Transport = None,
+    ):
+        self.ip_address = ip_address
+        self.port = port
+        self.socket_timeout = socket_timeout
+        self.idle_timeout = idle_timeout
+        self.transport = transport or TcpTransport(ip_address, port)
+
+        self._socket: socket.socket | None = None
+        self._lock = threading.RLock()
+        self._unread = 0
+
+        # how much of each write's answer is still to come, and when it went
+        self._writes: deque[list] = deque()
+        self._last_used = 0.0
+        self._reconnect_delay = 0.0
+        self._next_connect_time = 0.0
+
+        # how many connections we've opened, and failed to open
+        self.connects = 0
+        self.connect_failures = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._socket is not None
+
+    # send the command and wait for whatever the gateway sends back. any
+    # socket error drops the connection, so a late reply can never be read
+    # as the answer to the next command. when several commands are sent at
+    # once, response_size tells us how many bytes to wait for. if the device
+    # stops short of that, we hand back what we got and drop the connection,
+    # so the stragglers don't end up in the next response. timeout overrides
+    # the socket timeout for this one command.
+    def send(
+        self, data: bytes, response_size: int = None, timeout: float = None
+    ) -> bytes:
+        with self._lock:
+            connection = self._get_connection()
+
+            try:
+                connection.settimeout(
+                    self.socket_timeout if timeout is None else timeout
+                )
+                connection.sendall(data)
+                response = connection.recv(self.transport.read_size)
+
+                while (
+                    response_size is not None
+                    and 0 < len(response) < response_size
+                ):
+                    try:
+                        chunk = connection.recv(self.transport.read_size)
+                    except socket.timeout:
+                        self.close()
+                        break
+
+                    if len(chunk) == 0:
+                        break
+
+                    response += chunk
+            except OSError:
+                self.close()
+                raise
+
+            # an empty read means the gateway closed the connection on us
+            if len(response) == 0:
+                self.close()
+                raise ConnectionResetError(
+                    "connection closed by %s" % self.transport
+                )
+
+            self._last_used = time.monotonic()
+
+            return response
+
+    # send without waiting for an answer. response_size is how many bytes
+    # the gateway will send back for it, which we throw away later.
+    def write(self, data: bytes, response_size: int = 0):
+        with self._lock:
+            connection = self._get_connection()
+
+            try:
+                connection.sendall(data)
+            except OSError:
+                self.close()
+                raise
+
+            self._unread += response_size
+            self._last_used = time.monotonic()
+
+            if response_size > 0:
+                self._writes.append([response_size, self._last_used])
+
+    # read and throw away whatever answers to write have already shown up,
+    # without waiting for the rest. returns how long each write that's now
+    # been answered in full took to answer.
+    def read_available(self) -> [float]:
+        with self._lock:
+            read = 0
+
+            if self._socket is not None and self._unread > 0:
+                self._socket.settimeout(0)
+
+                try:
+                    while self._unread > 0:
+                        chunk = self._socket.recv(self.transport.read_size)
+
+                        if len(chunk) == 0:
+                            self.close()
+                            break
+
+                        read += len(chunk)
+                        self._unread -= len(chunk)
+                except (BlockingIOError, TimeoutError):
+                    # nothing more has shown up yet
+                    pass
+                except OSError:
+                    self.close()
+
+                if self._socket is not None:
+                    self._socket.settimeout(self.socket_timeout)
+
+            now = time.monotonic()
+            round_trips = []
+
+            while self._writes and read > 0:
+                answered = min(read, self._writes[0][0])
+                self._writes[0][0] -= answered
+                read -= answered
+
+                if self._writes[0][0] == 0:
+                    round_trips.append(now - self._writes.popleft()[1])
+
+            return round_trips
+
+    # read and throw away the answers to everything sent with write. if they
+    # don't all show up in time, drop the connection, so they can't end up in
+    # the response to a later command.
+    def discard(self):
+        with self._lock:
+            if self._socket is not None:
+                self._socket.settimeout(self.socket_timeout)
+
+            while self._socket is not None and self._unread > 0:
+                try:
+                    chunk = self._socket.recv(self.transport.read_size)
+                except OSError:
+                    self.close()
+                    break
+
+                if len(chunk) == 0:
+                    self.close()
+                    break
+
+                self._unread -= len(chunk)
+
+            self._unread = 0
+            self._writes.clear()
+
+    def close(self):
+        with self._lock:
+            if self._socket is None:
+                return
+
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+
+            self._socket = None
+            self._unread = 0
+            self._writes.clear()
+
+    # reuse the open socket if it's still good, otherwise open a new one
+    def _get_connection(self) -> socket.socket:
+        if self._socket is not None:
+            idle = time.monotonic() - self._last_used
+
+            if idle > self.idle_timeout:
+                _LOGGER.debug(
+                    "connection to %s idle for %.1fs, reconnecting"
+                    % (self.transport, idle)
+                )
+                self.close()
+            elif not self._is_healthy():
+                _LOGGER.debug(
+                    "connection to %s is no longer healthy, reconnecting"
+                    % self.transport
+                )
+                self.close()
+
+        if self._socket is None:
+            self._socket = self._connect()
+
+        return self._socket
+
+    # a healthy idle socket has nothing to read. if it's readable, either
+    # the gateway hung up (empty read) or there are stale bytes left over
+    # from an earlier command, which we throw away so they don't get mixed
+    # into the next response.
+    def _is_healthy(self) -> bool:
+        try:
+            while True:
+                readable, _, _ = select.select([self._socket], [], [], 0)
+
+                if not readable:
+                    return True
+
+                chunk = self._socket.recv(self.transport.read_size)
+
+                if len(chunk) == 0:
+                    return False
+
+                self._unread = max(0, self._unread - len(chunk))
+        except OSError:
+            return False
+
+    def _connect(self) -> socket.socket:
+        # wait out the backoff from previous failures before trying again
+        wait = self._next_connect_time - time.monotonic()
+
+        if wait > 0:
+            time.sleep(wait)
+
+        try:
+            connection = self.transport.open(self.socket_timeout)
+        except OSError:
+            self._reconnect_delay = min(
+                HtdConstants.MAX_RECONNECT_DELAY,
+                max(
+                    HtdConstants.MIN_RECONNECT_DELAY,
+                    self._reconnect_delay * 2
+                ),
+            )
+            self._next_connect_time = (
+                time.monotonic() + self._reconnect_delay
+            )
+            self.connect_failures += 1
+            _LOGGER.warning(
+                "unable to connect to %s, next attempt in %.1fs"
+                % (self.transport, self._reconnect_delay)
+            )
+            raise
+
+        connection.settimeout(self.socket_timeout)
+
+        self._reconnect_delay = 0.0
+        self._next_connect_time = 0.0
+        self._last_used = time.monotonic()
+        self.connects += 1
+
+        _LOGGER.debug("connected to %s" % self.transport)
+
+        return connection
+
+
+# the asyncio flavor of HtdConnection, used by the AsyncHtdMcClient. same
+# idea: one stream per gateway, dropped when idle or broken, and reopened
+# with a backoff when connecting keeps failing. the difference is that
+# nobody waits on a read here. a reader task owns the stream while it's
+# open and hands every byte that shows up to data_received, whether it's a
+# reply to a command or something the gateway decided to tell us on its own.
+class AsyncHtdConnection:
+    ip_address: str = None
+    port: int = None
+    socket_timeout: float = None
+    idle_timeout: float = None
+    transport: Transport = None
+
+    # when something is listening for pushed updates, the connection is kept
+    # open no matter how long it's been since the last command.
+    keep_alive: bool = False
+
+    def __init__(
+        self,
+        ip_address: str,
+        port: int = HtdConstants.DEFAULT_HTD_MC_PORT,
+        socket_timeout: float = HtdConstants.DEFAULT_SOCKET_TIMEOUT,
+        idle_timeout: float = HtdConstants.DEFAULT_IDLE_TIMEOUT,
+        data_received=None,
+        connection_lost=None,
+        transport: Transport = None,
+    ):
+        self.ip_address = ip_address
+        self.port = port
+        self.socket_timeout = socket_timeout
+        self.idle_timeout = idle_timeout
+        self.transport = transport or TcpTransport(ip_address, port)
+        self.data_received = data_received
+        self.connection_lost = connection_lost
+
+        self._writer: asyncio.StreamWriter | None = None
+        self._reader_task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self._last_used = 0.0
+        self._reconnect_delay = 0.0
+        self._next_connect_time = 0.0
+
+        # how many connections we've opened, and failed to open
+        self.connects = 0
+        self.connect_failures = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    async def connect(self):
+        async with self._lock:
+            await self._get_connection()
+
+    async def write(self, data: bytes):
+        async with self._lock:
+            writer = await self._get_connection()
+
+            try:
+                writer.write(data)
+                await writer.drain()
+            except OSError:
+                await self.close()
+                raise
+
+            self._last_used = time.monotonic()
+
+    # wait out the backoff from previous failures. nothing else waits for
+    # it, see _connect.
+    async def wait_for_backoff(self):
+        wait = self._next_connect_time - time.monotonic()
+
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    # wait until the connection goes away, for whatever reason
+    async def wait_closed(self):
+        reader_task = self._reader_task
+
+        if reader_task is not None:
+            await asyncio.wait([reader_task])
+
+    async def close(self):
+        writer = self._writer
+        reader_task = self._reader_task
+        self._writer = None
+        self._reader_task = None
+
+        if (
+            reader_task is not None
+            and reader_task is not asyncio.current_task()
+        ):
+            reader_task.cancel()
+
+        if writer is None:
+            return
+
+        writer.close()
+
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    async def _get_connection(self) -> asyncio.StreamWriter:
+        if self._writer is not None:
+            idle = time.monotonic() - self._last_used
+
+            if not self.keep_alive and idle > self.idle_timeout:
+                _LOGGER.debug(
+                    "connection to %s idle for %.1fs, reconnecting"
+                    % (self.transport, idle)
+                )
+                await self.close()
+            elif self._writer.is_closing():
+                _LOGGER.debug(
+                    "connection to %s is no longer healthy, reconnecting"
+                    % self.transport
+                )
+                await self.close()
+
+        if self._writer is None:
+            reader, self._writer = await self._connect()
+            self._reader_task = asyncio.create_task(
+                self._read(reader, self._writer)
+            )
+
+        return self._writer
+
+    async def _read(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        error = None
+
+        try:
+            while True:
+                data = await reader.read(self.transport.read_size)
+
+                # an empty read means the gateway closed the connection on us
+                if len(data) == 0:
+                    break
+
+                self._last_used = time.monotonic()
+
+                if self.data_received is not None:
+                    self.data_received(data)
+        except OSError as e:
+            error = e
+        finally:
+            _LOGGER.debug(
+                "connection to %s closed, error = %s"
+                % (self.transport, error)
+            )
+
+            # only clean up if we're still the current connection, close()
+            # may have already dropped it
+            if self._writer is writer:
+                await self.close()
+
+            if self.connection_lost is not None:
+                self.connection_lost(error)
+
+    async def _connect(self) -> (asyncio.StreamReader, asyncio.StreamWriter):
+        # while backing off from previous failures, fail straight away
+        # rather than sleeping with the lock held, which would hold up every
+        # command behind it. the listener waits the backoff out on its own
+        # and reconnects once it's over.
+        wait = self._next_connect_time - time.monotonic()
+
+        if wait > 0:
+            raise ConnectionError(
+                "not connected to %s, next attempt in %.1fs"
+                % (self.transport, wait)
+            )
+
+        try:
+            reader, writer = await asyncio.wait_for(
+                self.transport.open_async(), self.socket_timeout
+            )
+        except (OSError, asyncio.TimeoutError):
+            self._reconnect_delay = min(
+                HtdConstants.MAX_RECONNECT_DELAY,
+                max(
+                    HtdConstants.MIN_RECONNECT_DELAY,
+                    self._reconnect_delay * 2
+                ),
+            )
+            self._next_connect_time = (
+                time.monotonic() + self._reconnect_delay
+            )
+            self.connect_failures += 1
+            _LOGGER.warning(
+                "unable to connect to %s, next attempt in %.1fs"
+                % (self.transport, self._reconnect_delay)
+            )
+            raise
+
+        self._reconnect_delay = 0.0
+        self._next_connect_time = 0.0
+        self._last_used = time.monotonic()
+        self.connects += 1
+
+        _LOGGER.debug("connected to %s" % self.transport)
+
+        return reader, writer
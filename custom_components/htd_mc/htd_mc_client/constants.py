@@ -7,15 +7,58 @@ class HtdConstants:
     # inbetween commands, in milliseconds
     DEFAULT_COMMAND_DELAY = 100
 
+    # the delay between commands adapts to how well the device is doing,
+    # command_delay is the most it can be and this is the least, in
+    # milliseconds
+    MIN_COMMAND_DELAY = 10
+
     # the device is flakey, let's retry a bunch of times
     DEFAULT_RETRY_ATTEMPTS = 5
 
     # the port of the device, default is 10006
     DEFAULT_HTD_MC_PORT = 10006
 
+    # the device's own RS-232 port runs at 38400 baud. with no gateway in
+    # between, the delay between commands can get closer to the bare
+    # minimum, in milliseconds
+    DEFAULT_SERIAL_BAUDRATE = 38400
+    SERIAL_MIN_COMMAND_DELAY = 5
+
     # the number of seconds before we give up trying to read from the device
     DEFAULT_SOCKET_TIMEOUT = 1
 
+    # the time we wait for an answer adapts to how quickly the device usually
+    # answers, but never drops below this many seconds
+    MIN_RESPONSE_TIMEOUT = 0.25
+
+    # the connection to the device is kept open between commands. if nothing
+    # has been sent for this many seconds, we reconnect on the next command
+    DEFAULT_IDLE_TIMEOUT = 60
+
+    # when we can't connect, we wait before trying again, doubling the wait
+    # each time up to the max, in seconds
+    MIN_RECONNECT_DELAY = 0.5
+    MAX_RECONNECT_DELAY = 30
+
+    # a volume slider sends a new volume many times a second while it's
+    # dragged. we wait this many seconds before starting to change the
+    # volume, and while it changes, we update the volume shown at most once
+    # every VOLUME_UPDATE_INTERVAL seconds
+    VOLUME_DEBOUNCE = 0.1
+    VOLUME_UPDATE_INTERVAL = 0.5
+
+    # the last state we saw for a zone is trusted for this many seconds
+    # before we ask the device again
+    DEFAULT_CACHE_TTL = 5
+
+    # how often, in seconds, a zone is polled when it's playing, and when
+    # it's off. the gateway pushes changes to us, so polling only catches
+    # what we've missed, and a zone we've heard from recently isn't polled
+    # at all. no more than POLL_BUDGET zones are polled at a time.
+    ACTIVE_POLL_INTERVAL = 60
+    IDLE_POLL_INTERVAL = 900
+    POLL_BUDGET = 2
+
     # 255 is the max value you can have with 1 byte. the volume max is 60.
     # so, we use 256 to represent a real 100% when computing the volume
     MAX_HTD_RAW_VOLUME = 256
@@ -23,9 +66,17 @@ class HtdConstants:
     MAX_HTD_ZONES = 6
     VOLUME_OFFSET = MAX_HTD_RAW_VOLUME - MAX_HTD_VOLUME
 
+    # treble and bass go from -MAX_HTD_TONE to MAX_HTD_TONE, balance from
+    # -MAX_HTD_BALANCE (left) to MAX_HTD_BALANCE (right), one step at a time
+    MAX_HTD_TONE = 12
+    MAX_HTD_BALANCE = 18
+
     # each message we get is chunked at 14 bytes
     MESSAGE_CHUNK_SIZE = 14
 
+    # the device answers every command with 2 chunks
+    RESPONSE_CHUNK_COUNT = 2
+
     # command codes instruct the device what mode to do,
     # it's follow with a command as well listed below
     SET_COMMAND_CODE = 0x04
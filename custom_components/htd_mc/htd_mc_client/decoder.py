@@ -0,0 +1,124 @@
+from .constants import HtdConstants
+
+# the 4th byte of every zone chunk, see parse_zone
+ZONE_CHUNK_MARKER = 0x05
+
+
+# turns the bytes coming from the device into whole zone chunks, no matter
+# how they were cut up on the way. bytes are kept between calls to feed, so
+# a chunk split across two reads comes out whole once the rest shows up.
+# instead of trusting that the stream starts on a chunk boundary, we look
+# for the header, reserved byte and 0x05 marker that every zone chunk starts
+# with, and skip over anything in front of it. a chunk only counts once its
+# last byte matches the checksum of the rest, otherwise we look again from
+# the byte after where it seemed to start, so junk that happens to look like
+# the start of a chunk can't swallow a real one. that way, a read that
+# starts halfway through a chunk, or junk the device sends in between, only
+# costs us the broken chunk, not every chunk after it.
+#
+# rejected counts the chunks that started like a zone chunk, but had a zone
+# that can't be, or didn't add up to their checksum.
+class FrameDecoder:
+    rejected: int = 0
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.rejected = 0
+
+    # how many bytes are waiting for the rest of their chunk
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def reset(self):
+        self._buffer.clear()
+
+    def feed(self, data: bytes) -> [bytes]:
+        data, offsets = self.feed_offsets(data)
+        return [
+            data[offset: offset + HtdConstants.MESSAGE_CHUNK_SIZE]
+            for offset in offsets
+        ]
+
+    # the same as feed, but instead of copying out every chunk, it returns
+    # the bytes that were consumed along with where each chunk starts in
+    # them, ready to be parsed in place.
+    def feed_offsets(self, data: bytes) -> (bytes, [int]):
+        self._buffer += data
+        offsets = []
+        position = 0
+        size = len(self._buffer)
+
+        while True:
+            start = self._find_start(position)
+
+            # nothing left that could start a chunk
+            if start is None:
+                position = size
+                break
+
+            end = start + HtdConstants.MESSAGE_CHUNK_SIZE
+
+            # the rest of the chunk hasn't shown up yet
+            if end > size:
+                position = start
+                break
+
+            # a garbled chunk, or something that only looked like a start
+            if not self._is_valid(start, end):
+                self.rejected += 1
+                position = start + 1
+                continue
+
+            offsets.append(start)
+            position = end
+
+        consumed = bytes(self._buffer[:position])
+        del self._buffer[:position]
+
+        return consumed, offsets
+
+    # the position of the next possible chunk start, or None if there isn't
+    # one. a start that's too close to the end to check fully still counts.
+    def _find_start(self, position: int) -> int | None:
+        buffer = self._buffer
+        size = len(buffer)
+
+        while True:
+            start = buffer.find(HtdConstants.HEADER_BIT, position)
+
+            if start == -1:
+                return None
+
+            if self._is_start(start, size):
+                return start
+
+            position = start + 1
+
+    # the last byte of a chunk is the sum of the others, cut down to a byte
+    def _is_valid(self, start: int, end: int) -> bool:
+        buffer = self._buffer
+        return sum(buffer[start: end - 1]) & 0xFF == buffer[end - 1]
+
+    def _is_start(self, start: int, size: int) -> bool:
+        buffer = self._buffer
+
+        if (
+            start + 1 < size
+            and buffer[start + 1] != HtdConstants.RESERVED_BYTE
+        ):
+            return False
+
+        if start + 3 < size and buffer[start + 3] != ZONE_CHUNK_MARKER:
+            return False
+
+        if start + 2 < size and not (
+            1 <= buffer[start + 2] <= HtdConstants.MAX_HTD_ZONES
+        ):
+            # everything else says zone chunk, so the zone got garbled
+            if start + 3 < size:
+                self.rejected += 1
+
+            return False
+
+        return True
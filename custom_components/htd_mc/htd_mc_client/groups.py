@@ -0,0 +1,115 @@
+import copy
+
+from .models import ZoneDetail
+
+# what a scene sets, and the fields that go along with it. when every zone
+# in a group is sent the same change, where one of them ended up for these
+# goes for the rest.
+SHARED_FIELDS = {
+    "power": ("power",),
+    "mute": ("mute",),
+    "source": ("source",),
+    "volume": ("volume", "htd_volume"),
+    "bass": ("bass",),
+    "treble": ("treble",),
+    "balance": ("balance",),
+}
+
+
+# which zones are linked together, so a change to one of them goes to all
+# of them. zones are linked either by joining them, or by the device itself
+# when they're in party mode, which links every zone with the party flag.
+# a joined group is listed with the zone it was joined to first.
+class ZoneGroups:
+    def __init__(self):
+        self._groups: dict[int, list[int]] = {}
+
+    # link members to leader, taking them out of any group they were in
+    def join(self, leader: int, members: [int]) -> [int]:
+        group = [leader]
+
+        for zone in [leader, *members]:
+            self.unjoin(zone)
+
+            if zone not in group:
+                group.append(zone)
+
+        if len(group) > 1:
+            for zone in group:
+                self._groups[zone] = group
+
+        return group
+
+    # take zone out of its group, a group left with one zone is no group
+    def unjoin(self, zone: int):
+        group = self._groups.pop(zone, None)
+
+        if group is None:
+            return
+
+        group.remove(zone)
+
+        if len(group) == 1:
+            self._groups.pop(group[0], None)
+
+    # every zone linked to zone, itself included. zone_infos is the last
+    # we heard of every zone, for their party flags.
+    def get_members(
+        self, zone: int, zone_infos: dict[int, ZoneDetail] = None
+    ) -> [int]:
+        group = self._groups.get(zone)
+
+        if group is not None:
+            return list(group)
+
+        zone_info = (zone_infos or {}).get(zone)
+
+        if zone_info is None or not zone_info.party:
+            return [zone]
+
+        return sorted(
+            number
+            for number, other in zone_infos.items()
+            if other.party and number not in self._groups
+        )
+
+
+# the zones in scene we didn't ask the device about, worked out from the
+# first one we did. only works for zones we knew the state of before the
+# scene, and only for the fields the scene set, everything else is left as
+# it was.
+def infer_zones(
+    scene: dict[int, ZoneDetail],
+    confirmed: dict[int, ZoneDetail | None],
+    current: dict[int, ZoneDetail | None],
+) -> dict[int, ZoneDetail]:
+    reference = next(
+        (
+            confirmed[zone]
+            for zone in sorted(confirmed)
+            if confirmed[zone] is not None
+        ),
+        None,
+    )
+
+    if reference is None:
+        return {}
+
+    inferred = {}
+
+    for zone, wanted in scene.items():
+        zone_info = current.get(zone)
+
+        if zone in confirmed or zone_info is None:
+            continue
+
+        zone_info = copy.copy(zone_info)
+
+        for setting, fields in SHARED_FIELDS.items():
+            if getattr(wanted, setting) is not None:
+                for field in fields:
+                    setattr(zone_info, field, getattr(reference, field))
+
+        inferred[zone] = zone_info
+
+    return inferred
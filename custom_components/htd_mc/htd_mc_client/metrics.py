@@ -0,0 +1,128 @@
+import bisect
+
+from .constants import HtdConstants
+
+ONE_SECOND = 1_000
+
+# the upper bound of each histogram bucket, in milliseconds. anything slower
+# than the last one goes in a bucket of its own.
+HISTOGRAM_BUCKETS = (
+    5, 10, 25, 50, 75, 100, 150, 250, 500, 750, 1_000, 2_500, 5_000
+)
+
+COMMAND_NAMES = {
+    HtdConstants.SET_COMMAND_CODE: "set",
+    HtdConstants.QUERY_COMMAND_CODE: "query",
+    HtdConstants.MODEL_QUERY_COMMAND_CODE: "model",
+}
+
+
+# how long something took, bucketed, so we can keep every measurement
+# without keeping a list that grows forever. percentiles come out as the
+# upper bound of the bucket they fall in.
+class Histogram:
+    def __init__(self, buckets: tuple[int, ...] = HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min: float | None = None
+        self.max: float | None = None
+
+    # seconds in, milliseconds in the buckets
+    def record(self, seconds: float):
+        milliseconds = seconds * ONE_SECOND
+        self.counts[bisect.bisect_left(self.buckets, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+
+        if self.min is None or milliseconds < self.min:
+            self.min = milliseconds
+
+        if self.max is None or milliseconds > self.max:
+            self.max = milliseconds
+
+    @property
+    def mean(self) -> float | None:
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percent: float) -> float | None:
+        if not self.count:
+            return None
+
+        wanted = self.count * percent / 100
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            seen += count
+
+            if seen >= wanted and count:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], self.max)
+
+                return self.max
+
+        return self.max
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": self.mean,
+            "min_ms": self.min,
+            "max_ms": self.max,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "buckets": dict(
+                zip([*map(str, self.buckets), "inf"], self.counts)
+            ),
+        }
+
+
+# everything the client counts while it works, so the pacing can be tuned
+# from what really happens instead of guessing. it's all plain counters and
+# histograms, cheap enough to always be on.
+class ClientMetrics:
+    def __init__(self):
+        # round trip times, per command type
+        self.round_trips: dict[str, Histogram] = {}
+
+        self.commands = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.bad_responses = 0
+        self.bad_frames = 0
+        self.connection_errors = 0
+
+        # time spent waiting between commands, in seconds
+        self.pacing_time = 0.0
+
+        self.max_queue_depth = 0
+
+    def record_round_trip(self, command: int | str, seconds: float):
+        name = COMMAND_NAMES.get(command, command)
+        histogram = self.round_trips.get(name)
+
+        if histogram is None:
+            histogram = self.round_trips[name] = Histogram()
+
+        histogram.record(seconds)
+
+    def record_queue_depth(self, depth: int):
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def as_dict(self) -> dict:
+        return {
+            "commands": self.commands,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "bad_responses": self.bad_responses,
+            "bad_frames": self.bad_frames,
+            "connection_errors": self.connection_errors,
+            "pacing_time_s": self.pacing_time,
+            "max_queue_depth": self.max_queue_depth,
+            "round_trips": {
+                name: histogram.as_dict()
+                for name, histogram in self.round_trips.items()
+            },
+        }
@@ -1,18 +1,57 @@
+# the state of a single zone. we make a lot of these, one for every zone
+# chunk the device sends, so they use slots instead of a dict per instance.
 class ZoneDetail:
-    number: int = None
-    power: bool = None
-    mute: bool = None
-    mode: bool = None
-    party: bool = None
-    source: int = None
-    volume: int = None
-    htd_volume: int = None
-    treble: int = None
-    bass: int = None
-    balance: int = None
+    __slots__ = (
+        "number",
+        "power",
+        "mute",
+        "mode",
+        "party",
+        "source",
+        "volume",
+        "htd_volume",
+        "treble",
+        "bass",
+        "balance",
+    )
 
-    def __init__(self, number: int):
+    number: int
+    power: bool | None
+    mute: bool | None
+    mode: bool | None
+    party: bool | None
+    source: int | None
+    volume: int | None
+    htd_volume: int | None
+    treble: int | None
+    bass: int | None
+    balance: int | None
+
+    def __init__(
+        self,
+        number: int,
+        power: bool = None,
+        mute: bool = None,
+        mode: bool = None,
+        party: bool = None,
+        source: int = None,
+        volume: int = None,
+        htd_volume: int = None,
+        treble: int = None,
+        bass: int = None,
+        balance: int = None,
+    ):
         self.number = number
+        self.power = power
+        self.mute = mute
+        self.mode = mode
+        self.party = party
+        self.source = source
+        self.volume = volume
+        self.htd_volume = htd_volume
+        self.treble = treble
+        self.bass = bass
+        self.balance = balance
 
     def __str__(self):
         return (
@@ -0,0 +1,92 @@
+import random
+
+from .constants import HtdConstants
+
+ONE_SECOND = 1_000
+
+# while the device keeps answering properly, the delay shrinks by this much
+# after every command. a bad answer grows it by the other.
+HEALTHY_DELAY_FACTOR = 0.8
+UNHEALTHY_DELAY_FACTOR = 2
+
+# how much weight a new measurement gets in the running averages
+RTT_SMOOTHING = 0.125
+RTT_VARIANCE_SMOOTHING = 0.25
+BAD_RESPONSE_SMOOTHING = 0.1
+
+
+# works out how long to wait between commands, and before a retry, from how
+# the device is actually doing instead of a fixed delay. we keep a running
+# average of how long the device takes to answer and how often the answer is
+# bad. while it's healthy, the delay between commands shrinks towards the
+# minimum, and as soon as it starts sending garbage, the delay goes back up.
+# the configured command_delay is the most we'll ever wait between
+# commands, and the configured socket_timeout is the most we'll ever wait
+# for an answer.
+class AdaptivePacer:
+    min_delay: float = None
+    max_delay: float = None
+    max_timeout: float = None
+
+    def __init__(
+        self,
+        max_delay: float,
+        max_timeout: float,
+        min_delay: float = HtdConstants.MIN_COMMAND_DELAY / ONE_SECOND,
+    ):
+        self.max_delay = max_delay
+        self.max_timeout = max_timeout
+        self.min_delay = min(min_delay, max_delay)
+
+        # start out where the configured values would have had us
+        self.delay = max_delay
+        self.rtt: float | None = None
+        self.rtt_variance = 0.0
+        self.bad_response_rate = 0.0
+
+    # how long to wait for an answer. like tcp, it's the average round trip
+    # plus some room for how much it varies, but never less than the floor
+    # and never more than the socket timeout.
+    @property
+    def timeout(self) -> float:
+        if self.rtt is None:
+            return self.max_timeout
+
+        timeout = self.rtt + 4 * self.rtt_variance
+        timeout = max(HtdConstants.MIN_RESPONSE_TIMEOUT, timeout)
+        return min(self.max_timeout, timeout)
+
+    def record_response(self, rtt: float, valid: bool):
+        if self.rtt is None:
+            self.rtt = rtt
+            self.rtt_variance = rtt / 2
+        else:
+            self.rtt_variance += RTT_VARIANCE_SMOOTHING * (
+                abs(rtt - self.rtt) - self.rtt_variance
+            )
+            self.rtt += RTT_SMOOTHING * (rtt - self.rtt)
+
+        self.bad_response_rate += BAD_RESPONSE_SMOOTHING * (
+            (0.0 if valid else 1.0) - self.bad_response_rate
+        )
+
+        if valid:
+            self.delay *= HEALTHY_DELAY_FACTOR
+        else:
+            self.delay *= UNHEALTHY_DELAY_FACTOR
+
+        self.delay = max(self.min_delay, min(self.max_delay, self.delay))
+
+    # a response that never showed up counts as a bad one that took the
+    # whole timeout
+    def record_timeout(self):
+        self.record_response(self.timeout, False)
+
+    # how long to wait before retrying. it doubles with every attempt, with
+    # some jitter so retries from different zones don't line up, but never
+    # goes past the fixed backoff we used to always wait.
+    def retry_delay(self, attempt: int) -> float:
+        max_retry_delay = (self.max_delay * 2) * (attempt + 1)
+        retry_delay = self.delay * (2 ** attempt)
+        retry_delay = random.uniform(retry_delay / 2, retry_delay)
+        return min(max_retry_delay, retry_delay)
@@ -0,0 +1,67 @@
+from .cache import ZoneCache
+from .constants import HtdConstants
+from .models import ZoneDetail
+
+# the order zones are polled in when more are due than the budget allows
+CHANGING = 0
+UNKNOWN = 1
+DUE = 2
+
+
+# picks which zones to poll, so a zone that's been off for days isn't asked
+# about as often as one that's playing. a zone that's on, or in party mode,
+# is polled every active_interval seconds, and one that's off every
+# idle_interval seconds, counted from whenever we last heard about it, so a
+# zone the gateway has pushed to us recently is left alone. a zone with a
+# command that hasn't been answered yet is polled every time, so we find
+# out where it ended up quickly. no more than budget zones are polled at a
+# time, the ones waiting on a command first, then ones we know nothing
+# about, then whichever is the most overdue.
+class PollPlanner:
+    cache: ZoneCache = None
+    active_interval: float = None
+    idle_interval: float = None
+    budget: int = None
+
+    def __init__(
+        self,
+        cache: ZoneCache,
+        active_interval: float = HtdConstants.ACTIVE_POLL_INTERVAL,
+        idle_interval: float = HtdConstants.IDLE_POLL_INTERVAL,
+        budget: int = HtdConstants.POLL_BUDGET,
+    ):
+        self.cache = cache
+        self.active_interval = active_interval
+        self.idle_interval = idle_interval
+        self.budget = budget
+
+    def get_interval(self, zone_info: ZoneDetail) -> float:
+        if zone_info.power or zone_info.party:
+            return self.active_interval
+
+        return self.idle_interval
+
+    # the zones to poll now, out of zones. zone_infos is what we last knew
+    # about each.
+    def get_due_zones(
+        self, zones: [int], zone_infos: dict[int, ZoneDetail | None]
+    ) -> [int]:
+        due = []
+
+        for zone in zones:
+            zone_info = zone_infos.get(zone)
+            age = self.cache.age(zone)
+
+            if self.cache.is_changing(zone):
+                due.append((CHANGING, 0, zone))
+            elif zone_info is None or age is None:
+                due.append((UNKNOWN, 0, zone))
+            else:
+                interval = self.get_interval(zone_info)
+
+                if age >= interval:
+                    # the most overdue, for how often it should be polled,
+                    # goes first
+                    due.append((DUE, -age / interval, zone))
+
+        return [zone for _, _, zone in sorted(due)[: self.budget]]
@@ -0,0 +1,242 @@
+import asyncio
+import logging
+from collections import deque
+
+from .constants import HtdConstants
+
+_LOGGER = logging.getLogger(__name__)
+
+# commands somebody is waiting on go first, polling can wait
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 1
+
+
+# a command waiting its turn to be sent. several requests for the same thing
+# can end up sharing one of these, in which case they all get the same
+# answer.
+class ScheduledCommand:
+    zone: int = None
+    command: int = None
+    data_code: int = None
+    priority: int = None
+
+    # for volume steps, how many steps up (positive) or down (negative)
+    steps: int = 0
+
+    # whether anybody needs the device's answer. volume steps sent during a
+    # ramp don't, which lets them go out without waiting for a reply.
+    wait_reply: bool = True
+
+    def __init__(self, zone: int, command: int, data_code: int,
+                 priority: int):
+        self.zone = zone
+        self.command = command
+        self.data_code = data_code
+        self.priority = priority
+        self.futures = []
+
+    @property
+    def is_query(self) -> bool:
+        return self.command == HtdConstants.QUERY_COMMAND_CODE
+
+    @property
+    def is_volume_step(self) -> bool:
+        return self.command == HtdConstants.SET_COMMAND_CODE and (
+            self.data_code == HtdConstants.VOLUME_UP_COMMAND
+            or self.data_code == HtdConstants.VOLUME_DOWN_COMMAND
+        )
+
+    def set_result(self, result):
+        for future in self.futures:
+            if not future.done():
+                future.set_result(result)
+
+    def set_exception(self, error: Exception):
+        for future in self.futures:
+            if not future.done():
+                future.set_exception(error)
+
+
+# every command for a gateway goes through here, and a single writer task
+# sends them one at a time, so commands from different entities never step
+# on each other. while commands wait their turn:
+#  - a query for a zone that already has a query waiting shares it, unless
+#    another command for that zone would be sent after the waiting query,
+#    since its answer would be from before that command,
+#  - volume up and down steps for a zone are merged into one net change,
+#  - user commands are sent before background polling.
+# the writer hands commands to execute, which sends them and sets their
+# results. when it finds several queries waiting, it hands them over
+# together so they can be sent in one go.
+class CommandScheduler:
+    def __init__(self, execute):
+        self._execute = execute
+        self._lanes = {
+            PRIORITY_USER: deque(),
+            PRIORITY_BACKGROUND: deque(),
+        }
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    # how many commands are waiting to be sent
+    @property
+    def depth(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def submit(
+        self,
+        zone: int,
+        command: int,
+        data_code: int,
+        priority: int = PRIORITY_USER,
+        wait_reply: bool = True,
+    ) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        scheduled = self._coalesce(zone, command, data_code, priority)
+
+        if scheduled is None:
+            scheduled = ScheduledCommand(zone, command, data_code, priority)
+            scheduled.wait_reply = wait_reply
+
+            if scheduled.is_volume_step:
+                scheduled.steps = self._get_step(data_code)
+
+            self._lanes[priority].append(scheduled)
+        elif scheduled.is_volume_step:
+            scheduled.steps += self._get_step(data_code)
+            scheduled.wait_reply = scheduled.wait_reply or wait_reply
+
+        scheduled.futures.append(future)
+        self._start()
+
+        return future
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        for lane in self._lanes.values():
+            while lane:
+                lane.popleft().set_exception(
+                    ConnectionAbortedError("the client was closed")
+                )
+
+    # find a waiting command this one can share or be merged into
+    def _coalesce(
+        self, zone: int, command: int, data_code: int, priority: int
+    ) -> ScheduledCommand | None:
+        probe = ScheduledCommand(zone, command, data_code, priority)
+
+        if probe.is_query:
+            for lane in self._lanes.values():
+                for scheduled in lane:
+                    if (
+                        scheduled.is_query
+                        and scheduled.zone == zone
+                        and not self._is_overtaken(scheduled, priority)
+                    ):
+                        self._promote(scheduled, priority)
+                        return scheduled
+
+        if probe.is_volume_step:
+            for scheduled in self._lanes[priority]:
+                if scheduled.is_volume_step and scheduled.zone == zone:
+                    return scheduled
+
+        return None
+
+    # whether a command for the query's zone, other than a query, would be
+    # sent after it, once it's been moved up to priority. a promoted query
+    # goes on the end of its new lane, so only the lanes after that are
+    # behind it.
+    def _is_overtaken(self, query: ScheduledCommand, priority: int) -> bool:
+        priority = min(priority, query.priority)
+        lane = self._lanes[priority]
+        behind = []
+
+        if query.priority == priority:
+            behind.extend(list(lane)[lane.index(query) + 1:])
+
+        for other_priority, other_lane in self._lanes.items():
+            if other_priority > priority:
+                behind.extend(other_lane)
+
+        return any(
+            other.zone == query.zone and not other.is_query
+            for other in behind
+            if other is not query
+        )
+
+    # a background query someone is now waiting on jumps the queue
+    def _promote(self, scheduled: ScheduledCommand, priority: int):
+        if priority >= scheduled.priority:
+            return
+
+        self._lanes[scheduled.priority].remove(scheduled)
+        scheduled.priority = priority
+        self._lanes[priority].append(scheduled)
+
+    @staticmethod
+    def _get_step(data_code: int) -> int:
+        if data_code == HtdConstants.VOLUME_UP_COMMAND:
+            return 1
+
+        return -1
+
+    def _start(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+
+        self._wakeup.set()
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    # the next command to send, plus any other queries waiting in the same
+    # lane when it's a query. a query waiting behind another command for
+    # its zone stays put, so it's still answered after that command.
+    def _next_batch(self) -> [ScheduledCommand]:
+        for lane in self._lanes.values():
+            if not lane:
+                continue
+
+            scheduled = lane.popleft()
+
+            if not scheduled.is_query:
+                return [scheduled]
+
+            batch = [scheduled]
+            held = set()
+
+            for other in list(lane):
+                if not other.is_query:
+                    held.add(other.zone)
+                elif other.zone not in held:
+                    lane.remove(other)
+                    batch.append(other)
+
+            return batch
+
+        return []
+
+    async def _run(self):
+        while True:
+            batch = self._next_batch()
+
+            if not batch:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            try:
+                await self._execute(batch)
+            except asyncio.CancelledError:
+                for scheduled in batch:
+                    scheduled.set_exception(
+                        ConnectionAbortedError("the client was closed")
+                    )
+                raise
+            except Exception as e:
+                for scheduled in batch:
+                    scheduled.set_exception(e)
@@ -0,0 +1,458 @@
+import argparse
+import asyncio
+import logging
+import random
+import socket
+import threading
+
+from .constants import HtdConstants
+from .decoder import ZONE_CHUNK_MARKER
+from .models import ZoneDetail
+from .utils import calculate_checksum
+
+_LOGGER = logging.getLogger(__name__)
+
+# header, reserved, zone, command, data code and checksum
+REQUEST_SIZE = 6
+
+# the first chunk of every response isn't a zone chunk, we only ever skip
+# over it, so any marker other than the zone chunk's will do
+ECHO_CHUNK_MARKER = 0x06
+
+MODEL_INFO = b"MCA66"
+
+# the flags in the state toggles byte, see get_state_toggles
+POWER_FLAG = 0b1000
+MUTE_FLAG = 0b0100
+MODE_FLAG = 0b0010
+PARTY_FLAG = 0b0001
+
+
+# a stand-in for an MCA-66 gateway, for trying the clients out without the
+# real thing. it keeps the state of all six zones, answers every command the
+# way the device does, with a 2 chunk response ending in the zone's state,
+# and can be made to misbehave the ways the real one does:
+#  - latency, how long it takes to answer, plus up to jitter more,
+#  - fragment_size, to send answers in pieces this big,
+#  - drop_rate, how often an answer never comes,
+#  - garble_rate, how often an answer comes back with a byte broken,
+#  - unsolicited_interval, how often a zone is sent on its own, like when
+#    someone uses a keypad.
+# rates are between 0 and 1. like the real gateway, it works through one
+# command at a time, no matter how many connections are open.
+#
+# it runs on the current event loop with start, or on a thread of its own
+# with start_in_thread, for the blocking client. it can also be run from
+# the command line, see main. attach serves a socket handed to it, so a
+# client with a PipeTransport can use it without going over tcp.
+class HtdSimulator:
+    host: str = None
+    port: int = None
+    latency: float = None
+    jitter: float = None
+    fragment_size: int | None = None
+    drop_rate: float = None
+    garble_rate: float = None
+    unsolicited_interval: float | None = None
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        fragment_size: int = None,
+        drop_rate: float = 0.0,
+        garble_rate: float = 0.0,
+        unsolicited_interval: float = None,
+        seed: int = None,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.fragment_size = fragment_size
+        self.drop_rate = drop_rate
+        self.garble_rate = garble_rate
+        self.unsolicited_interval = unsolicited_interval
+
+        self.zones = {
+            zone: ZoneDetail(
+                zone,
+                power=False,
+                mute=False,
+                mode=False,
+                party=False,
+                source=1,
+                htd_volume=0,
+                treble=0,
+                bass=0,
+                balance=0,
+            )
+            for zone in range(1, HtdConstants.MAX_HTD_ZONES + 1)
+        }
+
+        # counters, for tests and benchmarks to check against
+        self.connections_opened = 0
+        self.commands_received = 0
+        self.responses_dropped = 0
+        self.responses_garbled = 0
+
+        self._random = random.Random(seed)
+        self._server: asyncio.AbstractServer | None = None
+        self._writers: set[asyncio.StreamWriter] = set()
+        self._handlers: set[asyncio.Task] = set()
+        self._device_lock: asyncio.Lock | None = None
+        self._unsolicited_task: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._device_lock = asyncio.Lock()
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+
+        if self.unsolicited_interval:
+            self._unsolicited_task = self._loop.create_task(
+                self._send_unsolicited()
+            )
+
+    async def close(self):
+        if self._unsolicited_task is not None:
+            self._unsolicited_task.cancel()
+            self._unsolicited_task = None
+
+        if self._server is not None:
+            self._server.close()
+
+        for writer in list(self._writers):
+            writer.close()
+
+        # closing the writers ends every connection, let them finish up
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+        if self._server is not None:
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self):
+        await self.start()
+        await self._server.serve_forever()
+
+    # run on a loop of our own in the background, returns the port once
+    # it's listening
+    def start_in_thread(self) -> int:
+        started = threading.Event()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(self.start())
+            started.set()
+            loop.run_forever()
+            loop.run_until_complete(self.close())
+            loop.close()
+
+        self._thread = threading.Thread(
+            target=run, name="htd_simulator", daemon=True
+        )
+        self._thread.start()
+        started.wait()
+
+        return self.port
+
+    def stop_thread(self):
+        if self._thread is None:
+            return
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    # serve the device's end of a PipeTransport. safe to call from any
+    # thread.
+    def attach(self, sock: socket.socket):
+        async def serve():
+            reader, writer = await asyncio.open_connection(sock=sock)
+            await self._handle_connection(reader, writer)
+
+        asyncio.run_coroutine_threadsafe(serve(), self._loop)
+
+    # send a zone's state to every connection, as if it was changed on a
+    # keypad. safe to call from any thread.
+    def push(self, zone: int):
+        self._loop.call_soon_threadsafe(self._push, zone)
+
+    def _push(self, zone: int):
+        chunk = self.get_zone_chunk(zone)
+
+        for writer in list(self._writers):
+            writer.write(chunk)
+
+    async def _send_unsolicited(self):
+        while True:
+            await asyncio.sleep(self.unsolicited_interval)
+            self._push(self._random.randint(1, HtdConstants.MAX_HTD_ZONES))
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        self.connections_opened += 1
+        self._writers.add(writer)
+        self._handlers.add(asyncio.current_task())
+        buffer = bytearray()
+
+        try:
+            while True:
+                data = await reader.read(1024)
+
+                if not data:
+                    break
+
+                buffer += data
+
+                for request in self._take_requests(buffer):
+                    await self._handle_request(request, writer)
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+
+    # every whole request in the buffer, skipping anything that isn't one
+    @staticmethod
+    def _take_requests(buffer: bytearray) -> [bytes]:
+        requests = []
+
+        while len(buffer) >= REQUEST_SIZE:
+            request = bytes(buffer[:REQUEST_SIZE])
+
+            if (
+                request[0] != HtdConstants.HEADER_BIT
+                or request[1] != HtdConstants.RESERVED_BYTE
+                or calculate_checksum(request[:-1]) & 0xFF != request[-1]
+            ):
+                del buffer[0]
+                continue
+
+            del buffer[:REQUEST_SIZE]
+            requests.append(request)
+
+        return requests
+
+    async def _handle_request(
+        self, request: bytes, writer: asyncio.StreamWriter
+    ):
+        _, _, zone, command, data_code, _ = request
+
+        async with self._device_lock:
+            self.commands_received += 1
+            response = self.handle_command(zone, command, data_code)
+
+            if response is None:
+                return
+
+            delay = self.latency + self._random.uniform(0, self.jitter)
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if self._random.random() < self.drop_rate:
+                self.responses_dropped += 1
+                return
+
+            if self._random.random() < self.garble_rate:
+                self.responses_garbled += 1
+                response = bytearray(response)
+                response[self._random.randrange(len(response))] ^= 0xFF
+                response = bytes(response)
+
+            await self._write(writer, response)
+
+    async def _write(self, writer: asyncio.StreamWriter, response: bytes):
+        size = self.fragment_size or len(response)
+
+        for start in range(0, len(response), size):
+            writer.write(response[start: start + size])
+            await writer.drain()
+
+            # give each piece the chance to arrive in a read of its own
+            if start + size < len(response):
+                await asyncio.sleep(0.001)
+
+    # change the zone the way the device would and return the response, or
+    # None for anything the device doesn't answer
+    def handle_command(
+        self, zone: int, command: int, data_code: int
+    ) -> bytes | None:
+        if zone not in self.zones:
+            return None
+
+        if command == HtdConstants.MODEL_QUERY_COMMAND_CODE:
+            return MODEL_INFO
+
+        if command == HtdConstants.SET_COMMAND_CODE:
+            self._set(zone, data_code)
+        elif command != HtdConstants.QUERY_COMMAND_CODE:
+            return None
+
+        return self.get_echo_chunk(zone, command, data_code) + (
+            self.get_zone_chunk(zone)
+        )
+
+    def _set(self, zone: int, data_code: int):
+        zone_info = self.zones[zone]
+
+        if data_code == HtdConstants.POWER_ON_ZONE_COMMAND:
+            zone_info.power = True
+        elif data_code == HtdConstants.POWER_OFF_ZONE_COMMAND:
+            zone_info.power = False
+        elif data_code in (
+            HtdConstants.POWER_ON_ALL_ZONES_COMMAND,
+            HtdConstants.POWER_OFF_ALL_ZONES_COMMAND,
+        ):
+            for other in self.zones.values():
+                other.power = (
+                    data_code == HtdConstants.POWER_ON_ALL_ZONES_COMMAND
+                )
+        elif data_code == HtdConstants.TOGGLE_MUTE_COMMAND:
+            zone_info.mute = not zone_info.mute
+        elif data_code == HtdConstants.VOLUME_UP_COMMAND:
+            zone_info.htd_volume = min(
+                HtdConstants.MAX_HTD_VOLUME, zone_info.htd_volume + 1
+            )
+        elif data_code == HtdConstants.VOLUME_DOWN_COMMAND:
+            zone_info.htd_volume = max(0, zone_info.htd_volume - 1)
+        elif data_code == HtdConstants.BASE_UP_COMMAND:
+            zone_info.bass = min(HtdConstants.MAX_HTD_TONE, zone_info.bass + 1)
+        elif data_code == HtdConstants.BASE_DOWN_COMMAND:
+            zone_info.bass = max(
+                -HtdConstants.MAX_HTD_TONE, zone_info.bass - 1
+            )
+        elif data_code == HtdConstants.TREBLE_UP_COMMAND:
+            zone_info.treble = min(
+                HtdConstants.MAX_HTD_TONE, zone_info.treble + 1
+            )
+        elif data_code == HtdConstants.TREBLE_DOWN_COMMAND:
+            zone_info.treble = max(
+                -HtdConstants.MAX_HTD_TONE, zone_info.treble - 1
+            )
+        elif data_code == HtdConstants.BALANCE_RIGHT_COMMAND:
+            zone_info.balance = min(
+                HtdConstants.MAX_HTD_BALANCE, zone_info.balance + 1
+            )
+        elif data_code == HtdConstants.BALANCE_LEFT_COMMAND:
+            zone_info.balance = max(
+                -HtdConstants.MAX_HTD_BALANCE, zone_info.balance - 1
+            )
+        elif 1 <= data_code - 2 <= HtdConstants.MAX_HTD_ZONES:
+            # I have no idea why this is offset by 2
+            zone_info.source = data_code - 2
+
+    # the chunk the device sends ahead of the zone, which parse_message
+    # always throws away
+    @staticmethod
+    def get_echo_chunk(zone: int, command: int, data_code: int) -> bytes:
+        return get_chunk(
+            [
+                zone,
+                ECHO_CHUNK_MARKER,
+                command,
+                data_code,
+                0,
+                0,
+                0,
+                0,
+                0,
+                0,
+                0,
+            ]
+        )
+
+    # the zone chunk parse_zone reads, built from the zone's state
+    def get_zone_chunk(self, zone: int) -> bytes:
+        zone_info = self.zones[zone]
+        state_toggles = (
+            (POWER_FLAG if zone_info.power else 0)
+            | (MUTE_FLAG if zone_info.mute else 0)
+            | (MODE_FLAG if zone_info.mode else 0)
+            | (PARTY_FLAG if zone_info.party else 0)
+        )
+
+        # max volume wraps around to 0, see convert_volume
+        raw_volume = (
+            zone_info.htd_volume + HtdConstants.VOLUME_OFFSET
+        ) & 0xFF
+
+        return get_chunk(
+            [
+                zone,
+                ZONE_CHUNK_MARKER,
+                state_toggles,
+                0,
+                0,
+                0,
+                zone_info.source - 1,
+                raw_volume,
+                zone_info.treble & 0xFF,
+                zone_info.bass & 0xFF,
+                zone_info.balance & 0xFF,
+            ]
+        )
+
+
+# a 14 byte chunk, the header and reserved byte, then the body, then the
+# checksum
+def get_chunk(body: [int]) -> bytes:
+    chunk = bytearray(
+        [HtdConstants.HEADER_BIT, HtdConstants.RESERVED_BYTE, *body]
+    )
+    chunk.append(calculate_checksum(chunk) & 0xFF)
+    return bytes(chunk)
+
+
+# python -m htd_mc_client.simulator, from custom_components/htd_mc
+def main():
+    parser = argparse.ArgumentParser(
+        description="a stand-in for an HTD MCA-66 gateway"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, default=HtdConstants.DEFAULT_HTD_MC_PORT
+    )
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--fragment-size", type=int, default=None)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--garble-rate", type=float, default=0.0)
+    parser.add_argument("--unsolicited-interval", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    simulator = HtdSimulator(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        fragment_size=args.fragment_size,
+        drop_rate=args.drop_rate,
+        garble_rate=args.garble_rate,
+        unsolicited_interval=args.unsolicited_interval,
+        seed=args.seed,
+    )
+
+    _LOGGER.info("listening on %s:%d" % (args.host, args.port))
+
+    try:
+        asyncio.run(simulator.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import asyncio
+import socket
+
+from .constants import HtdConstants
+
+MAX_BYTES_TO_RECEIVE = 2 ** 10  # 1024
+
+
+# how we reach the device. the connections only ever need a stream of bytes
+# both ways, so all a transport does is open one, as a socket like object
+# for HtdConnection, with settimeout, sendall, recv, fileno and close, or a
+# StreamReader and StreamWriter for AsyncHtdConnection. everything on top,
+# the commands, the FrameDecoder and the pacing, is the same whichever way
+# the bytes go. each transport knows how much to read at once, and how
+# short the delay between commands can get over it.
+class Transport:
+    read_size: int = MAX_BYTES_TO_RECEIVE
+    min_command_delay: int = HtdConstants.MIN_COMMAND_DELAY
+
+    def open(self, timeout: float):
+        raise NotImplementedError()
+
+    async def open_async(
+        self,
+    ) -> (asyncio.StreamReader, asyncio.StreamWriter):
+        raise NotImplementedError()
+
+
+# the IP gateway, or a serial to network bridge like ser2net, over tcp
+class TcpTransport(Transport):
+    host: str = None
+    port: int = None
+
+    def __init__(
+        self, host: str, port: int = HtdConstants.DEFAULT_HTD_MC_PORT
+    ):
+        self.host = host
+        self.port = port
+
+    def open(self, timeout: float) -> socket.socket:
+        connection = socket.create_connection(
+            (self.host, self.port), timeout=timeout
+        )
+        self._tune(connection)
+        return connection
+
+    async def open_async(
+        self,
+    ) -> (asyncio.StreamReader, asyncio.StreamWriter):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        sock = writer.get_extra_info("socket")
+
+        if sock is not None:
+            self._tune(sock)
+
+        return reader, writer
+
+    # the commands are tiny, so send them straight away instead of waiting
+    # to fill a packet, and notice when the gateway has gone away
+    @staticmethod
+    def _tune(connection: socket.socket):
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def __str__(self):
+        return "%s:%d" % (self.host, self.port)
+
+
+# the device's own RS-232 port, through a USB serial adapter, which skips
+# the gateway and the time it adds to every answer. device is anything
+# pyserial can open, a path like /dev/ttyUSB0, or a url like
+# rfc2217://host:port. an answer is 2 chunks, so that's what we read at a
+# time, and the serial port never has to wait for more than one answer.
+class SerialTransport(Transport):
+    device: str = None
+    baudrate: int = None
+
+    read_size = (
+        HtdConstants.RESPONSE_CHUNK_COUNT * HtdConstants.MESSAGE_CHUNK_SIZE
+    )
+    min_command_delay = HtdConstants.SERIAL_MIN_COMMAND_DELAY
+
+    def __init__(
+        self,
+        device: str,
+        baudrate: int = HtdConstants.DEFAULT_SERIAL_BAUDRATE,
+    ):
+        self.device = device
+        self.baudrate = baudrate
+
+    def open(self, timeout: float) -> "SerialStream":
+        import serial
+
+        try:
+            port = serial.serial_for_url(
+                self.device, baudrate=self.baudrate, timeout=timeout
+            )
+        except serial.SerialException as e:
+            raise ConnectionError(str(e)) from e
+
+        return SerialStream(port)
+
+    async def open_async(
+        self,
+    ) -> (asyncio.StreamReader, asyncio.StreamWriter):
+        try:
+            import serial_asyncio_fast as serial_asyncio
+        except ImportError:
+            import serial_asyncio
+
+        import serial
+
+        try:
+            return await serial_asyncio.open_serial_connection(
+                url=self.device, baudrate=self.baudrate
+            )
+        except serial.SerialException as e:
+            raise ConnectionError(str(e)) from e
+
+    def __str__(self):
+        return self.device
+
+
+# a pyserial port that passes for a socket, so HtdConnection doesn't need
+# to know the difference. a read waits for the first byte, then takes
+# whatever else has already arrived, the way a socket's recv does.
+class SerialStream:
+    def __init__(self, port):
+        self._port = port
+
+    def settimeout(self, timeout: float):
+        self._port.timeout = timeout
+
+    def sendall(self, data: bytes):
+        self._port.write(data)
+        self._port.flush()
+
+    def recv(self, size: int) -> bytes:
+        data = self._port.read(1)
+
+        if not data:
+            raise TimeoutError("timed out")
+
+        waiting = min(self._port.in_waiting, size - 1)
+
+        if waiting > 0:
+            data += self._port.read(waiting)
+
+        return data
+
+    def fileno(self) -> int:
+        return self._port.fileno()
+
+    def close(self):
+        self._port.close()
+
+
+# both ends of a socketpair, for running the clients against something in
+# the same process, like the simulator, without a network in between. every
+# time the connection opens, on_connect is given the device's end.
+class PipeTransport(Transport):
+    min_command_delay = 0
+
+    def __init__(self, on_connect):
+        self.on_connect = on_connect
+
+    def open(self, timeout: float) -> socket.socket:
+        connection, device = socket.socketpair()
+        connection.settimeout(timeout)
+        self.on_connect(device)
+        return connection
+
+    async def open_async(
+        self,
+    ) -> (asyncio.StreamReader, asyncio.StreamWriter):
+        connection, device = socket.socketpair()
+        self.on_connect(device)
+        return await asyncio.open_connection(sock=connection)
+
+    def __str__(self):
+        return "pipe"
@@ -1,4 +1,7 @@
+import struct
+
 from .constants import HtdConstants
+from .decoder import FrameDecoder
 from .models import ZoneDetail
 
 
@@ -36,6 +39,13 @@ def convert_volume(raw_volume: int) -> (int, int):
     return fixed, htd_volume
 
 
+# the other way around, turn a volume between 0 - 100 into the device's own
+# scale of 0 - 60, which is what each volume up/down step moves by.
+def convert_to_htd_volume(volume: float) -> int:
+    htd_volume = round(volume / 100 * HtdConstants.MAX_HTD_VOLUME)
+    return max(0, min(HtdConstants.MAX_HTD_VOLUME, htd_volume))
+
+
 # the checksum is the last digit on the entire command,
 # it's the sum of all the bytes the other bytes.
 def calculate_checksum(message) -> int:
@@ -45,88 +55,101 @@ def calculate_checksum(message) -> int:
     return cs
 
 
-# helper method to check the state toggle index is on.
-def is_bit_on(toggles: str, index: int) -> bool:
-    return toggles[index] == "1"
-
-
-# helper method to validate the source is not outside the range
-def validate_source(source: int):
-    if source not in range(1, HtdConstants.MAX_HTD_ZONES + 1):
-        raise "source %s is invalid" % source
-
-
-# helper method to validate the zone is not outside the range
-def validate_zone(zone: int):
-    if zone not in range(1, HtdConstants.MAX_HTD_ZONES + 1):
-        raise "zone %s is invalid" % zone
+# helper method to validate the source is not outside the range, which is
+# the device's own source count when we know it
+def validate_source(
+    source: int, source_count: int = HtdConstants.MAX_HTD_ZONES
+):
+    if not 1 <= source <= source_count:
+        raise ValueError("source %s is invalid" % source)
+
+
+# helper method to validate the zone is not outside the range, which is the
+# device's own zone count when we know it
+def validate_zone(zone: int, zone_count: int = HtdConstants.MAX_HTD_ZONES):
+    if not 1 <= zone <= zone_count:
+        raise ValueError("zone %s is invalid" % zone)
+
+
+# the layout of a zone chunk, 14 bytes. we don't know what bytes 5 - 7 are
+# for, and the last byte is the checksum, so those are skipped. treble, bass
+# and balance go below zero, so they're signed.
+ZONE_DATA = struct.Struct(
+    "B"  # header
+    "B"  # reserved
+    "B"  # zone number
+    "B"  # always 0x05 for a zone chunk
+    "B"  # state toggles
+    "3x"
+    "B"  # source
+    "B"  # volume
+    "b"  # treble
+    "b"  # bass
+    "b"  # balance
+    "x"
+)
 
 
 # this will take a single message chunk of 14 bytes and parse this into
-# a usable ZoneDetail model to read the state.
+# a usable ZoneDetail model to read the state. the chunk is read straight
+# out of data at offset, so a whole buffer of chunks can be parsed without
+# copying each one out first.
 # all credit for this new parser goes to lounsbrough
-def parse_zone(zone_data: bytes) -> ZoneDetail | None:
+def parse_zone(zone_data: bytes, offset: int = 0) -> ZoneDetail | None:
+    (
+        header,
+        reserved,
+        zone_number,
+        marker,
+        raw_state_toggles,
+        raw_source,
+        raw_volume,
+        treble,
+        bass,
+        balance,
+    ) = ZONE_DATA.unpack_from(zone_data, offset)
+
     if (
-        zone_data[0] != HtdConstants.HEADER_BIT
-        and zone_data[1] != HtdConstants.RESERVED_BYTE
+        header != HtdConstants.HEADER_BIT
+        and reserved != HtdConstants.RESERVED_BYTE
     ):
         return None
 
     # I think this is some kind of verification, it has been right so far.
-    if zone_data[3] != 0x05:
+    if marker != 0x05:
         return None
 
     # the 4th position represent the toggles for power, mute, mode and party,
-    state_toggles = get_state_toggles(
-        zone_data[HtdConstants.STATE_TOGGLES_ZONE_DATA_INDEX]
-    )
-
-    volume, htd_volume = convert_volume(
-        zone_data[HtdConstants.VOLUME_ZONE_DATA_INDEX]
-    )
-
-    zone_number = zone_data[HtdConstants.ZONE_NUMBER_ZONE_DATA_INDEX]
-
-    zone = ZoneDetail(zone_number)
-
-    zone.number = zone_number
-    zone.power = is_bit_on(
-        state_toggles,
-        HtdConstants.POWER_STATE_TOGGLE_INDEX
-    )
-    zone.mute = is_bit_on(state_toggles, HtdConstants.MUTE_STATE_TOGGLE_INDEX)
-    zone.mode = is_bit_on(state_toggles, HtdConstants.MODE_STATE_TOGGLE_INDEX)
-    zone.party = is_bit_on(
-        state_toggles,
-        HtdConstants.PARTY_MODE_STATE_TOGGLE_INDEX
+    power, mute, mode, party = STATE_TOGGLES[raw_state_toggles]
+    volume, htd_volume = VOLUMES[raw_volume]
+
+    return ZoneDetail(
+        zone_number,
+        power,
+        mute,
+        mode,
+        party,
+        raw_source + 1,
+        volume,
+        htd_volume,
+        treble,
+        bass,
+        balance,
     )
-    zone.source = zone_data[HtdConstants.SOURCE_ZONE_DATA_INDEX] + 1
-    zone.volume = volume
-    zone.htd_volume = htd_volume
-    zone.treble = zone_data[HtdConstants.TREBLE_ZONE_DATA_INDEX]
-    zone.bass = zone_data[HtdConstants.BASS_ZONE_DATA_INDEX]
-    zone.balance = zone_data[HtdConstants.BALANCE_ZONE_DATA_INDEX]
-
-    return zone
 
 
 # the handler method to take the entire response from the controller and parse
 # each zone. it was believed that the controller can respond with multiple
 # zones. in my testing this has never been the case. the device will always
 # send 28 bytes (2 chunks), the first chunk is always invalidated by some
-# check, the second is zone info we requested.
+# check, the second is zone info we requested. the FrameDecoder finds where
+# each chunk starts, so a response that doesn't start on a chunk boundary
+# still parses.
 def parse_message(zone: int, data: bytes) -> ZoneDetail | None:
-    position = 0
-    while position < len(data):
-        # each chunk represents a different zone that should be 14 bytes long,
-        zone_data = data[position: position + HtdConstants.MESSAGE_CHUNK_SIZE]
-        position += HtdConstants.MESSAGE_CHUNK_SIZE
-
-        # if the zone data we got is less than the exp
-        if len(zone_data) < HtdConstants.MESSAGE_CHUNK_SIZE:
-            break
+    data, offsets = FrameDecoder().feed_offsets(data)
 
-        zone_info = parse_zone(zone_data)
+    for offset in offsets:
+        zone_info = parse_zone(data, offset)
 
         # if a valid zone was found, we're done
         if zone_info is not None and zone_info.number == zone:
@@ -135,19 +158,42 @@ def parse_message(zone: int, data: bytes) -> ZoneDetail | None:
     return None
 
 
-# helper method to convert the integer number for the state values into a
-# binary string, so we can check the state of each individual toggle.
-def get_state_toggles(raw_value: int) -> str:
-    # the state toggles value needs to be interpreted in binary,
-    # each bit represents a new flag.
-    state_toggles = bin(raw_value)
+# the same walk as parse_message, but keeps every valid zone it finds. when
+# several zones are queried at once, their replies come back one after the
+# other in the same stream, so this returns them keyed by zone number. if a
+# zone shows up more than once, the last one wins since it's the newest.
+def parse_all_zones(data: bytes) -> dict[int, ZoneDetail]:
+    zones = {}
+    data, offsets = FrameDecoder().feed_offsets(data)
+
+    for offset in offsets:
+        zone_info = parse_zone(data, offset)
 
-    # when converting to binary, python will prepend '0b',
-    # so substring starting at 2
-    state_toggles = state_toggles[2:]
+        if zone_info is not None:
+            zones[zone_info.number] = zone_info
+
+    return zones
+
+
+# the state toggles are all stored in one byte, each bit being a flag. the
+# flags are read from the highest bit down, so with 4 bits, power is 0b1000
+# and party is 0b0001. if the value has more than 4 bits, the flags start at
+# its highest set bit instead. returns power, mute, mode and party.
+def get_state_toggles(raw_value: int) -> (bool, bool, bool, bool):
+    width = max(raw_value.bit_length(), 4)
+
+    def is_bit_on(index: int) -> bool:
+        return raw_value & (1 << (width - 1 - index)) != 0
+
+    return (
+        is_bit_on(HtdConstants.POWER_STATE_TOGGLE_INDEX),
+        is_bit_on(HtdConstants.MUTE_STATE_TOGGLE_INDEX),
+        is_bit_on(HtdConstants.MODE_STATE_TOGGLE_INDEX),
+        is_bit_on(HtdConstants.PARTY_MODE_STATE_TOGGLE_INDEX),
+    )
 
-    # each of the 4 bits as 1 represent that the toggle is set to on,
-    # if it's less than 4 digits, we fill with zeros
-    state_toggles = state_toggles.zfill(4)
 
-    return state_toggles
+# every byte the device can send for the state toggles and the volume,
+# worked out once, so parsing a zone is just a couple of lookups
+STATE_TOGGLES = tuple(get_state_toggles(raw) for raw in range(256))
+VOLUMES = tuple(convert_volume(raw) for raw in range(256))
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+
+from .constants import HtdConstants
+from .models import ZoneDetail
+from .utils import convert_to_htd_volume
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# changes a zone's volume for something like a slider, which sends a new
+# volume many times a second while it's being dragged. only the latest
+# volume matters, so every new one just replaces the target. a single ramp
+# task per zone steps towards the target, picking up a new one between
+# steps, so dragging back and forth never starts a second ramp. the first
+# volume waits debounce seconds before the ramp starts, so a drag that's
+# already underway doesn't send a step for every value it passes through.
+# while the ramp runs, on_update is given our best guess of the zone at
+# most once every update_interval seconds, and once more with the result.
+class VolumeController:
+    zone: int = None
+    debounce: float = None
+    update_interval: float = None
+
+    def __init__(
+        self,
+        client,
+        zone: int,
+        on_update=None,
+        debounce: float = HtdConstants.VOLUME_DEBOUNCE,
+        update_interval: float = HtdConstants.VOLUME_UPDATE_INTERVAL,
+    ):
+        self.client = client
+        self.zone = zone
+        self.on_update = on_update
+        self.debounce = debounce
+        self.update_interval = update_interval
+
+        self._target: int | None = None
+        self._task: asyncio.Task | None = None
+        self._last_update = 0.0
+
+    @property
+    def changing(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    # head for volume, between 0 and 100, and wait for the zone to get
+    # there, or for wherever a later volume took it instead
+    async def set_volume(self, volume: int) -> ZoneDetail | None:
+        self._target = volume
+
+        if not self.changing:
+            self._task = asyncio.get_running_loop().create_task(
+                self._ramp()
+            )
+        else:
+            _LOGGER.debug(
+                "changing desired volume for zone %d to %d"
+                % (self.zone, volume)
+            )
+
+        # a caller giving up shouldn't stop the ramp for everyone else
+        return await asyncio.shield(self._task)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _ramp(self) -> ZoneDetail | None:
+        await asyncio.sleep(self.debounce)
+
+        # a new target can land between the last step and the ramp
+        # finishing, so keep going until the zone is at the latest one, or
+        # stops getting any closer to it
+        previous = None
+
+        while True:
+            zone_info = await self._apply(self._target)
+
+            if (
+                zone_info is None
+                or zone_info.htd_volume == convert_to_htd_volume(self._target)
+                or zone_info.htd_volume == previous
+            ):
+                break
+
+            previous = zone_info.htd_volume
+
+        if zone_info is not None:
+            self._notify(zone_info)
+
+        return zone_info
+
+    async def _apply(self, volume: int) -> ZoneDetail | None:
+        return await self.client.set_volume(
+            self.zone, volume, self._on_increment
+        )
+
+    def _on_increment(self, volume: int, zone_info: ZoneDetail) -> int | None:
+        now = time.monotonic()
+
+        if now - self._last_update >= self.update_interval:
+            self._last_update = now
+            self._notify(zone_info)
+
+        if self._target != volume:
+            return self._target
+
+        return None
+
+    def _notify(self, zone_info: ZoneDetail):
+        if self.on_update is None:
+            return
+
+        try:
+            self.on_update(zone_info)
+        except Exception:
+            _LOGGER.exception(
+                "error updating volume for zone %d" % self.zone
+            )
+
+
+# the same for a group of zones, keeping one per group. each pass takes the
+# whole group to the target as one scene, see apply_group, and zone is the
+# member whose answer tells us where the group ended up. a target that
+# changes while a pass is underway is picked up by the next one.
+class GroupVolumeController(VolumeController):
+    async def _apply(self, volume: int) -> ZoneDetail | None:
+        zone_infos = await self.client.apply_group(self.zone, volume=volume)
+        return zone_infos.get(self.zone)
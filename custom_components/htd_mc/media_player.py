@@ -1,15 +1,22 @@
 """Support for HTD MC Series"""
 
+import copy
 import logging
 
+import voluptuous as vol
 from homeassistant.components.media_player import MediaPlayerEntity
 from homeassistant.components.media_player.const import MediaPlayerEntityFeature
 from homeassistant.const import STATE_OFF, STATE_ON, STATE_UNKNOWN
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers import entity_platform
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
 
 from . import DOMAIN
-from .htd_mc_client.client import HtdMcClient
+from .coordinator import HtdCoordinator
+from .htd_mc_client.async_client import AsyncHtdMcClient
+from .htd_mc_client.constants import HtdConstants
 from .htd_mc_client.models import ZoneDetail
+from .htd_mc_client.volume import GroupVolumeController, VolumeController
 
 MEDIA_PLAYER_PREFIX = "media_player.htd_mc_zone"
 
@@ -20,48 +27,129 @@ SUPPORT_HTD_MC = (
     | MediaPlayerEntityFeature.VOLUME_MUTE
     | MediaPlayerEntityFeature.VOLUME_SET
     | MediaPlayerEntityFeature.VOLUME_STEP
+    | MediaPlayerEntityFeature.GROUPING
 )
 
-_LOGGER = logging.getLogger(__name__)
+SERVICE_SET_BASS = "set_bass"
+SERVICE_SET_TREBLE = "set_treble"
+SERVICE_SET_BALANCE = "set_balance"
 
+ATTR_BASS = "bass"
+ATTR_TREBLE = "treble"
+ATTR_BALANCE = "balance"
 
-def setup_platform(hass: HomeAssistant, config, add_entities, discovery_info=None):
-    htd_configs = hass.data[DOMAIN]
-    entities = []
+TONE_RANGE = vol.All(
+    vol.Coerce(int),
+    vol.Range(min=-HtdConstants.MAX_HTD_TONE, max=HtdConstants.MAX_HTD_TONE),
+)
 
-    for device_index in range(len(htd_configs)):
-        config = htd_configs[device_index]
-        zones = config["zones"]
-        client = config["client"]
+BALANCE_RANGE = vol.All(
+    vol.Coerce(int),
+    vol.Range(
+        min=-HtdConstants.MAX_HTD_BALANCE, max=HtdConstants.MAX_HTD_BALANCE
+    ),
+)
+
+_LOGGER = logging.getLogger(__name__)
 
-        for zone_index in range(len(zones)):
-            entity = HtdDevice(device_index, zone_index + 1, client, config)
-            entities.append(entity)
 
-    add_entities(entities)
+async def async_setup_platform(
+    hass: HomeAssistant, config, async_add_entities, discovery_info=None
+):
+    htd_configs = hass.data[DOMAIN]
 
+    # every gateway is set up in the background, at the same time, so a
+    # slow or offline one doesn't hold up startup or the others.
+    for device_index in range(len(htd_configs)):
+        hass.async_create_background_task(
+            async_setup_gateway(
+                device_index, htd_configs[device_index], async_add_entities
+            ),
+            "htd_mc_%d setup" % device_index,
+        )
 
-class HtdDevice(MediaPlayerEntity):
+    platform = entity_platform.async_get_current_platform()
+    platform.async_register_entity_service(
+        SERVICE_SET_BASS,
+        {vol.Required(ATTR_BASS): TONE_RANGE},
+        "async_set_bass",
+    )
+    platform.async_register_entity_service(
+        SERVICE_SET_TREBLE,
+        {vol.Required(ATTR_TREBLE): TONE_RANGE},
+        "async_set_treble",
+    )
+    platform.async_register_entity_service(
+        SERVICE_SET_BALANCE,
+        {vol.Required(ATTR_BALANCE): BALANCE_RANGE},
+        "async_set_balance",
+    )
+
+
+# only the first zone_count zones are wired up, so those are the only ones
+# we create and poll. the zones show up straight away, and are unavailable
+# until the first refresh has answered.
+async def async_setup_gateway(device_index, config, async_add_entities):
+    client = config["client"]
+    coordinator = config["coordinator"]
+    capabilities = client.set_capabilities(
+        client.capabilities.limit_zones(config["zone_count"])
+    )
+
+    coordinator.zones = capabilities.zones
+    del config["zones"][capabilities.zone_count:]
+
+    entities = [
+        HtdDevice(coordinator, device_index, zone, client, config)
+        for zone in capabilities.zones
+    ]
+    config["entities"].extend(entities)
+    async_add_entities(entities)
+
+    await coordinator.async_refresh()
+
+
+class HtdDevice(CoordinatorEntity[HtdCoordinator], MediaPlayerEntity):
     device_instance_id: int = None
-    client: HtdMcClient = None
+    client: AsyncHtdMcClient = None
     sources: [str] = None
     zone: int = None
-    changing_volume: int | None = None
+    volume_controller: VolumeController = None
     zone_info: ZoneDetail = None
+    optimistic: bool = None
+
+    # every zone entity on the same gateway, for grouping
+    entities: list = None
+
+    # the volume controller for each group on the gateway, keyed by its
+    # zones, shared by every entity in it
+    group_volume_controllers: dict = None
 
-    def __init__(self, device_instance_id, zone, client, config):
+    # the fields we've changed ahead of the device telling us so, laid over
+    # whatever the coordinator hands us until the command is answered
+    pending: dict = None
+
+    def __init__(self, coordinator, device_instance_id, zone, client, config):
+        super().__init__(coordinator)
         self.device_instance_id = device_instance_id
         self.zone = zone
         self.client = client
         self.sources = config["sources"]
         self.update_volume_on_change = config["update_volume_on_change"]
+        self.optimistic = config["optimistic"]
+        self.entities = config["entities"]
+        self.group_volume_controllers = config["group_volume_controllers"]
+        self.pending = {}
+        self.volume_controller = VolumeController(
+            client, zone, on_update=self._volume_updated
+        )
         # zones are 0 based in the config b/c it's an array
         self.zone_name = config["zones"][zone - 1]
-        self.update()
+        self.zone_info = self._get_coordinator_zone_info()
 
     @property
-    def enabled(self) -> bool:
-        return self.zone_info is not None
+    def available(self) -> bool:
+        return super().available and self.zone_info is not None
 
     @property
     def supported_features(self):
@@ -75,12 +163,79 @@ class HtdDevice(MediaPlayerEntity):
     def name(self):
         return self.zone_name
 
-    def update(self):
-        _LOGGER.debug("starting updating zone %d" % self.zone)
-        self.zone_info = self.client.query_zone(self.zone)
+    def _get_coordinator_zone_info(self) -> ZoneDetail | None:
+        if self.coordinator.data is None:
+            return None
+
+        return self.coordinator.data.get(self.zone)
+
+    # the zone with the changes we're still waiting on applied
+    def _with_pending(
+        self, zone_info: ZoneDetail | None
+    ) -> ZoneDetail | None:
+        if not self.pending or zone_info is None:
+            return zone_info
+
+        zone_info = copy.copy(zone_info)
+
+        for field, value in self.pending.items():
+            setattr(zone_info, field, value)
+
+        return zone_info
+
+    # in optimistic mode, show the change straight away instead of waiting
+    # for the device. the device's reply replaces our guess, and if the
+    # command fails, we go back to the last state the device told us about.
+    # pushed updates that come in while we wait keep our change on top, so
+    # an older state doesn't flicker through.
+    async def _send_command(self, command, **changes):
+        if not self.optimistic or self.zone_info is None:
+            await command
+            return
+
+        self.pending.update(changes)
+        self.zone_info = self._with_pending(self.zone_info)
+        self.async_write_ha_state()
+
+        try:
+            zone_info = await command
+        except Exception:
+            self._clear_pending(changes)
+            self.zone_info = self._with_pending(
+                self._get_coordinator_zone_info()
+            )
+            self.async_write_ha_state()
+            raise
+
+        self._clear_pending(changes)
+
+        if zone_info is None:
+            _LOGGER.warning(
+                "no answer for zone %d, rolling back %s"
+                % (self.zone, changes)
+            )
+            zone_info = self._get_coordinator_zone_info()
+
+        self.zone_info = self._with_pending(zone_info)
+        self.async_write_ha_state()
+
+    # forget the changes a command made, unless a later command has made
+    # its own change to the same field since
+    def _clear_pending(self, changes: dict):
+        for field, value in changes.items():
+            if self.pending.get(field) == value:
+                del self.pending[field]
+
+    @callback
+    def _handle_coordinator_update(self):
+        self.zone_info = self._with_pending(
+            self._get_coordinator_zone_info()
+        )
         _LOGGER.debug(
-            "got new update for Zone %d, zone_info = %s" % (self.zone, self.zone_info)
+            "got new update for Zone %d, zone_info = %s"
+            % (self.zone, self.zone_info)
         )
+        self.async_write_ha_state()
 
     @property
     def state(self):
@@ -90,11 +245,15 @@ class HtdDevice(MediaPlayerEntity):
             return STATE_ON
         return STATE_OFF
 
-    def turn_on(self):
-        self.client.power_on(self.zone)
+    async def async_turn_on(self):
+        await self._send_command(
+            self.client.set_power(self.zone, True), power=True
+        )
 
-    def turn_off(self):
-        self.client.power_off(self.zone)
+    async def async_turn_off(self):
+        await self._send_command(
+            self.client.set_power(self.zone, False), power=False
+        )
 
     @property
     def volume_level(self) -> float:
@@ -102,45 +261,69 @@ class HtdDevice(MediaPlayerEntity):
         # home assistant wants a decimal between 0 and 1.
         return self.zone_info.volume / 100
 
-    def set_volume_level(self, new_volume: float):
-        if self.changing_volume is not None:
-            _LOGGER.info(
-                "changing new desired volume for zone %d to %d"
-                % (self.zone, new_volume)
-            )
-            self.changing_volume = int(new_volume * 100)
+    # every new volume replaces the one the zone is heading for, so a
+    # dragged slider only ever runs a single ramp. a grouped zone takes the
+    # whole group with it, through the group's own controller, so dragging
+    # any member's slider only ever runs a single ramp for the group.
+    async def async_set_volume_level(self, new_volume: float):
+        await self._drop_stale_group_volume_controllers()
+
+        if self.is_grouped:
+            controller = self._get_group_volume_controller()
+            await controller.set_volume(round(new_volume * 100))
             return
 
-        def on_increment(desired: int, zone_info: ZoneDetail) -> int | None:
-            if self.update_volume_on_change:
-                self.zone_info = zone_info
-                self.schedule_update_ha_state()
+        await self.volume_controller.set_volume(round(new_volume * 100))
 
-            _LOGGER.info(
-                "updated zone = %d, desired = %f, current = %f"
-                % (self.zone, desired, self.zone_info.volume)
-            )
+    def _get_group_volume_controller(self) -> GroupVolumeController:
+        zones = tuple(self.client.get_group(self.zone))
+        controller = self.group_volume_controllers.get(zones)
 
-            if desired != self.changing_volume:
-                _LOGGER.info(
-                    "a new volume for zone %d has been chosen, value = %d"
-                    % (self.zone, self.changing_volume)
-                )
-                return self.changing_volume
+        if controller is None:
+            controller = GroupVolumeController(self.client, zones[0])
+            self.group_volume_controllers[zones] = controller
 
-            return None
+        return controller
 
-        self.changing_volume = int(new_volume * 100)
-        self.client.set_volume(self.zone, self.changing_volume, on_increment)
-        self.changing_volume = None
-        self.schedule_update_ha_state()
+    # a group that changed, by joining, unjoining or party mode, leaves its
+    # controller behind under the zones it used to have. close and drop
+    # every controller that doesn't match its group anymore, so a ramp
+    # that's still running can't take the new group with it.
+    async def _drop_stale_group_volume_controllers(self):
+        for zones in list(self.group_volume_controllers):
+            if self.client.get_group(zones[0]) != list(zones):
+                await self.group_volume_controllers.pop(zones).close()
+
+    async def async_will_remove_from_hass(self):
+        await super().async_will_remove_from_hass()
+        await self.volume_controller.close()
+
+        for zones in list(self.group_volume_controllers):
+            if self.zone in zones:
+                await self.group_volume_controllers.pop(zones).close()
+
+    # our best guess of the zone while the volume changes, at most a couple
+    # of times a second
+    @callback
+    def _volume_updated(self, zone_info: ZoneDetail):
+        if not self.update_volume_on_change:
+            return
+
+        self.zone_info = self._with_pending(zone_info)
+        self.async_write_ha_state()
 
     @property
     def is_volume_muted(self) -> bool:
         return self.zone_info.mute
 
-    def mute_volume(self, mute):
-        self.client.toggle_mute(self.zone)
+    async def async_mute_volume(self, mute):
+        if self.is_grouped:
+            await self.client.apply_group(self.zone, mute=mute)
+            return
+
+        await self._send_command(
+            self.client.set_mute(self.zone, mute), mute=mute
+        )
 
     @property
     def source(self) -> int:
@@ -154,9 +337,89 @@ class HtdDevice(MediaPlayerEntity):
     def media_title(self):
         return self.source
 
-    def select_source(self, source: int):
+    async def async_select_source(self, source: int):
         index = self.sources.index(source)
-        self.client.set_source(self.zone, index + 1)
+
+        if self.is_grouped:
+            await self.client.apply_group(self.zone, source=index + 1)
+            return
+
+        await self._send_command(
+            self.client.set_source(self.zone, index + 1), source=index + 1
+        )
+
+    # zones are grouped by joining them here, or by putting them in party
+    # mode on the device. volume, mute and source changes to any zone in a
+    # group go to every zone in it, as a single scene.
+    @property
+    def is_grouped(self) -> bool:
+        return len(self.client.get_group(self.zone)) > 1
+
+    @property
+    def group_members(self) -> list[str] | None:
+        zones = self.client.get_group(self.zone)
+
+        if len(zones) == 1:
+            return None
+
+        entity_ids = {
+            entity.zone: entity.entity_id for entity in self.entities
+        }
+
+        return [entity_ids[zone] for zone in zones if zone in entity_ids]
+
+    async def async_join_players(self, group_members: list[str]):
+        zones = {entity.entity_id: entity.zone for entity in self.entities}
+        ignored = [
+            entity_id for entity_id in group_members if entity_id not in zones
+        ]
+
+        if ignored:
+            _LOGGER.warning(
+                "only zones on the same gateway can be grouped, ignoring %s"
+                % ignored
+            )
+
+        self.client.groups.join(
+            self.zone,
+            [zones[entity_id] for entity_id in group_members
+             if entity_id in zones],
+        )
+        await self._drop_stale_group_volume_controllers()
+        self._write_group_state()
+
+    async def async_unjoin_player(self):
+        self.client.groups.unjoin(self.zone)
+        await self._drop_stale_group_volume_controllers()
+        self._write_group_state()
+
+    # every zone's group_members may have changed, not just ours
+    def _write_group_state(self):
+        for entity in self.entities:
+            if entity.hass is not None:
+                entity.async_write_ha_state()
+
+    @property
+    def extra_state_attributes(self) -> dict | None:
+        if self.zone_info is None:
+            return None
+
+        return {
+            ATTR_BASS: self.zone_info.bass,
+            ATTR_TREBLE: self.zone_info.treble,
+            ATTR_BALANCE: self.zone_info.balance,
+        }
+
+    # the steps for each of these go out as one burst. when several zones
+    # are picked, they all queue up on the gateway's writer together.
+    async def async_set_bass(self, bass: int):
+        await self.client.set_bass(self.zone, bass)
+
+    async def async_set_treble(self, treble: int):
+        await self.client.set_treble(self.zone, treble)
+
+    async def async_set_balance(self, balance: int):
+        await self.client.set_balance(self.zone, balance)
 
     @property
     def icon(self):
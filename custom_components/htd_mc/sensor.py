@@ -0,0 +1,206 @@
+"""Diagnostic sensors for HTD MC Series"""
+
+from datetime import timedelta
+
+from homeassistant.components.sensor import (
+    SensorEntity,
+    SensorStateClass,
+)
+from homeassistant.const import EntityCategory, UnitOfTime
+from homeassistant.core import HomeAssistant
+
+from . import DOMAIN
+from .htd_mc_client.async_client import AsyncHtdMcClient
+
+# the metrics are counted by the client as it goes, so reading them costs
+# nothing, and they don't need to be any fresher than this
+SCAN_INTERVAL = timedelta(seconds=30)
+
+SENSOR_PREFIX = "sensor.htd_mc"
+
+
+def get_round_trip(metrics: dict, percent: int) -> float | None:
+    query = metrics["round_trips"].get("query")
+
+    if query is None:
+        return None
+
+    return query["p%d_ms" % percent]
+
+
+# a few more numbers about the query round trips and how the connection is
+# doing, for the round trip sensors. everything else is in the
+# diagnostics, see diagnostics.py.
+def get_round_trip_attributes(metrics: dict) -> dict:
+    query = metrics["round_trips"].get("query") or {}
+
+    return {
+        "samples": query.get("count", 0),
+        "mean_ms": query.get("mean_ms"),
+        "max_ms": query.get("max_ms"),
+        "p99_ms": query.get("p99_ms"),
+        "smoothed_rtt_ms": metrics["smoothed_rtt_ms"],
+        "bad_response_rate": metrics["bad_response_rate"],
+        "connected": metrics["connected"],
+    }
+
+
+# key, name, unit, state class and how to get the value out of the metrics
+SENSORS = (
+    (
+        "round_trip_p50",
+        "Round trip p50",
+        UnitOfTime.MILLISECONDS,
+        SensorStateClass.MEASUREMENT,
+        lambda metrics: get_round_trip(metrics, 50),
+    ),
+    (
+        "round_trip_p95",
+        "Round trip p95",
+        UnitOfTime.MILLISECONDS,
+        SensorStateClass.MEASUREMENT,
+        lambda metrics: get_round_trip(metrics, 95),
+    ),
+    (
+        "command_delay",
+        "Command delay",
+        UnitOfTime.MILLISECONDS,
+        SensorStateClass.MEASUREMENT,
+        lambda metrics: metrics["command_delay_ms"],
+    ),
+    (
+        "response_timeout",
+        "Response timeout",
+        UnitOfTime.MILLISECONDS,
+        SensorStateClass.MEASUREMENT,
+        lambda metrics: metrics["response_timeout_ms"],
+    ),
+    (
+        "pacing_time",
+        "Pacing time",
+        UnitOfTime.SECONDS,
+        SensorStateClass.TOTAL_INCREASING,
+        lambda metrics: metrics["pacing_time_s"],
+    ),
+    (
+        "queue_depth",
+        "Queue depth",
+        None,
+        SensorStateClass.MEASUREMENT,
+        lambda metrics: metrics["queue_depth"],
+    ),
+    (
+        "commands",
+        "Commands",
+        None,
+        SensorStateClass.TOTAL_INCREASING,
+        lambda metrics: metrics["commands"],
+    ),
+    (
+        "retries",
+        "Retries",
+        None,
+        SensorStateClass.TOTAL_INCREASING,
+        lambda metrics: metrics["retries"],
+    ),
+    (
+        "timeouts",
+        "Timeouts",
+        None,
+        SensorStateClass.TOTAL_INCREASING,
+        lambda metrics: metrics["timeouts"],
+    ),
+    (
+        "bad_responses",
+        "Bad responses",
+        None,
+        SensorStateClass.TOTAL_INCREASING,
+        lambda metrics: metrics["bad_responses"],
+    ),
+    (
+        "bad_frames",
+        "Bad frames",
+        None,
+        SensorStateClass.TOTAL_INCREASING,
+        lambda metrics: metrics["bad_frames"],
+    ),
+    (
+        "connections_opened",
+        "Connections opened",
+        None,
+        SensorStateClass.TOTAL_INCREASING,
+        lambda metrics: metrics["connections_opened"],
+    ),
+)
+
+
+async def async_setup_platform(
+    hass: HomeAssistant, config, async_add_entities, discovery_info=None
+):
+    htd_configs = hass.data[DOMAIN]
+    entities = []
+
+    for device_index in range(len(htd_configs)):
+        client = htd_configs[device_index]["client"]
+
+        for sensor in SENSORS:
+            entities.append(HtdMetricSensor(device_index, client, *sensor))
+
+    async_add_entities(entities)
+
+
+# one of the client's metrics, as a diagnostic sensor for the gateway. the
+# round trip sensors also carry a few more numbers about the round trips
+# as attributes. they change with every poll, so they're left out of the
+# recorder, all but whether we're connected.
+class HtdMetricSensor(SensorEntity):
+    device_instance_id: int = None
+    client: AsyncHtdMcClient = None
+    key: str = None
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_should_poll = True
+    _unrecorded_attributes = frozenset(
+        {
+            "samples",
+            "mean_ms",
+            "max_ms",
+            "p99_ms",
+            "smoothed_rtt_ms",
+            "bad_response_rate",
+        }
+    )
+
+    def __init__(
+        self,
+        device_instance_id: int,
+        client: AsyncHtdMcClient,
+        key: str,
+        name: str,
+        unit: str | None,
+        state_class: SensorStateClass,
+        get_value,
+    ):
+        self.device_instance_id = device_instance_id
+        self.client = client
+        self.key = key
+        self.get_value = get_value
+
+        self._attr_name = "%s %s" % (client.ip_address, name)
+        self._attr_native_unit_of_measurement = unit
+        self._attr_state_class = state_class
+
+    @property
+    def unique_id(self):
+        return f"{SENSOR_PREFIX}_{self.device_instance_id}_{self.key}"
+
+    @property
+    def native_value(self):
+        return self.get_value(self.client.get_metrics())
+
+    @property
+    def extra_state_attributes(self) -> dict | None:
+        if not self.key.startswith("round_trip"):
+            return None
+
+        return get_round_trip_attributes(self.client.get_metrics())
@@ -0,0 +1,13 @@
+import os
+import sys
+
+# the client has no home assistant imports, so it's tested on its own, the
+# same way it's imported from custom_components/htd_mc
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "custom_components",
+        "htd_mc",
+    ),
+)
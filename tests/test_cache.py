@@ -0,0 +1,95 @@
+import time
+
+from htd_mc_client.cache import ZoneCache
+from htd_mc_client.client import HtdMcClient
+from htd_mc_client.constants import HtdConstants
+from htd_mc_client.models import ZoneDetail
+from htd_mc_client.simulator import HtdSimulator
+from htd_mc_client.transport import PipeTransport
+
+SET = HtdConstants.SET_COMMAND_CODE
+
+
+def test_zone_is_only_served_for_ttl_seconds():
+    cache = ZoneCache(ttl=0.05)
+    cache.update(ZoneDetail(1, power=True))
+
+    assert cache.get(1).power is True
+    assert cache.get(2) is None
+
+    time.sleep(0.06)
+
+    assert cache.get(1) is None
+    # still known, just too old to serve
+    assert cache.known[1].power is True
+    assert cache.age(1) > 0.05
+
+
+def test_command_only_invalidates_the_fields_it_changes():
+    cache = ZoneCache()
+    cache.update(ZoneDetail(1, power=True, source=1, volume=20))
+
+    cache.invalidate(1, SET, 4)  # source 2
+
+    assert cache.is_changing(1)
+    assert cache.get(1) is None
+    assert cache.get(1, ["source"]) is None
+    assert cache.get(1, ["volume", "power"]).volume == 20
+
+    cache.invalidate(1, SET, HtdConstants.VOLUME_UP_COMMAND)
+    assert cache.get(1, ["htd_volume"]) is None
+
+    # hearing about the zone again makes every field fresh
+    cache.update(ZoneDetail(1, power=True, source=2, volume=22))
+    assert not cache.is_changing(1)
+    assert cache.get(1).source == 2
+
+
+def test_all_zones_commands_invalidate_every_zone():
+    cache = ZoneCache(zone_count=3)
+
+    for zone in range(1, 4):
+        cache.update(ZoneDetail(zone, power=False, mute=False))
+
+    cache.invalidate(1, SET, HtdConstants.POWER_ON_ALL_ZONES_COMMAND)
+
+    for zone in range(1, 4):
+        assert cache.get(zone, ["power"]) is None
+        assert cache.get(zone, ["mute"]) is not None
+
+    # queries don't change anything
+    cache.clear()
+    cache.update(ZoneDetail(1, power=False))
+    cache.invalidate(1, HtdConstants.QUERY_COMMAND_CODE, 0)
+    assert cache.get(1) is not None
+
+
+# against the simulator, a fresh zone is served without asking the device
+# again, until it's too old or a command changes it
+def test_client_serves_fresh_zones_from_the_cache():
+    sim = HtdSimulator()
+    sim.start_in_thread()
+    client = HtdMcClient(
+        "pipe", transport=PipeTransport(sim.attach), cache_ttl=0.2
+    )
+
+    try:
+        client.query_zone(1)
+        commands = sim.commands_received
+
+        assert client.get_zone(1).source == 1
+        assert sim.commands_received == commands
+
+        # the source change is answered, so it's known straight away
+        client.set_source(1, 2)
+        assert client.get_cached_zone(1).source == 2
+
+        time.sleep(0.25)
+        assert client.get_cached_zone(1) is None
+
+        commands = sim.commands_received
+        assert client.get_zone(1).source == 2
+        assert sim.commands_received == commands + 1
+    finally:
+        client.close()
+        sim.stop_thread()
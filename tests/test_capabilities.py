@@ -0,0 +1,59 @@
+import pytest
+
+from htd_mc_client.capabilities import DeviceCapabilities
+from htd_mc_client.client import HtdMcClient
+from htd_mc_client.constants import HtdConstants
+from htd_mc_client.models import ZoneDetail
+from htd_mc_client.simulator import HtdSimulator
+from htd_mc_client.transport import PipeTransport
+
+
+def test_limit_zones_drops_the_all_zones_commands():
+    capabilities = DeviceCapabilities()
+    limited = capabilities.limit_zones(4)
+
+    assert capabilities.zones == [1, 2, 3, 4, 5, 6]
+    assert capabilities.supports(HtdConstants.POWER_ON_ALL_ZONES_COMMAND)
+    assert limited.zones == [1, 2, 3, 4]
+    assert limited.source_count == 6
+    assert not limited.supports(HtdConstants.POWER_ON_ALL_ZONES_COMMAND)
+    assert not limited.supports(HtdConstants.POWER_OFF_ALL_ZONES_COMMAND)
+    assert limited.supports(HtdConstants.POWER_ON_ZONE_COMMAND)
+
+
+def test_limit_zones_keeps_a_device_that_is_already_small_enough():
+    capabilities = DeviceCapabilities()
+
+    assert capabilities.limit_zones(None) is capabilities
+    assert capabilities.limit_zones(6) is capabilities
+    assert str(capabilities) == "zones = 6, sources = 6"
+
+
+# a client limited to the zones wired up only ever talks to those, and
+# turns them all on zone by zone, since the all zones command would reach
+# the others too
+def test_client_only_uses_the_zones_in_use():
+    sim = HtdSimulator()
+    sim.start_in_thread()
+    client = HtdMcClient("pipe", transport=PipeTransport(sim.attach))
+    client.set_capabilities(client.capabilities.limit_zones(4))
+
+    try:
+        with pytest.raises(ValueError):
+            client.power_on(5)
+
+        with pytest.raises(ValueError):
+            client.power_on(all_zones=True)
+
+        assert sorted(client.query_all_zones()) == [1, 2, 3, 4]
+
+        zone_infos = client.apply_scene(
+            {zone: ZoneDetail(zone, power=True) for zone in range(1, 5)}
+        )
+    finally:
+        client.close()
+        sim.stop_thread()
+
+    assert all(zone_infos[zone].power for zone in range(1, 5))
+    assert not sim.zones[5].power
+    assert not sim.zones[6].power
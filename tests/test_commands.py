@@ -0,0 +1,95 @@
+import socket
+
+import pytest
+
+from htd_mc_client.capabilities import DeviceCapabilities
+from htd_mc_client.commands import CommandTable
+from htd_mc_client.constants import HtdConstants
+from htd_mc_client.decoder import FrameDecoder
+from htd_mc_client.simulator import HtdSimulator
+from htd_mc_client.utils import get_command
+
+SET = HtdConstants.SET_COMMAND_CODE
+QUERY = HtdConstants.QUERY_COMMAND_CODE
+
+
+def test_frames_match_the_ones_built_by_hand():
+    table = CommandTable()
+
+    for zone in range(1, 7):
+        for data_code in (
+            HtdConstants.POWER_ON_ZONE_COMMAND,
+            HtdConstants.VOLUME_UP_COMMAND,
+            3,  # source 1
+            8,  # source 6
+        ):
+            assert table.get(zone, SET, data_code) == bytes(
+                get_command(zone, SET, data_code)
+            )
+
+        frame = table.get(zone, QUERY, 0)
+        assert frame == bytes(get_command(zone, QUERY, 0))
+        assert frame[-1] == sum(frame[:-1])
+
+
+@pytest.mark.parametrize(
+    "zone, command, data_code",
+    [
+        (0, QUERY, 0),
+        (7, QUERY, 0),
+        (1, QUERY, 1),
+        (1, SET, 0),
+        (1, SET, 0x30),
+        (1, SET, 1000),
+        (1, 0x99, 0),
+    ],
+)
+def test_anything_not_in_the_table_is_rejected(zone, command, data_code):
+    with pytest.raises(ValueError):
+        CommandTable().get(zone, command, data_code)
+
+
+def test_table_only_holds_what_the_device_has():
+    table = CommandTable(
+        DeviceCapabilities(zone_count=4, source_count=2).limit_zones(3)
+    )
+
+    assert table.get(3, SET, 4)
+
+    for zone, data_code in (
+        (4, HtdConstants.POWER_ON_ZONE_COMMAND),
+        (1, HtdConstants.POWER_ON_ALL_ZONES_COMMAND),
+        (1, 5),  # source 3
+    ):
+        with pytest.raises(ValueError):
+            table.get(zone, SET, data_code)
+
+
+# a batch is every frame back to back, and the device answers each of them
+def test_batch_is_answered_command_by_command():
+    sim = HtdSimulator()
+    sim.start_in_thread()
+    table = CommandTable()
+    commands = [
+        (2, SET, HtdConstants.POWER_ON_ZONE_COMMAND),
+        (2, SET, 5),  # source 3
+        (4, QUERY, 0),
+    ]
+    batch = table.get_batch(commands)
+    decoder = FrameDecoder()
+    chunks = []
+
+    assert batch == b"".join(table.get(*command) for command in commands)
+
+    try:
+        with socket.create_connection(("127.0.0.1", sim.port), 2) as sock:
+            sock.sendall(batch)
+
+            while len(chunks) < len(commands):
+                chunks += decoder.feed(sock.recv(1024))
+    finally:
+        sim.stop_thread()
+
+    assert [chunk[2] for chunk in chunks] == [2, 2, 4]
+    assert sim.zones[2].power is True
+    assert sim.zones[2].source == 3
@@ -0,0 +1,102 @@
+import asyncio
+
+from htd_mc_client.async_client import AsyncHtdMcClient
+from htd_mc_client.groups import ZoneGroups, infer_zones
+from htd_mc_client.models import ZoneDetail
+from htd_mc_client.simulator import HtdSimulator
+from htd_mc_client.transport import PipeTransport
+
+
+def test_join_and_unjoin():
+    groups = ZoneGroups()
+
+    assert groups.join(2, [3, 2, 4]) == [2, 3, 4]
+    assert groups.get_members(4) == [2, 3, 4]
+
+    # joining somewhere else takes the zone out of its old group
+    assert groups.join(5, [4]) == [5, 4]
+    assert groups.get_members(2) == [2, 3]
+
+    groups.unjoin(3)
+    assert groups.get_members(2) == [2]
+    assert groups.get_members(3) == [3]
+    assert groups.get_members(5) == [5, 4]
+
+    # a group of one is no group
+    assert groups.join(1, []) == [1]
+    assert groups.get_members(1) == [1]
+
+
+def test_party_mode_links_every_zone_in_it():
+    groups = ZoneGroups()
+    zone_infos = {
+        zone: ZoneDetail(zone, party=zone in (1, 3, 6)) for zone in range(1, 7)
+    }
+
+    assert groups.get_members(3, zone_infos) == [1, 3, 6]
+    assert groups.get_members(2, zone_infos) == [2]
+
+    # a zone joined elsewhere isn't in the party
+    groups.join(6, [5])
+    assert groups.get_members(1, zone_infos) == [1, 3]
+
+
+def test_infer_zones_copies_only_what_the_scene_set():
+    current = {
+        zone: ZoneDetail(zone, power=True, source=1, volume=20, bass=zone)
+        for zone in (1, 2, 3)
+    }
+    scene = {
+        zone: ZoneDetail(zone, source=2, volume=50) for zone in (1, 2, 3, 4)
+    }
+    confirmed = {
+        1: ZoneDetail(1, power=True, source=2, volume=48, htd_volume=29)
+    }
+
+    inferred = infer_zones(scene, confirmed, current)
+
+    # zone 4 wasn't known before the scene, so it can't be worked out
+    assert sorted(inferred) == [2, 3]
+
+    for zone in (2, 3):
+        assert inferred[zone].source == 2
+        assert inferred[zone].volume == 48
+        assert inferred[zone].htd_volume == 29
+        assert inferred[zone].bass == zone
+
+    assert current[2].source == 1
+    assert infer_zones(scene, {1: None}, current) == {}
+
+
+# against the simulator, a change to one zone in a group goes to every zone
+# in it, and only the first is asked where it ended up
+def test_group_changes_go_to_every_member():
+    async def run():
+        sim = HtdSimulator()
+        await sim.start()
+        client = AsyncHtdMcClient("pipe", transport=PipeTransport(sim.attach))
+        client.start_listening()
+
+        try:
+            await client.query_all_zones()
+            client.groups.join(2, [4, 5])
+            await client.apply_group(4, power=True)
+            commands = sim.commands_received
+            zone_infos = await client.apply_group(5, source=3, volume=30)
+        finally:
+            await client.close()
+            await sim.close()
+
+        # three source changes, the volume steps and a single query
+        assert sim.commands_received - commands == 3 + 3 * 18 + 1
+
+        for zone in (2, 4, 5):
+            assert sim.zones[zone].power is True
+            assert sim.zones[zone].source == 3
+            assert sim.zones[zone].htd_volume == 18
+            assert zone_infos[zone].source == 3
+            assert zone_infos[zone].htd_volume == 18
+
+        assert sim.zones[1].power is False
+
+    asyncio.run(run())
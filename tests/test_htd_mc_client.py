@@ -0,0 +1,400 @@
+import asyncio
+import random
+import socket
+import time
+
+import pytest
+
+from htd_mc_client.async_client import AsyncHtdMcClient
+from htd_mc_client.client import HtdMcClient
+from htd_mc_client.constants import HtdConstants
+from htd_mc_client.decoder import FrameDecoder
+from htd_mc_client.models import ZoneDetail
+from htd_mc_client.simulator import HtdSimulator, get_chunk
+from htd_mc_client.transport import PipeTransport
+from htd_mc_client.utils import parse_all_zones, parse_message
+
+CHUNK_SIZE = HtdConstants.MESSAGE_CHUNK_SIZE
+
+
+# the parser as it was before it was sped up, kept to check the new one
+# against. it walks the data 14 bytes at a time and reads every field
+# straight out of the chunk.
+def old_parse_zone(zone_data: bytes) -> dict | None:
+    if (
+        zone_data[0] != HtdConstants.HEADER_BIT
+        and zone_data[1] != HtdConstants.RESERVED_BYTE
+    ):
+        return None
+
+    if zone_data[3] != 0x05:
+        return None
+
+    state_toggles = bin(
+        zone_data[HtdConstants.STATE_TOGGLES_ZONE_DATA_INDEX]
+    )[2:].zfill(4)
+    raw_volume = zone_data[HtdConstants.VOLUME_ZONE_DATA_INDEX]
+
+    if raw_volume == 0:
+        volume, htd_volume = 100, HtdConstants.MAX_HTD_VOLUME
+    else:
+        htd_volume = raw_volume - HtdConstants.VOLUME_OFFSET
+        volume = max(
+            0,
+            min(100, round(htd_volume / HtdConstants.MAX_HTD_VOLUME * 100)),
+        )
+
+    return {
+        "number": zone_data[HtdConstants.ZONE_NUMBER_ZONE_DATA_INDEX],
+        "power": state_toggles[HtdConstants.POWER_STATE_TOGGLE_INDEX] == "1",
+        "mute": state_toggles[HtdConstants.MUTE_STATE_TOGGLE_INDEX] == "1",
+        "mode": state_toggles[HtdConstants.MODE_STATE_TOGGLE_INDEX] == "1",
+        "party": (
+            state_toggles[HtdConstants.PARTY_MODE_STATE_TOGGLE_INDEX] == "1"
+        ),
+        "source": zone_data[HtdConstants.SOURCE_ZONE_DATA_INDEX] + 1,
+        "volume": volume,
+        "htd_volume": htd_volume,
+        # the old parser left these unsigned
+        "treble": signed(zone_data[HtdConstants.TREBLE_ZONE_DATA_INDEX]),
+        "bass": signed(zone_data[HtdConstants.BASS_ZONE_DATA_INDEX]),
+        "balance": signed(zone_data[HtdConstants.BALANCE_ZONE_DATA_INDEX]),
+    }
+
+
+def old_parse_all_zones(data: bytes) -> dict[int, dict]:
+    zones = {}
+
+    for position in range(0, len(data) - CHUNK_SIZE + 1, CHUNK_SIZE):
+        zone_info = old_parse_zone(data[position: position + CHUNK_SIZE])
+
+        if zone_info is not None:
+            zones[zone_info["number"]] = zone_info
+
+    return zones
+
+
+def signed(value: int) -> int:
+    return value - 256 if value > 127 else value
+
+
+FIELDS = (
+    "number",
+    "power",
+    "mute",
+    "mode",
+    "party",
+    "source",
+    "volume",
+    "htd_volume",
+    "treble",
+    "bass",
+    "balance",
+)
+
+
+def as_dict(zone_info) -> dict:
+    return {field: getattr(zone_info, field) for field in FIELDS}
+
+
+# a zone chunk with everything but the zone picked at random
+def zone_chunk(rng: random.Random, zone: int) -> bytes:
+    return get_chunk(
+        [
+            zone,
+            0x05,
+            rng.randrange(256),
+            0,
+            0,
+            0,
+            rng.randrange(6),
+            rng.randrange(256),
+            rng.randrange(256),
+            rng.randrange(256),
+            rng.randrange(256),
+        ]
+    )
+
+
+def echo_chunk(zone: int) -> bytes:
+    return HtdSimulator.get_echo_chunk(
+        zone, HtdConstants.QUERY_COMMAND_CODE, 0
+    )
+
+
+# only zone chunks come out, the echo in front of each reply is skipped
+def test_decoder_finds_chunks_split_anywhere():
+    sim = HtdSimulator()
+    data = echo_chunk(2) + sim.get_zone_chunk(2) + sim.get_zone_chunk(3)
+    decoder = FrameDecoder()
+    chunks = []
+
+    for index in range(len(data)):
+        chunks.extend(decoder.feed(data[index: index + 1]))
+
+    assert [chunk[2] for chunk in chunks] == [2, 3]
+    assert decoder.pending == 0
+
+
+def test_decoder_resyncs_past_junk_that_looks_like_a_start():
+    sim = HtdSimulator()
+    junk = bytes([0x02, 0x00, 0x01, 0x05, 0x00, 0x00, 0x00])
+
+    zones = parse_all_zones(junk + sim.get_zone_chunk(2))
+
+    assert list(zones) == [2]
+
+
+def test_decoder_drops_chunks_with_a_bad_checksum():
+    sim = HtdSimulator()
+    garbled = bytearray(sim.get_zone_chunk(2))
+    garbled[9] ^= 0x55
+
+    assert parse_message(2, bytes(garbled)) is None
+    assert list(parse_all_zones(bytes(garbled) + sim.get_zone_chunk(3))) == [
+        3
+    ]
+
+
+def test_decoder_counts_rejected_chunks():
+    sim = HtdSimulator()
+    garbled = bytearray(sim.get_zone_chunk(2))
+    garbled[9] ^= 0x55
+    bad_zone = bytearray(sim.get_zone_chunk(3))
+    bad_zone[2] = 0xFC
+    decoder = FrameDecoder()
+
+    chunks = decoder.feed(
+        echo_chunk(2) + garbled + bad_zone + sim.get_zone_chunk(4)
+    )
+
+    assert [chunk[2] for chunk in chunks] == [4]
+    assert decoder.rejected == 2
+
+
+# replies the simulator garbles show up as bad frames
+def test_async_counts_bad_frames():
+    async def run():
+        sim = HtdSimulator(garble_rate=0.5, seed=3)
+        await sim.start()
+        client = AsyncHtdMcClient(
+            "pipe", transport=PipeTransport(sim.attach), socket_timeout=0.2
+        )
+        client.start_listening()
+
+        try:
+            for zone in range(1, 7):
+                await client.query_zone(zone)
+        finally:
+            await client.close()
+            await sim.close()
+
+        assert sim.responses_garbled > 0
+        assert client.metrics.bad_frames > 0
+
+    asyncio.run(run())
+
+
+# a zone pushed while the model query waits goes to the zone, not to the
+# query, and bytes that aren't utf-8 don't break the answer
+def test_model_query_only_gets_what_isnt_a_zone_chunk():
+    async def run():
+        sim = HtdSimulator(latency=0.2)
+        await sim.start()
+        client = AsyncHtdMcClient("pipe", transport=PipeTransport(sim.attach))
+        client.start_listening()
+        pushed = []
+
+        async def get_model_info(push):
+            model_info = asyncio.create_task(client.get_model_info())
+
+            while client._raw_waiter is None:
+                await asyncio.sleep(0.01)
+
+            push()
+            return await model_info
+
+        try:
+            await client.query_zone(1)
+            client.subscribe(pushed.append)
+
+            assert await get_model_info(lambda: sim.push(3)) == "MCA66"
+            assert await get_model_info(
+                lambda: client._data_received(
+                    sim.get_zone_chunk(5) + b"MCA\xff"
+                )
+            ) == "MCA\ufffd"
+        finally:
+            await client.close()
+            await sim.close()
+
+        assert [zone_info.number for zone_info in pushed] == [3, 5]
+
+    asyncio.run(run())
+
+
+def test_parse_message_matches_old_parser():
+    rng = random.Random(1)
+
+    for _ in range(500):
+        zone = rng.randrange(1, 7)
+        response = echo_chunk(zone) + zone_chunk(rng, zone)
+
+        zone_info = parse_message(zone, response)
+
+        assert as_dict(zone_info) == old_parse_all_zones(response)[zone]
+
+
+def test_parse_all_zones_matches_old_parser():
+    rng = random.Random(2)
+
+    for _ in range(100):
+        zones = rng.sample(range(1, 7), rng.randrange(1, 7))
+        data = b"".join(
+            echo_chunk(zone) + zone_chunk(rng, zone) for zone in zones
+        )
+
+        parsed = parse_all_zones(data)
+
+        assert {
+            zone: as_dict(zone_info) for zone, zone_info in parsed.items()
+        } == old_parse_all_zones(data)
+
+
+def test_sync_round_trip():
+    sim = HtdSimulator(fragment_size=5)
+    sim.start_in_thread()
+    client = HtdMcClient("pipe", transport=PipeTransport(sim.attach))
+
+    try:
+        assert client.power_on(2).power is True
+        assert client.set_source(2, 3).source == 3
+        assert client.set_volume(2, 50).volume == 50
+        assert client.set_mute(2, True).mute is True
+        assert sorted(client.query_all_zones()) == [1, 2, 3, 4, 5, 6]
+    finally:
+        client.close()
+        sim.stop_thread()
+
+    assert sim.zones[2].source == 3
+    assert sim.zones[2].htd_volume == 30
+
+
+def test_async_round_trip():
+    async def run():
+        sim = HtdSimulator(fragment_size=5)
+        await sim.start()
+        client = AsyncHtdMcClient("pipe", transport=PipeTransport(sim.attach))
+        client.start_listening()
+
+        try:
+            assert (await client.power_on(4)).power is True
+            assert (await client.set_source(4, 2)).source == 2
+            assert (await client.set_volume(4, 25)).htd_volume == 15
+            assert (await client.set_mute(4, True)).mute is True
+            zone_infos = await client.query_all_zones()
+        finally:
+            await client.close()
+            await sim.close()
+
+        assert sorted(zone_infos) == [1, 2, 3, 4, 5, 6]
+        assert sim.zones[4].htd_volume == 15
+
+    asyncio.run(run())
+
+
+# while the connection backs off, commands fail straight away instead of
+# waiting behind the backoff
+def test_offline_gateway_fails_fast():
+    async def run():
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        listener.close()
+
+        client = AsyncHtdMcClient("127.0.0.1", port=port, retry_attempts=2)
+        client.start_listening()
+        start = time.monotonic()
+
+        try:
+            with pytest.raises(OSError):
+                await client.power_on(3)
+
+            with pytest.raises(OSError):
+                await client.query_all_zones()
+        finally:
+            await client.close()
+
+        assert time.monotonic() - start < 1
+
+    asyncio.run(run())
+
+
+# the writer is the only one pacing the steps, so the time spent pacing
+# can't be more than the ramp took
+def test_async_volume_ramp_is_paced_once():
+    async def run():
+        sim = HtdSimulator()
+        await sim.start()
+        client = AsyncHtdMcClient(
+            "pipe", transport=PipeTransport(sim.attach), command_delay=20
+        )
+        client.start_listening()
+
+        try:
+            await client.query_zone(1)
+            pacing_time = client.metrics.pacing_time
+            start = time.monotonic()
+            zone_info = await client.set_volume(1, 50)
+            elapsed = time.monotonic() - start
+        finally:
+            await client.close()
+            await sim.close()
+
+        assert zone_info.htd_volume == 30
+        assert client.metrics.pacing_time - pacing_time <= elapsed
+
+    asyncio.run(run())
+
+
+# the answers to the steps feed the pacer, so a cold ramp speeds up as it
+# goes instead of keeping the configured delay throughout
+def test_volume_step_answers_feed_the_pacer():
+    async def run():
+        sim = HtdSimulator()
+        await sim.start()
+        async_client = AsyncHtdMcClient("127.0.0.1", port=sim.port)
+        async_client.start_listening()
+        sync_client = HtdMcClient("127.0.0.1", port=sim.port)
+
+        try:
+            assert (await async_client.set_volume(1, 100)).volume == 100
+            zone_info = await asyncio.to_thread(sync_client.set_volume, 2, 100)
+        finally:
+            await async_client.close()
+            sync_client.close()
+            await sim.close()
+
+        assert zone_info.volume == 100
+
+        for client in (async_client, sync_client):
+            assert client.pacer.delay == client.pacer.min_delay
+            assert client.metrics.bad_responses == 0
+
+    asyncio.run(run())
+
+
+# a zone that didn't end up where its steps should have taken it had steps
+# dropped, which backs the pacing off
+def test_dropped_volume_steps_back_off():
+    client = HtdMcClient("127.0.0.1")
+    client.pacer.delay = client.pacer.min_delay
+
+    client.check_volume_steps(ZoneDetail(1, htd_volume=30), 30)
+
+    assert client.metrics.bad_responses == 0
+
+    client.check_volume_steps(ZoneDetail(1, htd_volume=28), 30)
+
+    assert client.metrics.bad_responses == 1
+    assert client.pacer.delay > client.pacer.min_delay
@@ -0,0 +1,101 @@
+import random
+
+import pytest
+
+from htd_mc_client.client import HtdMcClient
+from htd_mc_client.constants import HtdConstants
+from htd_mc_client.pacing import AdaptivePacer
+from htd_mc_client.simulator import HtdSimulator
+from htd_mc_client.transport import PipeTransport
+
+
+def test_delay_shrinks_while_healthy_and_doubles_on_a_bad_answer():
+    pacer = AdaptivePacer(0.1, 1, min_delay=0.01)
+
+    assert pacer.delay == 0.1
+
+    pacer.record_response(0.02, True)
+    assert pacer.delay == 0.1 * 0.8
+
+    for _ in range(20):
+        pacer.record_response(0.02, True)
+
+    assert pacer.delay == 0.01
+
+    pacer.record_response(0.02, False)
+    assert pacer.delay == 0.02
+
+    for _ in range(10):
+        pacer.record_timeout()
+
+    assert pacer.delay == 0.1
+    assert pacer.bad_response_rate > 0.5
+
+
+def test_timeout_follows_the_round_trip_within_its_bounds():
+    pacer = AdaptivePacer(0.1, 1)
+
+    # nothing measured yet, so the configured timeout
+    assert pacer.timeout == 1
+
+    for _ in range(20):
+        pacer.record_response(0.01, True)
+
+    assert pacer.timeout == HtdConstants.MIN_RESPONSE_TIMEOUT
+
+    for _ in range(20):
+        pacer.record_response(0.5, True)
+
+    assert HtdConstants.MIN_RESPONSE_TIMEOUT < pacer.timeout < 1
+
+    for _ in range(20):
+        pacer.record_response(5, True)
+
+    assert pacer.timeout == 1
+
+
+def test_retry_delay_backs_off_up_to_its_cap():
+    random.seed(1)
+    pacer = AdaptivePacer(0.1, 1)
+
+    for attempt in range(6):
+        max_retry_delay = 0.1 * 2 * (attempt + 1)
+        retry_delay = pacer.retry_delay(attempt)
+
+        assert retry_delay <= max_retry_delay
+        assert retry_delay >= min(
+            max_retry_delay, pacer.delay * 2 ** attempt / 2
+        )
+
+
+# against the simulator, the pacing speeds up while the device keeps up and
+# backs off as soon as it stops answering
+def test_client_pacing_follows_the_device():
+    sim = HtdSimulator(latency=0.01, seed=1)
+    sim.start_in_thread()
+    client = HtdMcClient(
+        "pipe",
+        transport=PipeTransport(sim.attach),
+        retry_attempts=0,
+        socket_timeout=0.5,
+        cache_ttl=0,
+    )
+
+    try:
+        for _ in range(3):
+            client.query_all_zones()
+
+        healthy_delay = client.pacer.delay
+        assert healthy_delay < client.command_delay_sec
+        assert client.pacer.timeout < client.socket_timeout
+
+        sim.drop_rate = 1
+
+        with pytest.raises(TimeoutError):
+            client.query_zone(1)
+    finally:
+        client.close()
+        sim.stop_thread()
+
+    assert client.pacer.delay > healthy_delay
+    assert client.metrics.timeouts == 1
@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+from htd_mc_client.async_client import AsyncHtdMcClient
+from htd_mc_client.cache import ZoneCache
+from htd_mc_client.constants import HtdConstants
+from htd_mc_client.models import ZoneDetail
+from htd_mc_client.polling import PollPlanner
+from htd_mc_client.simulator import HtdSimulator
+from htd_mc_client.transport import PipeTransport
+
+ZONES = [1, 2, 3, 4, 5, 6]
+
+
+def get_planner(cache: ZoneCache, budget: int = 6) -> PollPlanner:
+    return PollPlanner(
+        cache, active_interval=0.05, idle_interval=0.2, budget=budget
+    )
+
+
+def test_zones_on_are_polled_more_often_than_zones_off():
+    cache = ZoneCache(ttl=10)
+    planner = get_planner(cache)
+    cache.update(ZoneDetail(1, power=True))
+    cache.update(ZoneDetail(2, power=False, party=True))
+    cache.update(ZoneDetail(3, power=False))
+
+    assert planner.get_due_zones([1, 2, 3], cache.known) == []
+
+    time.sleep(0.06)
+    assert sorted(planner.get_due_zones([1, 2, 3], cache.known)) == [1, 2]
+
+    time.sleep(0.15)
+    assert sorted(planner.get_due_zones([1, 2, 3], cache.known)) == [
+        1, 2, 3
+    ]
+
+
+def test_budget_goes_to_changing_then_unknown_then_most_overdue():
+    cache = ZoneCache(ttl=10)
+    planner = get_planner(cache, budget=3)
+
+    for zone in (1, 2, 3):
+        cache.update(ZoneDetail(zone, power=True))
+
+    time.sleep(0.03)
+    cache.update(ZoneDetail(4, power=True))
+    cache.update(ZoneDetail(5, power=True))
+    time.sleep(0.03)
+
+    # 5 has a command on its way, 6 was never heard from, and of the ones
+    # that are overdue, 1 - 3 have waited the longest
+    cache.invalidate(
+        5, HtdConstants.SET_COMMAND_CODE, HtdConstants.VOLUME_UP_COMMAND
+    )
+    due = planner.get_due_zones(ZONES, cache.known)
+
+    assert due[:2] == [5, 6]
+    assert due[2] in (1, 2, 3)
+
+
+# a zone the gateway pushes to us counts as heard from, so it isn't polled
+def test_pushed_zones_are_not_polled():
+    async def run():
+        sim = HtdSimulator()
+        await sim.start()
+        client = AsyncHtdMcClient("pipe", transport=PipeTransport(sim.attach))
+        client.start_listening()
+        planner = get_planner(client.cache)
+
+        try:
+            await client.query_all_zones()
+            await asyncio.sleep(0.25)
+
+            assert sorted(
+                planner.get_due_zones(ZONES, client.cache.known)
+            ) == ZONES
+
+            sim.push(2)
+            sim.push(5)
+
+            while max(client.cache.age(2), client.cache.age(5)) > 0.1:
+                await asyncio.sleep(0.01)
+
+            due = planner.get_due_zones(ZONES, client.cache.known)
+        finally:
+            await client.close()
+            await sim.close()
+
+        assert sorted(due) == [1, 3, 4, 6]
+
+    asyncio.run(run())
@@ -0,0 +1,108 @@
+from htd_mc_client.client import HtdMcClient
+from htd_mc_client.constants import HtdConstants
+from htd_mc_client.models import ZoneDetail
+from htd_mc_client.simulator import HtdSimulator
+from htd_mc_client.transport import PipeTransport
+
+SET = HtdConstants.SET_COMMAND_CODE
+ZONES = [1, 2, 3, 4, 5, 6]
+
+
+def get_zone(zone: int, **settings) -> ZoneDetail:
+    state = dict(
+        power=False,
+        mute=False,
+        source=1,
+        volume=0,
+        htd_volume=0,
+        bass=0,
+        treble=0,
+        balance=0,
+    )
+    state.update(settings)
+    return ZoneDetail(zone, **state)
+
+
+def test_every_zone_on_is_one_all_zones_command():
+    client = HtdMcClient("127.0.0.1")
+    current = {zone: get_zone(zone) for zone in ZONES}
+    scene = {zone: ZoneDetail(zone, power=True) for zone in ZONES}
+
+    assert client.plan_scene(scene, current) == [
+        (1, SET, HtdConstants.POWER_ON_ALL_ZONES_COMMAND)
+    ]
+
+    # without every zone, or without the all zones command, zone by zone
+    del scene[6]
+    assert client.plan_scene(scene, current) == [
+        (zone, SET, HtdConstants.POWER_ON_ZONE_COMMAND)
+        for zone in range(1, 6)
+    ]
+
+    client.set_capabilities(client.capabilities.limit_zones(5))
+    assert client.plan_scene(scene, current) == [
+        (zone, SET, HtdConstants.POWER_ON_ZONE_COMMAND)
+        for zone in range(1, 6)
+    ]
+
+
+def test_only_what_differs_is_sent():
+    client = HtdMcClient("127.0.0.1")
+    current = {
+        1: get_zone(1, power=True, source=2, volume=50, htd_volume=30),
+        2: get_zone(2, mute=True, bass=11),
+    }
+    scene = {
+        1: ZoneDetail(1, power=True, source=3, volume=55),
+        2: ZoneDetail(2, mute=False, bass=20, treble=-2),
+    }
+
+    assert client.plan_scene(scene, current) == [
+        (1, SET, 5),  # source 3
+        *[(1, SET, HtdConstants.VOLUME_UP_COMMAND)] * 3,
+        (2, SET, HtdConstants.TOGGLE_MUTE_COMMAND),
+        # bass stops at the most the device goes to
+        (2, SET, HtdConstants.BASE_UP_COMMAND),
+        *[(2, SET, HtdConstants.TREBLE_DOWN_COMMAND)] * 2,
+    ]
+
+
+# nothing relative can be worked out for a zone we know nothing about
+def test_unknown_zone_only_gets_absolute_changes():
+    client = HtdMcClient("127.0.0.1")
+    scene = {3: ZoneDetail(3, power=True, source=2, mute=True, volume=40)}
+
+    assert client.plan_scene(scene, {3: None}) == [
+        (3, SET, HtdConstants.POWER_ON_ZONE_COMMAND),
+        (3, SET, 4),  # source 2
+    ]
+
+
+# against the simulator, the whole scene lands with just the commands it
+# needs and one query per zone to confirm it
+def test_scene_is_applied_to_the_device():
+    sim = HtdSimulator(fragment_size=5)
+    sim.start_in_thread()
+    client = HtdMcClient("pipe", transport=PipeTransport(sim.attach))
+    scene = {
+        zone: ZoneDetail(zone, power=True, source=zone, volume=10 * zone)
+        for zone in ZONES
+    }
+
+    try:
+        client.query_all_zones()
+        commands = sim.commands_received
+        zone_infos = client.apply_scene(scene)
+    finally:
+        client.close()
+        sim.stop_thread()
+
+    for zone in ZONES:
+        assert zone_infos[zone].power is True
+        assert zone_infos[zone].source == zone
+        assert zone_infos[zone].volume == 10 * zone
+        assert sim.zones[zone].source == zone
+
+    steps = sum(round(zone * 10 / 100 * 60) for zone in ZONES)
+    # one all zones command, five source changes, the steps and the queries
+    assert sim.commands_received - commands == 1 + 5 + steps + 6
@@ -0,0 +1,159 @@
+import asyncio
+
+from htd_mc_client.async_client import AsyncHtdMcClient
+from htd_mc_client.constants import HtdConstants
+from htd_mc_client.scheduler import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_USER,
+    CommandScheduler,
+)
+from htd_mc_client.simulator import HtdSimulator
+from htd_mc_client.transport import PipeTransport
+
+QUERY = HtdConstants.QUERY_COMMAND_CODE
+SET = HtdConstants.SET_COMMAND_CODE
+POWER_ON = HtdConstants.POWER_ON_ZONE_COMMAND
+VOLUME_UP = HtdConstants.VOLUME_UP_COMMAND
+VOLUME_DOWN = HtdConstants.VOLUME_DOWN_COMMAND
+
+
+# a scheduler whose writer only writes down what it was handed, and answers
+# every command with the order it was sent in
+def get_scheduler() -> (CommandScheduler, list):
+    sent = []
+
+    async def execute(batch):
+        sent.append(
+            [
+                (scheduled.zone, scheduled.command, scheduled.data_code)
+                for scheduled in batch
+            ]
+        )
+
+        for scheduled in batch:
+            scheduled.set_result(len(sent))
+
+    return CommandScheduler(execute), sent
+
+
+def test_query_is_shared_with_a_waiting_query():
+    async def run():
+        scheduler, sent = get_scheduler()
+        first = scheduler.submit(1, QUERY, 0)
+        second = scheduler.submit(1, QUERY, 0)
+
+        assert scheduler.depth == 1
+        assert await first == await second
+        assert sent == [[(1, QUERY, 0)]]
+        await scheduler.close()
+
+    asyncio.run(run())
+
+
+def test_query_is_not_shared_across_a_command_for_its_zone():
+    async def run():
+        scheduler, sent = get_scheduler()
+        before = scheduler.submit(1, QUERY, 0)
+        power_on = scheduler.submit(1, SET, POWER_ON)
+        after = scheduler.submit(1, QUERY, 0)
+
+        assert scheduler.depth == 3
+        await asyncio.gather(before, power_on, after)
+        assert sent == [[(1, QUERY, 0)], [(1, SET, POWER_ON)], [(1, QUERY, 0)]]
+        assert after.result() > power_on.result()
+        await scheduler.close()
+
+    asyncio.run(run())
+
+
+# a query for another zone is batched with the first one, the one behind
+# the command for its zone isn't
+def test_batch_leaves_queries_behind_a_command_for_their_zone():
+    async def run():
+        scheduler, sent = get_scheduler()
+        futures = [
+            scheduler.submit(2, QUERY, 0),
+            scheduler.submit(1, SET, POWER_ON),
+            scheduler.submit(1, QUERY, 0),
+            scheduler.submit(3, QUERY, 0),
+        ]
+
+        await asyncio.gather(*futures)
+        assert sent == [
+            [(2, QUERY, 0), (3, QUERY, 0)],
+            [(1, SET, POWER_ON)],
+            [(1, QUERY, 0)],
+        ]
+        await scheduler.close()
+
+    asyncio.run(run())
+
+
+def test_volume_steps_are_merged_into_a_net_change():
+    async def run():
+        scheduler, sent = get_scheduler()
+        futures = [
+            scheduler.submit(1, SET, data_code, wait_reply=False)
+            for data_code in (VOLUME_UP, VOLUME_UP, VOLUME_DOWN, VOLUME_UP)
+        ]
+        scheduled = scheduler._lanes[PRIORITY_USER][0]
+
+        assert scheduler.depth == 1
+        assert scheduled.steps == 2
+        assert scheduled.wait_reply is False
+
+        futures.append(scheduler.submit(1, SET, VOLUME_DOWN))
+
+        assert scheduled.steps == 1
+        assert scheduled.wait_reply is True
+        await asyncio.gather(*futures)
+        assert len(sent) == 1
+        await scheduler.close()
+
+    asyncio.run(run())
+
+
+# a background query a user is now waiting on moves to the end of the user
+# lane, ahead of the rest of the polling
+def test_waiting_query_is_promoted_to_the_user_lane():
+    async def run():
+        scheduler, sent = get_scheduler()
+        futures = [
+            scheduler.submit(1, QUERY, 0, PRIORITY_BACKGROUND),
+            scheduler.submit(4, QUERY, 0, PRIORITY_BACKGROUND),
+            scheduler.submit(2, SET, POWER_ON),
+            scheduler.submit(1, QUERY, 0),
+        ]
+
+        assert list(scheduler._lanes[PRIORITY_USER])[-1].zone == 1
+        assert len(scheduler._lanes[PRIORITY_BACKGROUND]) == 1
+        await asyncio.gather(*futures)
+        assert sent == [[(2, SET, POWER_ON)], [(1, QUERY, 0)], [(4, QUERY, 0)]]
+        assert futures[0].result() == futures[3].result()
+        await scheduler.close()
+
+    asyncio.run(run())
+
+
+def test_concurrent_query_sees_the_command_before_it():
+    async def run():
+        sim = HtdSimulator()
+        await sim.start()
+        client = AsyncHtdMcClient("pipe", transport=PipeTransport(sim.attach))
+        client.start_listening()
+
+        try:
+            before, powered, after = await asyncio.gather(
+                client.query_zone(1),
+                client.power_on(1),
+                client.query_zone(1),
+            )
+        finally:
+            await client.close()
+            await sim.close()
+
+        assert before.power is False
+        assert powered.power is True
+        assert after.power is True
+
+    asyncio.run(run())
@@ -0,0 +1,93 @@
+import asyncio
+
+from htd_mc_client.async_client import AsyncHtdMcClient
+from htd_mc_client.simulator import HtdSimulator
+from htd_mc_client.transport import PipeTransport
+from htd_mc_client.volume import GroupVolumeController, VolumeController
+
+
+async def start() -> (HtdSimulator, AsyncHtdMcClient):
+    sim = HtdSimulator(latency=0.002)
+    await sim.start()
+    client = AsyncHtdMcClient("pipe", transport=PipeTransport(sim.attach))
+    client.start_listening()
+    await client.query_all_zones()
+    return sim, client
+
+
+# a dragged slider only ever runs one ramp, which ends up at the last
+# volume it was given
+def test_dragged_volume_runs_a_single_ramp():
+    async def run():
+        sim, client = await start()
+        updates = []
+        controller = VolumeController(
+            client, 1, on_update=updates.append, update_interval=0
+        )
+
+        try:
+            first = asyncio.create_task(controller.set_volume(80))
+            await asyncio.sleep(0.01)
+            ramp = controller._task
+
+            for volume in (60, 40, 50):
+                await asyncio.sleep(0.02)
+                assert controller._task is ramp
+                latest = asyncio.create_task(controller.set_volume(volume))
+
+            zone_infos = await asyncio.gather(first, latest)
+        finally:
+            await controller.close()
+            await client.close()
+            await sim.close()
+
+        assert [zone_info.volume for zone_info in zone_infos] == [50, 50]
+        assert sim.zones[1].htd_volume == 30
+        assert updates and updates[-1].volume == 50
+        assert not controller.changing
+
+    asyncio.run(run())
+
+
+def test_closing_stops_the_ramp():
+    async def run():
+        sim, client = await start()
+        controller = VolumeController(client, 2, debounce=0.05)
+
+        try:
+            ramp = asyncio.create_task(controller.set_volume(100))
+            await asyncio.sleep(0.01)
+            await controller.close()
+            await asyncio.sleep(0.1)
+        finally:
+            await client.close()
+            await sim.close()
+
+        assert ramp.cancelled()
+        assert sim.zones[2].htd_volume == 0
+
+    asyncio.run(run())
+
+
+def test_group_ramp_takes_every_member():
+    async def run():
+        sim, client = await start()
+        client.groups.join(3, [5, 6])
+        controller = GroupVolumeController(client, 3)
+
+        try:
+            zone_info = await controller.set_volume(25)
+        finally:
+            await controller.close()
+            await client.close()
+            await sim.close()
+
+        assert zone_info.number == 3
+        assert zone_info.htd_volume == 15
+
+        for zone in (3, 5, 6):
+            assert sim.zones[zone].htd_volume == 15
+
+        assert sim.zones[4].htd_volume == 0
+
+    asyncio.run(run())